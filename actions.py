@@ -4,11 +4,26 @@ then the cooresponding method of Actions will be called.
 
 Any views that have to load a separate thread or process"""
 import os
+import json
+import time
 import shutil
 import datetime
+from collections import OrderedDict
+from threading import Thread, Lock
+from urllib.error import URLError
+from concurrent.futures import ThreadPoolExecutor
 from logmod import Log
 from wpcli import Installations, DatabaseInformation, WpConfig
 from wpcli import Themes, Plugins
+from dbdump import IncrementalDump
+from objectstore import ObjectStore, MANIFEST_EXTENSION, replace_tree
+from catalog import RevisionCatalog, revision_size
+from retention import RetentionEngine
+from database import DbConnections, human_size
+from jobs import DONE
+from jobqueue import JobQueue, TaskFailed
+from updates import UpdateCache, download
+from fleet import FleetOperation
 L = Log()
 
 
@@ -23,6 +38,7 @@ class Actions(object):
         self.plugins = PluginActions(app, self.revisions)
         self.database = DatabaseActions(app, self.revisions)
         self.themes = ThemeActions(app, self.revisions)
+        self.fleet = FleetActions(app, self.revisions)
 
     def change_text_attr(self, main_loop, changes):
         """Changes the attribute of a text_object as part
@@ -46,6 +62,8 @@ class DatabaseActions(object):
         self.db_exported = False
         self.sr_search_term = None
         self.replace_term = None
+        # the direct DB search being paged in the DbSearch view
+        self.search = {'engine': None, 'query': '', 'page': 0}
 
     def wpcli_not_exist(self):
         """Checks if the database's wpcli instance exists"""
@@ -146,6 +164,15 @@ class DatabaseActions(object):
     def db_search(self, edit, query):
         """Search Database for Query"""
         L.debug('Edit Obj: %s, Query: %s', edit, query)
+        self.cancel_db_search()
+        engine = None
+        if not self.wpcli_not_exist():
+            engine = self.wpcli.db_search_engine(query)
+        if engine:
+            self.search = {'engine': engine, 'query': query, 'page': 0}
+            self.app.views.DbSearch.body.show_searching(query)
+            self.fetch_db_search_page()
+            return
         if self.wpcli_not_exist():
             db_search_results = self.wpcli_not_exist()
             L.warning(db_search_results)
@@ -157,6 +184,48 @@ class DatabaseActions(object):
         self.app.views.DbSearch.body.after_action(
             db_search_results, query)
 
+    def page_db_search(self, button, step):
+        """Moves the direct DB search step pages back or forward"""
+        L.debug('Button: %s, Step: %s', button, step)
+        if not self.search['engine']:
+            return
+        self.search['page'] = max(0, self.search['page'] + step)
+        self.fetch_db_search_page()
+
+    def cancel_db_search(self, *args):
+        """Stops the direct DB search. Pages already found can still be
+        viewed"""
+        L.debug('Cancel DB search: %s', args)
+        if self.search['engine']:
+            self.search['engine'].cancel()
+
+    def fetch_db_search_page(self):
+        """Reads the current page of the direct DB search in a thread,
+        and shows it in the DbSearch view once found"""
+        body = self.app.views.DbSearch.body
+        engine = self.search['engine']
+        query = self.search['query']
+        index = self.search['page']
+        page_size = getattr(self.app.settings, 'database', {}).get(
+            'search_page_size', 50)
+        pipe = self.app.loop.watch_pipe(body.show_search_page)
+
+        def fetch():
+            """Runs in the db_search thread"""
+            results, more = engine.page(index, page_size)
+            paging = {
+                'page': index,
+                'offset': index * page_size,
+                'more': more,
+                'finished': engine.finished,
+                'cancelled': engine.stopped,
+            }
+            body.pending_page = (results, query, paging)
+            os.write(pipe, b'p')
+            os.close(pipe)
+
+        Thread(target=fetch, name='db_search', daemon=True).start()
+
     def sr_search(self, origin, search_term):
         """obtains search and replace search term"""
 
@@ -205,24 +274,43 @@ class PluginActions(object):
     def activate(self, plugin):
         """activates a given plugin"""
 
+        self.wpcli.invalidate_list()
         self.wpcli.activate(plugin['name'])
         self.app.views.Plugins.body.show_plugin_action_response()
 
     def deactivate(self, plugin):
         """Deactivates a given plugin"""
 
+        self.wpcli.invalidate_list()
         self.wpcli.deactivate(plugin['name'])
         self.app.views.Plugins.body.show_plugin_action_response()
 
-    def deactivate_all(self):
-        """Deactivates all active plugins, and stores a list
-        of the plugins that were active"""
+    def deactivate_all(self, *args):
+        """Deactivates all active plugins with a single write of the
+        active_plugins option, and stores a list of the plugins that were
+        active"""
+
+        self.wpcli.invalidate_list()
+        self.revisions.run_queue(
+            'Plugins', lambda queue: queue.add(
+                'deactivate', 'Deactivate all plugins',
+                self.deactivate_job))
+
+    def deactivate_job(self):
+        """Does the work of deactivate_all, as a JobQueue task"""
 
         active_plugins = self.wpcli.get_active_plugins()
         L.debug('Active Plugins: %s', active_plugins)
+        try:
+            count = len(json.loads(active_plugins))
+        except ValueError:
+            raise TaskFailed(active_plugins.strip() or
+                             'Active plugins could not be read')
+        result = self.wpcli.set_active_plugins('[]').strip()
+        if not result.startswith('Success'):
+            raise TaskFailed(result or 'Plugins could not be deactivated')
         self.app.views.Plugins.body.deactivated_plugins = active_plugins
-        self.wpcli.deactivate('--all')
-        self.app.views.Plugins.body.show_plugin_action_response()
+        return 'Deactivated %s plugins' % count
 
     def get_plugin_list(self):
         """Gets list of plugins"""
@@ -235,21 +323,35 @@ class PluginActions(object):
     def install_plugin(self, edit_widget, edit_text):
         """Installs a plugin from wordpress.org repo"""
 
+        self.wpcli.invalidate_list()
         L.debug("edit_widget: %s, edit_text: %s", edit_widget, edit_text)
         self.app.views.Plugins.body.show_plugin_action_response()
         self.wpcli.install(edit_text)
         L.debug('wpcli_pipe fstat: %s', os.fstat(self.app.wpcli_pipe))
 
-    def reactivate_all(self):
+    def reactivate_all(self, *args):
         """Reactivates all plugins that were previously deactivated
-        by deactivate_all"""
+        by deactivate_all, with a single write of the active_plugins
+        option"""
+
+        self.wpcli.invalidate_list()
+        self.revisions.run_queue(
+            'Plugins', lambda queue: queue.add(
+                'reactivate', 'Reactivate plugins', self.reactivate_job))
+
+    def reactivate_job(self):
+        """Does the work of reactivate_all, as a JobQueue task. The list
+        of deactivated plugins is kept until it has been written"""
+
+        body = self.app.views.Plugins.body
+        if not body.deactivated_plugins:
+            raise TaskFailed('No plugins were deactivated')
         result = self.wpcli.set_active_plugins(
-            self.app.views.Plugins.body.deactivated_plugins
-        )
-        self.app.views.Plugins.body.deactivated_plugins = []
-        self.app.views.Plugins.body.show_plugin_action_response(
-            response_text=result)
-        self.app.views.Plugins.body.after_response()
+            body.deactivated_plugins).strip()
+        if not result.startswith('Success'):
+            raise TaskFailed(result or 'Plugins could not be reactivated')
+        body.deactivated_plugins = []
+        return result
 
     def details(self, plugin):
         """Obtain plugin details"""
@@ -260,52 +362,91 @@ class PluginActions(object):
             plugin_details
         )
 
-    def update_all(self):
-        """Updates all plugins"""
+    def backup(self, plugin_name):
+        """Backs up a plugin and the database ahead of a change to the
+        plugin. Runs in the wp-cli thread, and reports progress in the
+        response area"""
 
-        L.debug('Update All')
-        plugin_dir = self.wpcli.get_plugin_path()
+        plugin_dir = self.wpcli.get_plugin_path(plugin_name)
         L.debug('Plugin_dir: %s', plugin_dir)
         if not self.revisions.auto_bk(
                 plugin_src=plugin_dir,
-                plugin_dest=('plugins/' + 'all_plugins'),
+                plugin_dest=('plugins/' + plugin_name),
                 backup_plugins=True,
-                backup_db=True):
-            self.app.views.Plugin.backup_failed = True
-        self.app.views.Plugins.body.show_plugin_action_response()
-        self.wpcli.update('--all')
-        L.debug('wpcli_pipe fstat: %s', os.fstat(self.app.wpcli_pipe))
+                backup_db=True,
+                progress=self.revisions.pipe_progress):
+            self.app.views.Plugins.backup_failed = True
+
+    def update_all(self, *args):
+        """Queues the update of every plugin with an update available"""
+
+        self.wpcli.invalidate_list()
+        L.debug('Update All')
+        self.revisions.run_queue('Plugins', self.queue_updates)
+
+    def queue_updates(self, queue):
+        """Adds the backup, download and update steps of each plugin
+        with an update available to queue"""
+
+        plugin_root = self.wpcli.get_plugin_path()
+
+        def source(name):
+            """Returns the path backed up for plugin name"""
+            plugin_dir = os.path.join(plugin_root, name)
+            if not os.path.isdir(plugin_dir):
+                # single file plugins
+                plugin_dir = self.wpcli.get_plugin_path(name)
+            return plugin_dir
+
+        self.revisions.queue_update_steps(
+            queue, 'plugin', self.wpcli, source)
 
     def update(self, plugin):
-        """Updates specified plugin"""
+        """Updates specified plugin, once it has been backed up"""
 
-        plugin_dir = self.wpcli.get_plugin_path(plugin['name'])
-        L.debug('Plugin_dir: %s', plugin_dir)
-        if not self.revisions.auto_bk(
-                plugin_src=plugin_dir,
-                plugin_dest=('plugins/' + plugin['name']),
-                backup_plugins=True,
-                backup_db=True):
-            self.app.views.Plugin.backup_failed = True
+        self.wpcli.invalidate_list()
         self.app.views.Plugins.body.show_plugin_action_response()
-        self.wpcli.update(plugin['name'])
+        self.wpcli.update(
+            plugin['name'],
+            before=lambda: self.backup(plugin['name']))
         L.debug('wpcli_pipe fstat: %s', os.fstat(self.app.wpcli_pipe))
 
     def uninstall(self, plugin):
-        """Uninstalls specified plugin"""
+        """Uninstalls specified plugin, once it has been backed up"""
 
-        plugin_dir = self.wpcli.get_plugin_path(plugin['name'])
-        L.debug('Plugin_dir: %s', plugin_dir)
-        if not self.revisions.auto_bk(
-                plugin_src=plugin_dir,
-                plugin_dest=('plugins/' + plugin['name']),
-                backup_themes=False):
-            self.app.views.Plugin.backup_failed = True
+        self.wpcli.invalidate_list()
         self.app.views.Plugins.body.show_plugin_action_response()
-        self.wpcli.uninstall(plugin['name'])
+        self.wpcli.uninstall(
+            plugin['name'],
+            before=lambda: self.backup(plugin['name']))
         L.debug('wpcli_pipe fstat: %s', os.fstat(self.app.wpcli_pipe))
 
 
+class BackupJob(object):
+    """Backups started by RevisionActions.start_backup. futures is a
+    list of (label, future) of the backups running on the backup pool"""
+
+    def __init__(self, app, futures):
+        self.app = app
+        self.futures = futures
+
+    def wait(self):
+        """Waits until every backup is committed. Returns False if any
+        of them fail"""
+
+        bk_result = [
+            '%s Backup Failed' % label
+            for label, future in self.futures if not future.result()]
+        # old revisions are pruned without holding up the action
+        RetentionEngine.schedule(self.app)
+        # if any backup fails, logs error and returns False
+        if bk_result:
+            error = '\n'.join(bk_result)
+            L.warning('%s', error)
+            return False
+        return True
+
+
 class RevisionActions(object):
     """This class contains the methods for generating
     and restoring revisions"""
@@ -315,53 +456,341 @@ class RevisionActions(object):
         self.plugins = PluginActions(app, self)
         self.temp_dir = self.app.settings.app['temp_dir'].name
         L.debug('temp_dir: %s', self.temp_dir)
+        # the JobQueue of the bulk operations of each view, see run_queue
+        self.queues = {}
+        # operations add their steps one at a time
+        self.build_lock = Lock()
+        self.options_lock = Lock()
+        # the bk_options of the latest revision of each install_dir
+        self.last_options = {}
+        # paging and filters of the RevertChanges view
+        self.revision_filter = {'type': None, 'text': '', 'offset': 0}
+        # database exports and file snapshots of auto_bk run here
+        self.backup_pool = ThreadPoolExecutor(
+            max_workers=max(2, int(getattr(
+                self.app.settings, 'revisions', {}).get(
+                    'backup_workers', 4))),
+            thread_name_prefix='backup')
 
     def auto_bk(self, theme_src=None, theme_dest=None,
                 plugin_src=None, plugin_dest=None,
-                backup_db=False, backup_themes=False, backup_plugins=False):
+                backup_db=False, backup_themes=False, backup_plugins=False,
+                progress=None):
         """Automatically backups database, themes, and / or plugins
-        to allow for reverting changes. Returns False if any of the backups
+        to allow for reverting changes. The backups run concurrently,
+        see start_backup. Returns False if any of the backups
         fail."""
 
-        L.debug('Plugin_src: %s, Plugin_dest: %s', plugin_src, plugin_dest)
-        bk_result = []
+        return self.start_backup(
+            theme_src=theme_src, theme_dest=theme_dest,
+            plugin_src=plugin_src, plugin_dest=plugin_dest,
+            backup_db=backup_db, backup_themes=backup_themes,
+            backup_plugins=backup_plugins, progress=progress).wait()
+
+    def backup_options(self, previous=None, install_path=None):
+        """Returns the bk_options of a new revision of the installation
+        at install_path, by default the active one. Revisions are named
+        by the time to the second, so when given the bk_options of the
+        previous revision, waits until the time differs from it"""
+
         bk_options = {}
-        # Generates the date-time portion of reversion names.
-        bk_options['copy_time'] = (
-            datetime.datetime.now().strftime(
-                self.app.settings.datetime['date_string']))
+        while True:
+            # Generates the date-time portion of reversion names.
+            bk_options['copy_time'] = (
+                datetime.datetime.now().strftime(
+                    self.app.settings.datetime['date_string']))
+            if not previous or \
+                    bk_options['copy_time'] != previous['copy_time']:
+                break
+            time.sleep(0.1)
         bk_options['temp_dir'] = self.temp_dir
+        bk_options['install_path'] = install_path or \
+            self.app.state.active_installation['directory']
         # install_dir is the name of the wp doc_root without
         # the full path
         bk_options['install_dir'] = os.path.split(
-            self.app.state.active_installation['directory'])[1]
+            bk_options['install_path'])[1]
+        return bk_options
+
+    def start_backup(self, theme_src=None, theme_dest=None,
+                     plugin_src=None, plugin_dest=None,
+                     backup_db=False, backup_themes=False,
+                     backup_plugins=False, progress=None, bk_options=None):
+        """Starts the backups auto_bk makes on the backup pool, so the
+        database export and the file snapshots run at the same time.
+        progress, if given, is called with a line of text as each backup
+        starts and finishes. Backups given the same bk_options form one
+        revision. Returns a BackupJob"""
+
+        L.debug('Plugin_src: %s, Plugin_dest: %s', plugin_src, plugin_dest)
+        if not bk_options:
+            bk_options = self.backup_options()
+        catalog = RevisionCatalog.for_install(
+            self.temp_dir, bk_options['install_dir'])
+        tasks = []
         # call to database backup function
         if backup_db:
-            if not self.bkdb(self.app, bk_options):
-                bk_result.append('Database Backup Failed')
+            tasks.append((
+                'databases', None, 'Database',
+                lambda: self.bkdb(self.app, bk_options)))
         # call to file backup function for themes
         if backup_themes:
-            if not self.copy_dir(
-                    bk_options, theme_src, theme_dest):
-                bk_result.append('Theme Backup Failed')
+            tasks.append((
+                'themes', theme_dest.split('/', 1)[-1], 'Theme',
+                lambda: self.copy_dir(bk_options, theme_src, theme_dest)))
         # Call to file backup function for plugins
         if backup_plugins:
-            if not self.copy_dir(
-                    bk_options, plugin_src, plugin_dest):
-                bk_result.append('Plugin Backup Failed')
-        # if any backup fails, logs error and returns False
-        if bk_result:
-            error = '\n'.join(bk_result)
-            L.warning('%s', error)
-            return False
-        return True
+            tasks.append((
+                'plugins', plugin_dest.split('/', 1)[-1], 'Plugin',
+                lambda: self.copy_dir(
+                    bk_options, plugin_src, plugin_dest)))
+        futures = []
+        for revision_type, name, label, backup in tasks:
+            futures.append((label, self.backup_pool.submit(
+                self.run_backup, catalog, bk_options, revision_type, name,
+                label, backup, progress)))
+        return BackupJob(self.app, futures)
+
+    def run_backup(self, catalog, bk_options, revision_type, name, label,
+                   backup, progress):
+        """Runs one backup on the backup pool and catalogs it.
+        Returns what backup returned"""
+
+        if progress:
+            progress('%s backup started' % label)
+        start = time.time()
+        result = backup()
+        if revision_type == 'databases':
+            # bkdb looks the name up if it is not known yet
+            name = bk_options.get('db_name')
+        self.catalog_revision(
+            catalog, bk_options, revision_type, name, result)
+        if progress:
+            if not result:
+                progress('%s backup failed' % label)
+            elif isinstance(result, dict):
+                progress('%s backup done: %s files, %s new (%s) in %.1fs' % (
+                    label, result['files'], result['new_files'],
+                    human_size(result['new_bytes']), time.time() - start))
+            else:
+                progress('%s backup done: %s in %.1fs' % (
+                    label, human_size(revision_size(result)[0]),
+                    time.time() - start))
+        return result
+
+    def pipe_progress(self, message):
+        """Writes a progress line to app.wpcli_pipe, for backups started
+        from a wp-cli thread"""
+
+        try:
+            os.write(self.app.wpcli_pipe, str.encode(message + '\n'))
+        except OSError:
+            L.warning('wpcli_pipe not opened')
+
+    def next_backup_options(self, install_path=None):
+        """Returns the bk_options of a new revision of the installation
+        at install_path, by default the active one, distinct from every
+        revision of it made before through this method. Queued backups
+        start together, and revisions are named by the second"""
+
+        if not install_path:
+            install_path = self.app.state.active_installation['directory']
+        # revisions are stored by install_dir, which installations in
+        # different home directories can share
+        install_dir = os.path.split(install_path)[1]
+        with self.options_lock:
+            bk_options = self.backup_options(
+                self.last_options.get(install_dir), install_path)
+            self.last_options[install_dir] = bk_options
+            return bk_options
+
+    def run_queue(self, view_name, build):
+        """Shows the JobQueue of the view_name view, and calls
+        build(queue) in a new thread to add the steps of a bulk operation
+        to it, then starts it. Operations started while a queue runs are
+        added to it. A queue that has finished or been cancelled is
+        replaced by a new one"""
+
+        queue = self.queues.get(view_name)
+        body = getattr(self.app.views, view_name).body
+        # held until build has added every step, so it can't finish first
+        if queue is None or not queue.hold():
+            queue = JobQueue(
+                getattr(self.app.settings, 'jobs', {}).get('queue_limits'))
+            queue.hold()
+            queue.progress_fd = self.app.loop.watch_pipe(
+                lambda data, queue=queue: body.update_queue(queue))
+            self.queues[view_name] = queue
+            body.show_queue(queue, body.after_response)
+        Thread(target=self.build_queue, name='queue_thread',
+               args=[queue, build]).start()
+
+    def build_queue(self, queue, build):
+        """Adds the steps of an operation to queue, and starts it"""
+
+        try:
+            with self.build_lock:
+                build(queue)
+        finally:
+            queue.start()
+            queue.release()
+
+    def update_items(self, wpcli):
+        """Returns (name, package url) of the themes or plugins with an
+        update available. The url is None when the update cache is off,
+        and wp-cli downloads the update itself"""
+
+        if UpdateCache.for_app(self.app) is None:
+            return [(name, None) for name in wpcli.get_update_names()]
+        return [(item['name'], item.get('update_package') or None)
+                for item in wpcli.get_listing() or []
+                if item.get('update') == 'available']
+
+    def queue_update_steps(self, queue, kind, wpcli, source):
+        """Adds the steps of updating every theme or plugin with an
+        update available to queue. wpcli is the Themes or Plugins
+        instance, and source(name) returns the path to back up. The
+        database is backed up once, and each item as a revision of its
+        own. Backups and downloads run in parallel; each update waits for
+        its backup and download, and for the database backup"""
+
+        items = self.update_items(wpcli)
+        if not items:
+            queue.add('no-updates:' + kind,
+                      'No %s updates available' % kind, lambda: '')
+            return
+        install_path = self.app.state.active_installation['directory']
+        download_dir = os.path.join(self.temp_dir, '.downloads')
+        timeout = getattr(self.app.settings, 'updates', {}).get(
+            'timeout', 30)
+        downloads = {}
+        # steps still to run from an earlier operation are not repeated,
+        # but those that have finished, or failed, run again
+        if not queue.active('backup:database'):
+            queue.add('backup:database', 'Back up database',
+                      self.backup_job, 'backup')
+        for name, package in items:
+            step = '%s:%s' % (kind, name)
+            if queue.active('update:' + step):
+                continue
+            after = ['backup:database', 'backup:' + step]
+            queue.add(
+                'backup:' + step, 'Back up %s %s' % (kind, name),
+                lambda name=name: self.backup_job(kind, name, source(name)),
+                'backup')
+            if package:
+                after.append('download:' + step)
+                queue.add(
+                    'download:' + step, 'Download %s %s' % (kind, name),
+                    lambda name=name, package=package: self.download_job(
+                        queue, downloads, name, package, download_dir,
+                        timeout),
+                    'download')
+            queue.add(
+                'update:' + step, 'Update %s %s' % (kind, name),
+                lambda name=name: self.update_job(
+                    wpcli, name, install_path, downloads.pop(name, None)),
+                'wpcli', after)
+
+    def backup_job(self, kind=None, name=None, src=None, install_path=None,
+                   backup_db=None):
+        """Backs up the database, or the theme or plugin name at src, as
+        a revision of its own. With backup_db, the database is backed up
+        in the same revision as the theme or plugin. install_path
+        defaults to the active installation. A JobQueue task"""
+
+        dest = '%ss/%s' % (kind, name) if kind else None
+        if backup_db is None:
+            backup_db = kind is None
+        if not self.start_backup(
+                theme_src=src, theme_dest=dest,
+                plugin_src=src, plugin_dest=dest,
+                backup_db=backup_db,
+                backup_themes=kind == 'theme',
+                backup_plugins=kind == 'plugin',
+                bk_options=self.next_backup_options(install_path)).wait():
+            raise TaskFailed('Backup failed')
+        return 'Backed up'
+
+    @staticmethod
+    def download_job(queue, downloads, name, package, directory, timeout):
+        """Downloads the update package of name into directory. A
+        JobQueue task, stopped when the queue is cancelled"""
+
+        os.makedirs(directory, exist_ok=True)
+        try:
+            path = download(
+                package, directory, timeout,
+                cancelled=lambda: queue.cancelled)
+        except (URLError, OSError, ValueError) as error:
+            raise TaskFailed('Download failed: %s' % error)
+        downloads[name] = path
+        return human_size(os.path.getsize(path))
+
+    @staticmethod
+    def update_job(wpcli, name, install_path, package):
+        """Updates a theme or plugin, from package if it was downloaded.
+        A JobQueue task"""
+
+        try:
+            result, error, status = wpcli.update_job(
+                name, install_path, package)
+        finally:
+            if package and os.path.exists(package):
+                os.remove(package)
+        lines = [line for line in (result + '\n' + error).splitlines()
+                 if line.strip()]
+        if status != DONE:
+            raise TaskFailed(lines[-1] if lines else status)
+        return lines[-1] if lines else 'Updated'
+
+    @staticmethod
+    def catalog_revision(catalog, bk_options, revision_type, name, result):
+        """Appends a backup to the revision catalog. result is the dump
+        path from bkdb, the stats from copy_dir, or False if the backup
+        failed"""
+        entry = {
+            'type': revision_type,
+            'name': name or '',
+            'timestamp': bk_options['copy_time'],
+            'created': time.time(),
+            'status': 'ok' if result else 'failed',
+            'size': 0,
+            'stored': 0,
+            'files': 0
+        }
+        if isinstance(result, dict):
+            entry['path'] = os.path.basename(result['path'])
+            entry['size'] = result['bytes']
+            entry['stored'] = result['new_bytes']
+            entry['files'] = result['files']
+        elif result:
+            entry['path'] = os.path.basename(result)
+            entry['size'], entry['files'] = revision_size(result)
+            entry['stored'] = entry['size']
+        else:
+            entry['path'] = '%s-%s.failed' % (
+                name, bk_options['copy_time'])
+        try:
+            catalog.append(entry)
+        except (OSError, IOError) as error:
+            L.warning('Could not catalog revision: %s', error)
 
     @staticmethod
     def bkdb(app, bk_options):
         """exports database to temp dir
-        Returns true if successful, False if it fails"""
-
-        db_name = app.state.active_installation['db_name']
+        Returns the path written if successful, False if it fails"""
+
+        install_path = bk_options['install_path']
+        active = app.state.active_installation or {}
+        # the name is kept for the active installation only
+        db_name = active.get('db_name') \
+            if active.get('directory') == install_path else None
+        if not db_name:
+            db_name = WpConfig.get_db_name(app, install_path)
+            if active.get('directory') == install_path:
+                active['db_name'] = db_name
+        bk_options['db_name'] = db_name
         dest = db_name + '-' + bk_options['copy_time'] + '.sql'
         # bkdb_dir is the path where the database revisions are stored
         bkdb_dir = os.path.join(
@@ -371,17 +800,30 @@ class RevisionActions(object):
             os.makedirs(bkdb_dir)
         # absolute filepath of the db to be exported by wp db export
         bkdb_path = os.path.join(bkdb_dir, dest)
-        if DatabaseInformation.export_db(app, file_path=bkdb_path):
-            return True
-        else:
-            return False
+        settings = getattr(app.settings, 'database', {})
+        # only tables changed since the last revision are dumped when
+        # the database can be queried directly
+        if settings.get('incremental_backups', False):
+            client = DbConnections.get(app, install_path)
+            if client:
+                export = IncrementalDump(
+                    client, install_path, bkdb_path, settings).run()
+                if export:
+                    return export
+        # large databases can be dumped table by table in parallel
+        parallel = settings.get('parallel_backups', False)
+        return DatabaseInformation.export_db(
+            app, file_path=bkdb_path, parallel=parallel,
+            install_path=install_path)
 
     @staticmethod
     def copy_dir(bk_options, src, dest):
-        """Copies theme or plugin directory to temp_dir
-        Returns true if successful, False if it fails"""
+        """Stores theme or plugin directory in the object store under
+        temp_dir, writing the revision as a manifest
+        Returns the snapshot stats, with the manifest's 'path', if
+        successful, False if it fails"""
 
-        dest = dest + '-' + bk_options['copy_time']
+        dest = dest + '-' + bk_options['copy_time'] + MANIFEST_EXTENSION
         install_temp_dir = os.path.join(
             bk_options['temp_dir'], bk_options['install_dir'])
         destination = os.path.join(install_temp_dir, dest)
@@ -392,55 +834,71 @@ class RevisionActions(object):
                 L.warning('Error making temp_dir: %s', error)
                 return False
         try:
-            shutil.copytree(src, destination)
-        except (shutil.Error, OSError, IOError) as error:
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            stats = ObjectStore.get(bk_options['temp_dir']).snapshot(
+                src, destination)
+        except (OSError, IOError) as error:
             L.warning('Error backing up to temp_dir: %s', error)
             return False
-        L.debug("%s copied to %s", src, destination)
-        return True
+        L.debug("%s stored as %s", src, destination)
+        stats['path'] = destination
+        return stats
 
     def get_revisions(self, *args):
-        """Obtains list of available revisions"""
+        """Obtains a page of revisions from the revision catalog,
+        filtered as set in self.revision_filter"""
+        L.debug('Args: %s', args)
         # install_dir is the document root of the WP install
         # without the full path
-        L.debug('Args: %s', args)
         install_dir = os.path.split(
             self.app.state.active_installation['directory'])[1]
-        # dict for the directories the revisions can be found
-        revision_dirs = {
-            'themes': os.path.join(
-                self.temp_dir, install_dir,
-                'themes'),
-            'databases': os.path.join(
-                self.temp_dir, install_dir,
-                'databases'),
-            'plugins': os.path.join(
-                self.temp_dir, install_dir,
-                'plugins')
-        }
-        revisions = {}
-        for revision_type, revision_dir in revision_dirs.items():
-            if os.path.isdir(revision_dir):
-                available_revisions = os.listdir(revision_dir)
-                for revision in available_revisions:
-                    split_rev = revision.split('-')
-                    L.debug('split_rev: %s', split_rev)
-                    if '.sql' in split_rev[1]:
-                        split_sql = split_rev[1].split('.')
-                        revision_time = split_sql[0]
-                    else:
-                        revision_time = split_rev[1]
-                    if revision_time in revisions.keys():
-                        revisions[revision_time][revision_type] = split_rev[0]
-                    else:
-                        revisions[revision_time] = {}
-                        revisions[revision_time][revision_type] = split_rev[0]
-        L.debug('Available Revisions: %s', revisions)
-        self.app.views.RevertChanges.body.after_action(
-            revisions)
+        catalog = RevisionCatalog.for_install(self.temp_dir, install_dir)
+        page_size = getattr(self.app.settings, 'revisions', {}).get(
+            'page_size', 20)
+        page, total = catalog.query(
+            revision_type=self.revision_filter['type'],
+            text=self.revision_filter['text'],
+            offset=self.revision_filter['offset'],
+            limit=page_size)
+        revisions = OrderedDict(page)
+        L.debug('Available Revisions: %s of %s', len(revisions), total)
+        paging = dict(self.revision_filter, total=total, limit=page_size,
+                      retention=RetentionEngine.last_report)
+        self.app.views.RevertChanges.body.after_action(revisions, paging)
+
+    def filter_revisions(self, button, revision_type=None):
+        """Shows only revisions including revision_type, or all
+        revisions if it is None"""
+        L.debug('Button: %s, Type: %s', button, revision_type)
+        self.revision_filter['type'] = revision_type
+        self.revision_filter['offset'] = 0
+        self.get_revisions()
+
+    def search_revisions(self, edit, text):
+        """Shows only revisions of themes, plugins or databases
+        whose name contains text"""
+        L.debug('Edit: %s, Text: %s', edit, text)
+        self.revision_filter['text'] = text.strip()
+        self.revision_filter['offset'] = 0
+        self.get_revisions()
+
+    def page_revisions(self, button, step):
+        """Moves step pages forward, or back if negative"""
+        L.debug('Button: %s, Step: %s', button, step)
+        page_size = getattr(self.app.settings, 'revisions', {}).get(
+            'page_size', 20)
+        self.revision_filter['offset'] = max(
+            0, self.revision_filter['offset'] + step * page_size)
+        self.get_revisions()
 
     def restore_revision(self, button, user_data):
-        """Restores revisions"""
+        """Restores revisions. What is about to be replaced is kept as a
+        new revision first. Meanwhile theme and plugin revisions are
+        recreated beside their destinations, to be swapped in with
+        renames once that backup is done, so the site never sees a
+        missing or partial directory. The database import runs at the
+        same time as the swaps"""
 
         L.debug(
             'Button: %s, Revisions: %s, Revision to Restore: %s',
@@ -449,50 +907,97 @@ class RevisionActions(object):
         revision_time = user_data[1]
         install_dir = os.path.split(
             self.app.state.active_installation['directory'])[1]
-        theme_root = self.themes.wpcli.get_theme_root()
-        plugin_root = self.plugins.wpcli.get_plugin_path()
+        roots = {
+            'themes': (self.themes.wpcli.get_theme_root() or '').rstrip(),
+            'plugins': self.plugins.wpcli.get_plugin_path() or ''
+        }
         results = {
             'revision': revision_time,
             'themes': 'N/A',
             'plugins': 'N/A',
             'databases': 'N/A',
         }
-        for revision_type, revision_name in revisions[revision_time].items():
+        catalog = RevisionCatalog.for_install(self.temp_dir, install_dir)
+        db_path = None
+        destinations = {}
+        for revision_type, entry in revisions[revision_time].items():
+            catalog.touch(entry['id'])
+            revision_path = os.path.join(
+                self.temp_dir, install_dir, revision_type, entry['path'])
             if 'database' in revision_type:
-                revision_dirname = revision_name + '-' + \
-                    revision_time + '.sql'
-                revision_path = os.path.join(
-                    self.temp_dir, install_dir, 'databases', revision_dirname)
-                result = DatabaseInformation.import_db(self.app, revision_path)
-                if result:
-                    results['databases'] = 'Successful'
-                else:
-                    results['databases'] = 'Failed'
+                db_path = revision_path
             else:
-                revision_dirname = revision_name + '-' + \
-                    revision_time
-                revision_path = os.path.join(
-                    self.temp_dir,
-                    install_dir,
-                    revision_type,
-                    revision_dirname)
-                if 'theme' in revision_type:
-                    destination_dir = os.path.join(
-                        theme_root, revision_name)
-                if 'plugin' in revision_type:
-                    destination_dir = os.path.join(
-                        plugin_root, revision_name)
-                if os.path.isdir(destination_dir):
-                    shutil.rmtree(destination_dir)
-                try:
-                    shutil.move(revision_path, destination_dir)
-                except shutil.Error as error:
-                    L.warning('Error restoring revision: %s', error)
-                    results[revision_type] = "Failed"
-                else:
-                    results[revision_type] = "Successful"
-            L.debug('Restore Results: %s', results)
-            self.app.views.RevertChanges.body.after_revert(results)
+                destinations[revision_type] = (
+                    entry['name'], revision_path, self.restore_destination(
+                        roots[revision_type], entry['name']))
+        # keep what is being replaced, while the revisions are staged
+        theme_name, _path, theme_dir = destinations.get(
+            'themes', (None, None, None))
+        plugin_name, _path, plugin_dir = destinations.get(
+            'plugins', (None, None, None))
+        job = self.start_backup(
+            theme_src=theme_dir, theme_dest=('themes/%s' % theme_name),
+            plugin_src=plugin_dir, plugin_dest=('plugins/%s' % plugin_name),
+            backup_db=bool(db_path),
+            backup_themes=bool(theme_dir and os.path.isdir(theme_dir)),
+            backup_plugins=bool(plugin_dir and os.path.isdir(plugin_dir)))
+        staged = dict(
+            (revision_type, self.backup_pool.submit(
+                self.stage_revision, revision_path, destination_dir))
+            for revision_type, (_name, revision_path, destination_dir)
+            in destinations.items())
+        if not job.wait():
+            L.warning('Could not keep a revision of %s before restoring '
+                      '%s', install_dir, revision_time)
+        if db_path:
+            imported = self.backup_pool.submit(
+                DatabaseInformation.import_db, self.app, db_path)
+        for revision_type, staging in staged.items():
+            destination_dir = destinations[revision_type][2]
+            try:
+                replaced = replace_tree(staging.result(), destination_dir)
+            except (shutil.Error, OSError, IOError) as error:
+                L.warning('Error restoring revision: %s', error)
+                results[revision_type] = "Failed"
+            else:
+                results[revision_type] = "Successful"
+                if replaced:
+                    self.backup_pool.submit(shutil.rmtree, replaced, True)
+        if db_path:
+            if imported.result():
+                results['databases'] = 'Successful'
+            else:
+                results['databases'] = 'Failed'
+        self.themes.wpcli.invalidate_list()
+        self.plugins.wpcli.invalidate_list()
+        L.debug('Restore Results: %s', results)
+        self.app.views.RevertChanges.body.after_revert(results)
+
+    @staticmethod
+    def restore_destination(root, revision_name):
+        """Returns the directory a theme or plugin revision restores to.
+        Revisions of all themes or plugins restore the whole root"""
+
+        if revision_name in ('all_themes', 'all_plugins'):
+            return root
+        return os.path.join(root, revision_name)
+
+    def stage_revision(self, revision_path, destination_dir):
+        """Recreates a theme or plugin revision in a hidden directory
+        beside destination_dir, on the same filesystem, so it can be
+        renamed into place. Returns the staging directory"""
+
+        parent, name = os.path.split(os.path.normpath(destination_dir))
+        staging = os.path.join(parent, '.%s.restore' % name)
+        if os.path.lexists(staging):
+            # left behind by an interrupted restore
+            shutil.rmtree(staging)
+        if revision_path.endswith(MANIFEST_EXTENSION):
+            ObjectStore.get(self.temp_dir).materialize(
+                revision_path, staging)
+        else:
+            shutil.copytree(revision_path, staging, symlinks=True)
+        return staging
 
 
 class ThemeActions(object):
@@ -530,80 +1035,197 @@ class ThemeActions(object):
     def activate(self, button, theme):
         """activate theme"""
 
+        self.wpcli.invalidate_list()
         self.wpcli.activate(theme['name'])
         self.app.views.Themes.body.show_theme_action_response()
 
-    def update(self, button, theme):
-        """Updates theme"""
+    def backup(self, theme_name):
+        """Backs up a theme and the database ahead of a change to the
+        theme. Runs in the wp-cli thread, and reports progress in the
+        response area"""
 
-        theme_dir = self.wpcli.get_details(theme['name'])['template_dir']
+        theme_dir = self.wpcli.get_details(theme_name)['template_dir']
         if not self.revisions.auto_bk(
                 theme_src=theme_dir,
-                theme_dest=('themes/' + theme['name']),
+                theme_dest=('themes/' + theme_name),
                 backup_themes=True,
-                backup_db=True):
+                backup_db=True,
+                progress=self.revisions.pipe_progress):
             self.app.views.Themes.backup_failed = True
-        self.app.views.Themes.body.show_theme_action_response()
-        self.wpcli.update(theme['name'])
-        L.debug('wpcli_pipe fstat: %s', os.fstat(self.app.wpcli_pipe))
 
-    def update_all(self, button):
-        """Updates All Themes"""
-        theme_dir = self.wpcli.get_theme_root()
-        if not self.revisions.auto_bk(
-                theme_src=theme_dir,
-                theme_dest=('themes/' + 'all_themes'),
-                backup_themes=True,
-                backup_db=True):
-            self.app.views.Themes.backup_failed = True
+    def update(self, button, theme):
+        """Updates theme, once it has been backed up"""
+
+        self.wpcli.invalidate_list()
         self.app.views.Themes.body.show_theme_action_response()
-        self.wpcli.update('--all')
+        self.wpcli.update(
+            theme['name'],
+            before=lambda: self.backup(theme['name']))
         L.debug('wpcli_pipe fstat: %s', os.fstat(self.app.wpcli_pipe))
 
+    def update_all(self, *args):
+        """Queues the update of every theme with an update available"""
+
+        self.wpcli.invalidate_list()
+        self.revisions.run_queue('Themes', self.queue_updates)
+
+    def queue_updates(self, queue):
+        """Adds the backup, download and update steps of each theme
+        with an update available to queue"""
+
+        theme_root = (self.wpcli.get_theme_root() or '').rstrip()
+        self.revisions.queue_update_steps(
+            queue, 'theme', self.wpcli,
+            lambda name: os.path.join(theme_root, name))
+
     def uninstall(self, button, theme):
-        """Uninstalls theme"""
+        """Uninstalls theme, once it has been backed up"""
 
-        theme_dir = self.wpcli.get_details(theme['name'])['template_dir']
-        if self.revisions.auto_bk(
-                theme_src=theme_dir,
-                theme_dest=('themes/' + theme['name']),
-                backup_themes=True,
-                backup_db=True):
-            self.app.views.Themes.backup_failed = True
+        self.wpcli.invalidate_list()
         self.app.views.Themes.body.show_theme_action_response()
-        self.wpcli.uninstall(theme['name'])
+        self.wpcli.uninstall(
+            theme['name'],
+            before=lambda: self.backup(theme['name']))
         L.debug('wpcli_pipe fstat: %s', os.fstat(self.app.wpcli_pipe))
 
     def install_theme(self, edit_widget, edit_text):
         """Install a theme from wordpress.org repo"""
 
+        self.wpcli.invalidate_list()
         L.debug("edit_widget: %s, edit_text: %s", edit_widget, edit_text)
         self.app.views.Themes.body.show_theme_action_response()
         self.wpcli.install(edit_text)
         L.debug('wpcli_pipe fstat: %s', os.fstat(self.app.wpcli_pipe))
 
 
+class FleetActions(object):
+    """Actions run on every installation marked for the fleet"""
+
+    def __init__(self, app, revisions):
+        self.app = app
+        self.revisions = revisions
+        self.queue = None
+        self.runs = 0
+
+    def run(self, operation_name, values):
+        """Queues the operation operation_name, with the values of its
+        fields, on every installation marked for the fleet. Operations
+        started while others run join their queue, so the installation
+        limit holds across them. Each change waits for the backup of its
+        installation, in the same group, and is skipped if the backup
+        fails. Returns a message saying why the operation can not run,
+        or None"""
+
+        if not self.app.state.fleet:
+            return 'No installations are marked for the fleet'
+        try:
+            operation = FleetOperation(self.app, operation_name, values)
+        except ValueError as error:
+            return str(error)
+        self.runs += 1
+        # held until every step is added, so a backup that finishes
+        # first can't close the queue before its change is added
+        if self.queue is None or not self.queue.hold():
+            self.queue = self.new_queue()
+            self.queue.hold()
+        try:
+            for install_path in list(self.app.state.fleet):
+                step = '%s:%s' % (self.runs, install_path)
+                after = []
+                if operation.backup:
+                    after.append('backup:' + step)
+                    self.queue.add(
+                        'backup:' + step, 'Back up before: %s' % (
+                            operation.describe()),
+                        lambda install_path=install_path: self.backup_job(
+                            operation, install_path),
+                        'backup', (), install_path)
+                self.queue.add(
+                    step, operation.describe(),
+                    lambda install_path=install_path: operation.run(
+                        install_path),
+                    operation.resource, after, install_path)
+        finally:
+            self.queue.start()
+            self.queue.release()
+        L.debug('Fleet run %s: %s', self.runs, operation.describe())
+        return None
+
+    def backup_job(self, operation, install_path):
+        """Backs up the database of install_path, with the plugins or
+        themes operation changes, as one revision of that installation.
+        A JobQueue task"""
+
+        kind, name, src = operation.backup_source(install_path)
+        return self.revisions.backup_job(
+            kind, name, src, install_path=install_path, backup_db=True)
+
+    def new_queue(self):
+        """Returns a JobQueue with the fleet limits of settings.json"""
+
+        settings = getattr(self.app.settings, 'fleet', {})
+        queue = JobQueue(
+            settings.get('limits'),
+            group_limit=settings.get('installation_limit', 1))
+        queue.progress_fd = self.app.loop.watch_pipe(
+            lambda data: self.show_progress(queue))
+        return queue
+
+    def show_progress(self, queue):
+        """Redraws the Fleet view's results, if it is showing, as the
+        queue's tasks change. Returns False once queue has finished,
+        which removes the watch"""
+
+        if self.app.state.active_view_name == 'Fleet':
+            self.app.views.Fleet.body.show_results()
+        return not queue.closed
+
+
 class WpConfigActions(object):
     """Actions related to WpConfig"""
 
     def __init__(self, app):
         self.app = app
         self.wpcli = WpConfig(self.app)
+        self.rescan = False
+        self.pending_changes = OrderedDict()
 
     def get_installations(self):
         """searches user's homedir for wp installations
         and calls wp-cli command to get general installation
-        information
+        information. When the installation index is used, the list is
+        shown straight away and stale entries are re-probed afterwards
         """
         L.debug("get_installations Action Started")
-        installations = Installations(self.app)
-        self.app.views.Installs.body.after_action(
-            installations.installations)
+        body = self.app.views.Installs.body
+        if self.app.settings.app.get('stream_installs', True):
+            installations = Installations(
+                self.app, rescan=self.rescan, listener=body)
+            self.rescan = False
+            if installations.from_index:
+                installations.revalidate()
+            body.finish_stream()
+            return
+        self.app.loop.remove_watch_pipe(body.stream_pipe)
+        installations = Installations(self.app, rescan=self.rescan)
+        self.rescan = False
+        body.after_action(installations.installations)
+        if installations.from_index and installations.revalidate():
+            if self.app.state.active_view_name == 'Installs':
+                body.after_action(installations.installations)
+
+    def rescan_installations(self, *args):
+        """Discards the installation index, and scans the homedir
+        for installations again"""
+        L.debug("rescan_installations Args: %s", args)
+        self.rescan = True
+        self.app.views.activate(self, {"view": "Installs"})
 
     def get_wp_config(self):
         """Obtains wp_config information
         """
         L.debug("get_wp_config Action Started")
+        self.pending_changes = OrderedDict()
         self.wpcli.get_wp_config()
         L.debug('wp_config: %s', self.wpcli)
         self.app.views.GetWpConfig.body.after_action(self.wpcli)
@@ -627,6 +1249,37 @@ class WpConfigActions(object):
         else:
             edit_map.set_attr_map({None: 'alert'})
 
+    def queue_wp_config(self, options):
+        """Queues a wp_config directive change from the wp_config display
+        screen edit widgets. Queued changes are highlighted until
+        save_wp_config writes them"""
+        directive_name = options['user_data']['directive_name']
+        if options['user_data']['remove']:
+            directive_value = None
+        else:
+            directive_value = options['edit_text']
+        self.pending_changes[directive_name] = (
+            directive_value, options['attr_map'])
+        options['attr_map'].set_attr_map({None: 'highlight'})
+        L.debug("Queued wp_config change: %s = %s",
+                directive_name, directive_value)
+
+    def save_wp_config(self, *args):
+        """Writes all queued wp_config changes in one pass, and marks
+        each edit widget with its directive's result"""
+        L.debug("save_wp_config Args: %s", args)
+        if not self.pending_changes:
+            return
+        pending, self.pending_changes = self.pending_changes, OrderedDict()
+        results = self.wpcli.apply_wp_config([
+            (directive_name, change[0])
+            for directive_name, change in pending.items()])
+        for directive_name, change in pending.items():
+            if results.get(directive_name):
+                change[1].set_attr_map({None: 'body'})
+            else:
+                change[1].set_attr_map({None: 'alert'})
+
     def re_salt(self, *args):
         """Refreshes the salts defined in the wp-config.php"""
         L.debug("re_salt Args: %s", args)
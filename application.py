@@ -4,11 +4,17 @@ the overall flow and state of the application
 Raises:
     U.ExitMainLoop: Exits the application
 """
+from collections import OrderedDict
 import urwid as U
 from logmod import Log
 from widgets import CustomWidgets
 from menus import Menus
 from views import Views
+from wpcli import Call
+from database import DbConnections
+from dbsearch import DbSearchEngine
+from jobs import Job
+from jobqueue import JobQueue
 
 L = Log()
 W = CustomWidgets()
@@ -21,6 +27,7 @@ class App(object):
     def __init__(self, settings):
         L.debug("App Class Initializing")
         self.settings = settings
+        Job.configure(getattr(settings, 'jobs', {}))
         self.frame = U.Frame(
             U.Filler(
                 W.get_text(
@@ -42,6 +49,12 @@ class App(object):
             U.ExitMainLoop: Exits the application
         """
         L.debug("Args: %s", args)
+        # no queued task may start once the workers are closed
+        JobQueue.cancel_all()
+        Call.close_workers()
+        Job.stop_all()
+        DbSearchEngine.cancel_all()
+        DbConnections.close_all()
         raise U.ExitMainLoop()
 
     def unhandled_input(self, key):
@@ -67,6 +80,15 @@ class App(object):
                 self.state.go_forward()
             if 'home' in key:
                 self.state.go_back()
+            if key == Job.settings.get('cancel_key', 'esc'):
+                body = getattr(self.state.active_view, 'body', None)
+                queue = body.shown_queue() if body else None
+                if queue and not queue.closed:
+                    queue.cancel()
+                    L.debug('Cancelled the %s queue',
+                            self.state.active_view_name)
+                if Job.cancel_interactive():
+                    L.debug('Cancelled running jobs')
 
 
 class State(object):
@@ -87,6 +109,8 @@ class State(object):
         self.view_chain = []
         self.view_chain_pos = -1
         self.active_installation = None
+        # installations marked in the Installs view for fleet operations
+        self.fleet = OrderedDict()
         self.db_exports = []
         self.homedir = ''
         self.sr_search_term = None
@@ -138,6 +162,20 @@ class State(object):
             sub_title)
         self.app.frame.contents.__setitem__('header', [_x, None])
 
+    def mark_for_fleet(self, check_box, marked, installation):
+        """Adds or removes an installation from the fleet
+
+        Arguments:
+            check_box {obj} -- the check box that was changed
+            marked {bool} -- whether the check box is now checked
+            installation {dict} -- the installation of the check box
+        """
+        L.debug("Check_box %s, Marked: %s", check_box, marked)
+        if marked:
+            self.fleet[installation['directory']] = installation
+        else:
+            self.fleet.pop(installation['directory'], None)
+
     def set_sr_search_term(self, value):
         """Sets DB SearchReplace search term"""
         self.sr_search_term = value
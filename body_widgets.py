@@ -1,15 +1,20 @@
 """Collection of classes each used for a view"""
+import os
+import json
 import datetime
 import time
 import getpass
-from html.parser import HTMLParser
 from collections import OrderedDict
+from threading import Lock, Thread
+from html.parser import HTMLParser
 import urwid as U
 from logmod import Log
 from settings import Settings
 from widgets import CustomWidgets, BoxButton, WpConfigValueMap
 from widgets import DbImportEditMap, DbSearchEditMap
 from widgets import SRSearchEditMap
+from fleet import OPERATIONS
+from database import human_size
 S = Settings()
 L = Log()
 W = CustomWidgets()
@@ -35,6 +40,9 @@ class BodyWidget(object):
         )
         self.pile = None
         self.progress = 0
+        # the JobQueue shown by show_queue
+        self.queue = None
+        self.queue_after = None
 
     def define_widget(self, initial_text, progress_bar=False):
         """Page displayed as Home Page for the application
@@ -73,6 +81,9 @@ class BodyWidget(object):
         """
         L.debug('Pipe: %s :: Progress: %s', self.app.action_pipe, progress)
         if progress:
+            # Several newline separated updates may arrive in one read,
+            # only the latest one matters
+            progress = progress.split()[-1]
             self.progress_bar.set_completion(int(float(progress)))
         else:
             self.progress_bar.set_completion(100)
@@ -82,6 +93,70 @@ class BodyWidget(object):
                 L.Warning('Error trying to remove watch_pipe')
             self.app.loop.draw_screen()
 
+    def show_queue(self, queue, after):
+        """Shows the steps of a JobQueue, with their status, and once the
+        queue has finished, a summary and a button calling after in a new
+        thread to return to the view"""
+        self.queue = queue
+        self.queue_after = after
+        self.render_queue()
+
+    def render_queue(self):
+        """Draws the rows of self.queue"""
+        queue_rows = [
+            W.get_col_row([
+                W.get_blank_flow(),
+                U.AttrMap(W.get_text('header', 'Step', 'center'), 'header'),
+                U.AttrMap(W.get_text('header', 'Status', 'center'), 'header'),
+                ('weight', 2, U.AttrMap(
+                    W.get_text('header', 'Detail', 'center'), 'header')),
+                U.AttrMap(W.get_text('header', 'Time', 'center'), 'header'),
+                W.get_blank_flow()
+            ]),
+            W.get_div()
+        ]
+        for label, status, message, seconds in self.queue.rows():
+            queue_rows.append(W.get_col_row([
+                W.get_blank_flow(),
+                W.get_text('default', label, 'left'),
+                W.get_text('default', status, 'center'),
+                ('weight', 2, W.get_text('default', message, 'left')),
+                W.get_text('default', '%.1fs' % seconds if seconds else '',
+                           'right'),
+                W.get_blank_flow()
+            ]))
+        if self.queue.closed:
+            queue_rows.extend([
+                W.get_div(),
+                W.get_col_row([
+                    W.get_blank_flow(),
+                    W.get_text('default', self.queue.summary(), 'center'),
+                    BoxButton(
+                        'Back',
+                        on_press=lambda *args: Thread(
+                            target=self.queue_after,
+                            name='action_thread').start()),
+                    W.get_blank_flow()
+                ])
+            ])
+        queue_list_box = W.get_list_box(queue_rows)[0]
+        self.app.frame.contents.__setitem__('body', [queue_list_box, None])
+
+    def shown_queue(self):
+        """Returns the JobQueue of the view, which the cancel key
+        cancels"""
+        return self.queue
+
+    def update_queue(self, queue):
+        """Redraws queue's rows from its progress pipe, unless another
+        view or queue is showing. Returning False once it has finished
+        removes the watch"""
+        active_view = self.app.state.active_view
+        if queue is self.queue and active_view and \
+                active_view.body is self:
+            self.render_queue()
+        return not queue.closed
+
 # ADD SUBCLASSES HERE for each view's body
 
 
@@ -113,6 +188,188 @@ class Installs(BodyWidget):
         super(Installs, self).__init__(
             app, initial_text, progress_bar=progress_bar)
         L.debug("user_args: %s, calling_view: %s", user_args, calling_view)
+        self.walker = None
+        self.rows = {}
+        self.pending = []
+        self.pending_lock = Lock()
+        self.wake_pending = False
+        self.stream_pipe = self.app.loop.watch_pipe(self.flush_rows)
+
+    def header_row(self, location_column):
+        """Returns the column header row of the installation list.
+        location_column is the width spec of the Location column, e.g.
+        (40,) or ('weight', 3)"""
+        return W.get_col_row([
+            W.get_blank_flow(),
+            (10, U.AttrMap(W.get_div(), 'header')),
+            (7, U.AttrMap(W.get_text('header', 'Fleet', 'center'), 'header')),
+            tuple(location_column) + (
+                U.AttrMap(
+                    W.get_text(
+                        'header',
+                        'Location',
+                        'center'
+                    ),
+                    'header'),),
+            ('weight', 2, U.AttrMap(
+                W.get_text(
+                    'header',
+                    'Home URL',
+                    'center'
+                ),
+                'header')),
+            (18, U.AttrMap(
+                W.get_text(
+                    'header',
+                    'Valid wp_options',
+                    'center'
+                ),
+                'header')),
+            (20, U.AttrMap(
+                W.get_text(
+                    'header',
+                    'wp_db_check passed',
+                    'center'
+                ),
+                'header')),
+            W.get_blank_flow()
+        ])
+
+    def rescan_row(self):
+        """Returns the row holding the Rescan and Fleet buttons"""
+        return W.get_col_row([
+            W.get_blank_flow(),
+            BoxButton(
+                'Rescan',
+                on_press=self.app.views.actions.wp_config.
+                rescan_installations),
+            BoxButton(
+                'Fleet',
+                on_press=self.app.views.activate,
+                user_data={'view': 'Fleet'}),
+            W.get_blank_flow()
+        ])
+
+    def fleet_box(self, installation):
+        """Returns the check box marking installation for the fleet"""
+        return (7, U.CheckBox(
+            '',
+            state=installation['directory'] in self.app.state.fleet,
+            on_state_change=self.app.state.mark_for_fleet,
+            user_data=installation))
+
+    # Incremental mode. Installations calls add_installation,
+    # update_installation and remove_installation from its scan / probe
+    # threads. The events are queued, and flush_rows applies everything
+    # queued so far in the main loop, so a batch of rows costs one redraw.
+
+    def add_installation(self, installation):
+        """Queues a new row with placeholder cells"""
+        self.queue_event('add', installation)
+
+    def update_installation(self, installation):
+        """Queues filling in a row's cells with its probe results"""
+        self.queue_event('update', installation)
+
+    def remove_installation(self, installation):
+        """Queues removal of a row"""
+        self.queue_event('remove', installation)
+
+    def finish_stream(self):
+        """Queues the end of the list. No events are accepted after it"""
+        self.queue_event('done', None)
+
+    def queue_event(self, event, installation):
+        """Adds an event to the queue, and wakes the main loop unless
+        a wake up is already pending"""
+        with self.pending_lock:
+            self.pending.append((event, installation))
+            wake = not self.wake_pending
+            self.wake_pending = True
+        if wake:
+            try:
+                os.write(self.stream_pipe, b'.')
+            except OSError:
+                L.warning('Installs stream_pipe already closed')
+
+    def flush_rows(self, data):
+        """Applies every queued event. Called by the main loop through
+        stream_pipe. Returns False when the stream is done, which
+        removes the watch"""
+        L.debug('flush_rows data: %s', data)
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+            self.wake_pending = False
+        done = False
+        for event, installation in pending:
+            if not self.walker:
+                self.walker = W.get_list_box(
+                    [self.header_row(('weight', 3))])[1]
+                self.app.frame.contents.__setitem__(
+                    'body', [U.ListBox(self.walker), None])
+            if event == 'add':
+                self.walker.append(self.stream_row(installation))
+            elif event == 'update':
+                self.fill_row(installation)
+            elif event == 'remove':
+                row = self.rows.pop(installation['directory'], None)
+                if row:
+                    self.walker.remove(row[0])
+            elif event == 'done':
+                done = True
+        if done:
+            if not self.rows:
+                self.walker.append(W.get_text(
+                    'body',
+                    'There Are No WordPress Installations found for User: ' +
+                    getpass.getuser(),
+                    'center'))
+            self.walker.extend([W.get_div(), self.rescan_row()])
+            if self.app.state.active_view_name == 'Installs':
+                self.app.frame.set_focus('body')
+            os.close(self.stream_pipe)
+            return False
+        return True
+
+    def stream_row(self, installation):
+        """Returns a row for a newly found installation. The probe result
+        cells are placeholders until fill_row is called"""
+        cells = [
+            W.get_text('body', '...', 'center'),
+            W.get_text('body', '...', 'center'),
+            W.get_text('body', '...', 'center')
+        ]
+        row = W.get_col_row([
+            W.get_blank_flow(),
+            (10, BoxButton(
+                ' + ',
+                on_press=self.app.state.set_installation,
+                user_data=installation)),
+            self.fleet_box(installation),
+            ('weight', 3, W.get_text(
+                'body',
+                installation['directory'],
+                'center')),
+            ('weight', 2, cells[0]),
+            (18, cells[1]),
+            (20, cells[2]),
+            W.get_blank_flow()
+        ])
+        self.rows[installation['directory']] = (row, cells)
+        return row
+
+    def fill_row(self, installation):
+        """Sets a row's cells from the installation's probe results"""
+        row = self.rows.get(installation['directory'])
+        if not row:
+            return
+        cells = row[1]
+        if installation['valid_wp_options']:
+            cells[0].set_text(installation['home_url'])
+        else:
+            cells[0].set_text(str(installation['wp_db_error']))
+        cells[1].set_text(str(installation['valid_wp_options']))
+        cells[2].set_text(str(installation['wp_db_check_success']))
 
     def after_action(self, installations):
         """Updates the view's body in response to
@@ -127,41 +384,7 @@ class Installs(BodyWidget):
                 location_list.append(len(installation['directory']))
             location_list.sort(reverse=True)
             location_width = location_list[0] + 4
-            installation_columns = [W.get_col_row([
-                W.get_blank_flow(),
-                (10, U.AttrMap(W.get_div(), 'header')),
-                (
-                    location_width,
-                    U.AttrMap(
-                        W.get_text(
-                            'header',
-                            'Location',
-                            'center'
-                        ),
-                        'header')),
-                ('weight', 2, U.AttrMap(
-                    W.get_text(
-                        'header',
-                        'Home URL',
-                        'center'
-                    ),
-                    'header')),
-                (18, U.AttrMap(
-                    W.get_text(
-                        'header',
-                        'Valid wp_options',
-                        'center'
-                    ),
-                    'header')),
-                (20, U.AttrMap(
-                    W.get_text(
-                        'header',
-                        'wp_db_check passed',
-                        'center'
-                    ),
-                    'header')),
-                W.get_blank_flow()
-            ])]
+            installation_columns = [self.header_row((location_width,))]
             for installation in installations:
                 installation_rows = [
                     W.get_blank_flow(),
@@ -169,6 +392,7 @@ class Installs(BodyWidget):
                         ' + ',
                         on_press=self.app.state.set_installation,
                         user_data=installation)),
+                    self.fleet_box(installation),
                     (location_width, W.get_text(
                         'body',
                         installation['directory'],
@@ -218,6 +442,10 @@ class Installs(BodyWidget):
                     'center'),
                 W.get_blank_flow()
             ])]
+        installation_columns.extend([
+            W.get_div(),
+            self.rescan_row()
+        ])
         installation_pile = U.Pile(installation_columns)
         filler = U.Filler(installation_pile, 'middle')
         self.app.frame.contents.__setitem__('body', [filler, None])
@@ -266,7 +494,7 @@ class GetWpConfig(BodyWidget):
             button = WpConfigValueMap(
                 self.app,
                 'default',
-                on_enter=self.app.views.actions.wp_config.set_wp_config,
+                on_enter=self.app.views.actions.wp_config.queue_wp_config,
                 user_data={'directive_name': str(directive['name'])},
                 edit_text=str(directive['value']),
                 align='left')
@@ -321,6 +549,10 @@ class GetWpConfig(BodyWidget):
         directives_list.append(
             W.get_col_row([
                 W.get_blank_flow(),
+                BoxButton(
+                    'Save Changes',
+                    on_press=self.app.views.actions.wp_config.save_wp_config
+                ),
                 BoxButton(
                     'Re-Salt Config',
                     on_press=self.app.views.actions.wp_config.re_salt
@@ -345,6 +577,7 @@ class Database(BodyWidget):
         L.debug("user_args: %s, calling_view: %s", user_args, calling_view)
         self.menu_items = self.app.menus.DbSubMenu.items
         self.response_pile = None
+        self.export_text = None
 
     def after_action(self, db_info):
         """Updates the view's body in response to
@@ -486,6 +719,7 @@ class Database(BodyWidget):
             W.get_div()
         ]
         self.response_pile = U.Pile(response_text)
+        self.export_text = None
         filler = U.Filler(self.response_pile)
         self.app.frame.contents.__setitem__('body', [filler, None])
         time.sleep(1)
@@ -505,6 +739,42 @@ class Database(BodyWidget):
                     W.get_blank_flow()
                 ]), ('weight', 1)))
 
+    def update_export_progress(self, progress):
+        """Shows DbDump progress lines from the export pipe.
+        Returns False once the export is done, removing the watch"""
+        lines = progress.decode('UTF-8').splitlines()
+        if not lines:
+            return False
+        data = json.loads(lines[-1])
+        if data['total_tables']:
+            tables = '%s / %s tables' % (
+                min(data['tables'], data['total_tables']),
+                data['total_tables'])
+        else:
+            tables = '%s tables' % data['tables']
+        text = 'Exported %s, %s' % (human_size(data['bytes']), tables)
+        if data['done']:
+            if data['error']:
+                text = 'Database Export Failed:\n' + data['error']
+            else:
+                text = 'Database exported to %s\n%s' % (
+                    data['path'], text)
+        if self.response_pile:
+            if not self.export_text:
+                self.export_text = W.get_text('default', text, 'left')
+                self.response_pile.contents.append((
+                    W.get_col_row([
+                        W.get_blank_flow(),
+                        self.export_text,
+                        W.get_blank_flow()
+                    ]), ('weight', 1)))
+            else:
+                self.export_text.set_text(text)
+        if data['done']:
+            self.export_text = None
+            return False
+        return True
+
     def after_response(self):
         """Redirects to plugin_list after response"""
         time.sleep(2)
@@ -642,10 +912,18 @@ class DbSearch(BodyWidget):
         super(DbSearch, self).__init__(
             app, initial_text, progress_bar=progress_bar)
         L.debug("user_args: %s, calling_view: %s", user_args, calling_view)
+        # (results, query, paging) set by the db_search thread
+        self.pending_page = None
 
     def define_widget(self, initial_text, progress_bar=False):
         L.debug(' initial_text : %s', initial_text)
-        db_search_row = W.get_col_row([
+        return U.Filler(self.search_row(), 'middle')
+
+    def search_row(self, query=''):
+        """Returns the row holding the search query edit. Esc in it
+        cancels a direct DB search in progress"""
+        actions = self.app.views.actions.database
+        return W.get_col_row([
             W.get_blank_flow(),
             (
                 'weight',
@@ -654,17 +932,41 @@ class DbSearch(BodyWidget):
                     self.app,
                     self,
                     'body',
+                    edit_text=query,
                     caption='Database Search Query: ',
-                    on_enter=self.app.views.actions.database.db_search,
+                    on_enter=actions.db_search,
+                    on_cancel=actions.cancel_db_search,
                     align='left')),
             W.get_blank_flow()
         ])
-        return U.Filler(db_search_row, 'middle')
 
-    def after_action(self, db_search_results, query):
-        """Displays after_action contents"""
+    def show_searching(self, query):
+        """Shows that a direct DB search has started"""
+        pile = U.Pile([
+            self.search_row(query),
+            W.get_div(),
+            W.get_text(
+                'default',
+                'Searching for ' + query + '... (Esc cancels)',
+                'center')
+        ])
+        self.app.frame.contents.__setitem__(
+            'body', [U.Filler(pile, 'middle'), None])
+
+    def show_search_page(self, _data):
+        """Shows the page the db_search thread found. Returns False, as
+        the thread's pipe is used once"""
+        results, query, paging = self.pending_page
+        self.after_action(results, query, paging)
+        return False
+
+    def after_action(self, db_search_results, query, paging=None):
+        """Displays after_action contents. paging is given for pages of
+        a direct DB search"""
         L.debug('Search Results: %s', db_search_results)
-        search_result_rows = [
+        search_result_rows = [] if paging is None else [
+            self.search_row(query), W.get_div()]
+        search_result_rows += [
             W.get_col_row([
                 W.get_blank_flow(),
                 ('weight', 4, U.AttrMap(W.get_text(
@@ -705,6 +1007,13 @@ class DbSearch(BodyWidget):
                     W.get_blank_flow()
                 ])
             )
+        if paging is not None:
+            search_result_rows.extend([
+                W.get_div(),
+                self.search_paging_row(paging, len(db_search_results))])
+            self.app.frame.contents.__setitem__(
+                'body', [W.get_list_box(search_result_rows)[0], None])
+            return
         pile = U.Pile(search_result_rows)
         filler = U.Filler(pile, 'middle')
         self.app.frame.contents.__setitem__('body', [filler, None])
@@ -712,6 +1021,35 @@ class DbSearch(BodyWidget):
         self.app.loop.draw_screen()
 
 
+    def search_paging_row(self, paging, count):
+        """Returns the row with the search status and Prev / Next
+        buttons"""
+        actions = self.app.views.actions.database
+        if count:
+            status = 'Results %s - %s' % (
+                paging['offset'] + 1, paging['offset'] + count)
+        else:
+            status = 'No Matching Results'
+        if not paging['finished']:
+            status += ', still searching... (Esc cancels)'
+        elif paging['cancelled']:
+            status += ', search cancelled'
+        row = [
+            W.get_blank_flow(),
+            W.get_text('default', status, 'center')
+        ]
+        if paging['page'] > 0:
+            row.append((12, BoxButton(
+                'Prev', on_press=actions.page_db_search, user_data=-1,
+                strip_padding=True)))
+        if paging['more']:
+            row.append((12, BoxButton(
+                'Next', on_press=actions.page_db_search, user_data=1,
+                strip_padding=True)))
+        row.append(W.get_blank_flow())
+        return W.get_col_row(row)
+
+
 class SearchReplace(BodyWidget):
     """Creates the specific body widget for the view of the same name"""
 
@@ -1291,7 +1629,7 @@ class Plugins(BodyWidget):
         if self.deactivated_plugins:
             act_deact_all_plugins = BoxButton(
                 'Re-Activate All',
-                on_press=self.app.views.actions.plugins.reactivate,
+                on_press=self.app.views.actions.plugins.reactivate_all,
                 user_data=self.deactivated_plugins)
         else:
             act_deact_all_plugins = BoxButton(
@@ -1421,6 +1759,181 @@ class Plugins(BodyWidget):
         self.app.views.actions.plugins.get_plugin_list()
 
 
+class Fleet(BodyWidget):
+    """Creates the specific body widget for the view of the same name"""
+    # columns of the results table: header, record key, width
+    COLUMNS = [
+        ('Installation', 'group', ('weight', 3)),
+        ('Operation', 'label', ('weight', 2)),
+        ('Status', 'status', ('weight', 1)),
+        ('Detail', 'message', ('weight', 3)),
+        ('Time', 'seconds', ('weight', 1))
+    ]
+    # failures sort first
+    STATUS_ORDER = ['failed', 'cancelled', 'skipped', 'running', 'pending',
+                    'done']
+
+    def __init__(self, app, initial_text, user_args=None,
+                 calling_view=None, progress_bar=False):
+        self.operation = 'plugin-update'
+        self.edits = OrderedDict()
+        self.form_length = 0
+        self.sort = ('group', False)
+        self.error = None
+        super(Fleet, self).__init__(
+            app, initial_text, progress_bar=progress_bar)
+        L.debug("user_args: %s, calling_view: %s", user_args, calling_view)
+
+    def define_widget(self, initial_text, progress_bar=False):
+        L.debug(' initial_text : %s', initial_text)
+        form_rows = self.form_rows()
+        self.form_length = len(form_rows)
+        self.walker = W.get_list_box(form_rows)[1]
+        queue = self.app.views.actions.fleet.queue
+        if queue:
+            self.walker.extend(self.result_rows(queue))
+        return U.ListBox(self.walker)
+
+    def form_rows(self):
+        """Returns the rows listing the fleet, and choosing the
+        operation and the values of its fields"""
+        fleet = self.app.state.fleet
+        rows = [
+            W.get_col_row([
+                W.get_blank_flow(),
+                ('weight', 3, U.AttrMap(W.get_text(
+                    'header',
+                    '%s installations marked for the fleet' % len(fleet),
+                    'center'), 'header')),
+                W.get_blank_flow()
+            ])
+        ]
+        for install_path in fleet:
+            rows.append(W.get_col_row([
+                W.get_blank_flow(),
+                ('weight', 3, W.get_text('body', install_path, 'left')),
+                W.get_blank_flow()
+            ]))
+        if not fleet:
+            rows.append(W.get_text(
+                'body', 'Mark installations in the Installations view',
+                'center'))
+        rows.append(W.get_div())
+        group = []
+        for operation, (label, _fields, _resource) in OPERATIONS.items():
+            rows.append(W.get_col_row([
+                W.get_blank_flow(),
+                ('weight', 3, U.RadioButton(
+                    group, label, state=operation == self.operation,
+                    on_state_change=self.choose_operation,
+                    user_data=operation)),
+                W.get_blank_flow()
+            ]))
+        rows.append(W.get_div())
+        for _label, fields, _resource in OPERATIONS.values():
+            for field in fields:
+                if field not in self.edits:
+                    self.edits[field] = W.get_edit(
+                        '', caption=field + ': ', align='left')
+        for edit in self.edits.values():
+            rows.append(W.get_col_row([
+                W.get_blank_flow(),
+                ('weight', 3, U.AttrMap(edit, 'body')),
+                W.get_blank_flow()
+            ]))
+        rows.extend([
+            W.get_div(),
+            W.get_col_row([
+                W.get_blank_flow(),
+                BoxButton('Run', on_press=self.run),
+                W.get_blank_flow()
+            ])
+        ])
+        return rows
+
+    def choose_operation(self, radio_button, chosen, operation):
+        """Records the operation chosen with the radio buttons"""
+        L.debug('radio_button: %s, chosen: %s', radio_button, chosen)
+        if chosen:
+            self.operation = operation
+
+    def run(self, *args):
+        """Runs the chosen operation across the fleet"""
+        L.debug('Fleet run args: %s', args)
+        fields = OPERATIONS[self.operation][1]
+        self.error = self.app.views.actions.fleet.run(
+            self.operation,
+            [self.edits[field].get_edit_text() for field in fields])
+        self.show_results()
+
+    def sort_by(self, button, key):
+        """Sorts the results by key, reversing the order when they are
+        already sorted by it"""
+        L.debug('button: %s, key: %s', button, key)
+        self.sort = (key, not self.sort[1] if self.sort[0] == key
+                     else False)
+        self.show_results()
+
+    def sort_key(self, record):
+        """Returns the sort key of a result record"""
+        key = self.sort[0]
+        if key == 'status':
+            return (self.STATUS_ORDER.index(record['status']),
+                    record['group'])
+        return (record[key], record['group'])
+
+    def result_rows(self, queue):
+        """Returns the results table of queue, sorted by self.sort. The
+        column headers are buttons choosing the sort"""
+        header = [W.get_blank_flow()]
+        for title, key, width in self.COLUMNS:
+            if key == self.sort[0]:
+                title += ' v' if self.sort[1] else ' ^'
+            header.append(width + (BoxButton(
+                title, on_press=self.sort_by, user_data=key,
+                no_border=True),))
+        header.append(W.get_blank_flow())
+        rows = [W.get_div()]
+        if self.error:
+            rows.append(W.get_text('alert', self.error, 'center'))
+        rows.append(U.AttrMap(W.get_col_row(header), 'header'))
+        records = sorted(queue.records(), key=self.sort_key,
+                         reverse=self.sort[1])
+        for record in records:
+            cells = [W.get_blank_flow()]
+            for _title, key, width in self.COLUMNS:
+                value = record[key]
+                if key == 'seconds':
+                    value = '%.1fs' % value if value else ''
+                cells.append(width + (W.get_text(
+                    'default', value,
+                    'right' if key == 'seconds' else 'left'),))
+            cells.append(W.get_blank_flow())
+            rows.append(W.get_col_row(cells))
+        rows.extend([
+            W.get_div(),
+            W.get_text('default', queue.summary(), 'center')])
+        return rows
+
+    def shown_queue(self):
+        return self.app.views.actions.fleet.queue
+
+    def show_results(self, *args):
+        """Redraws the results table below the form, keeping the
+        focus where it was"""
+        queue = self.app.views.actions.fleet.queue
+        if queue is None:
+            if self.error:
+                del self.walker[self.form_length:]
+                self.walker.append(W.get_text('alert', self.error, 'center'))
+            return
+        focus = self.walker.focus
+        del self.walker[self.form_length:]
+        self.walker.extend(self.result_rows(queue))
+        if focus is not None and focus < len(self.walker):
+            self.walker.set_focus(focus)
+
+
 class RevertChanges(BodyWidget):
     """Creates the specific body widget for the view of the same name"""
 
@@ -1430,10 +1943,13 @@ class RevertChanges(BodyWidget):
             app, initial_text, progress_bar=progress_bar)
         L.debug("user_args: %s, calling_view: %s", user_args, calling_view)
 
-    def after_action(self, revisions):
-        """Displays after_action contents"""
-        L.debug('list_of_revisions: %s', revisions)
+    def after_action(self, revisions, paging=None):
+        """Displays a page of revisions from the revision catalog,
+        with type and name filters and paging controls"""
+        L.debug('list_of_revisions: %s, paging: %s', revisions, paging)
         revisions_rows = [
+            self.filter_row(paging),
+            W.get_div(),
             W.get_col_row([
                 W.get_blank_flow(),
                 U.AttrMap(W.get_text(
@@ -1449,8 +1965,7 @@ class RevertChanges(BodyWidget):
             ])
         ]
 
-        revisions_sorted = OrderedDict(sorted(revisions.items()))
-        for revision_time, revision_data in revisions_sorted.items():
+        for revision_time, revision_data in revisions.items():
             revision_datetime = datetime.datetime.strptime(
                 revision_time,
                 self.app.settings.datetime['date_string'])
@@ -1459,26 +1974,29 @@ class RevertChanges(BodyWidget):
             if 'themes' in revision_data.keys():
                 themes = W.get_text(
                     'default',
-                    '\n' + revision_data['themes'] + '\n', 'center')
+                    '\n' + revision_data['themes']['name'] + '\n',
+                    'center')
             else:
                 themes = W.get_blank_flow()
             if 'plugins' in revision_data.keys():
                 plugins = W.get_text(
                     'default',
-                    '\n' + revision_data['plugins'] + '\n', 'center')
+                    '\n' + revision_data['plugins']['name'] + '\n',
+                    'center')
             else:
                 plugins = W.get_blank_flow()
             if 'databases' in revision_data.keys():
                 databases = W.get_text(
                     'default',
-                    '\n' + revision_data['databases'] + '\n', 'center')
+                    '\n' + revision_data['databases']['name'] + '\n',
+                    'center')
             else:
                 databases = W.get_blank_flow()
 
             restore_button = BoxButton(
                 'Restore',
                 on_press=self.app.views.actions.revisions.restore_revision,
-                user_data=[revisions_sorted, revision_time]
+                user_data=[revisions, revision_time]
             )
             revisions_rows.append(
                 W.get_col_row([
@@ -1500,12 +2018,71 @@ class RevertChanges(BodyWidget):
                     W.get_blank_flow()
                 ])
             )
-        revisions_pile = U.Pile(revisions_rows)
-        filler = U.Filler(revisions_pile)
-        self.app.frame.contents.__setitem__('body', [filler, None])
+        if paging:
+            revisions_rows.extend([W.get_div(), self.paging_row(paging)])
+        revisions_list_box = W.get_list_box(revisions_rows)[0]
+        self.app.frame.contents.__setitem__(
+            'body', [revisions_list_box, None])
         time.sleep(1)
         self.app.loop.draw_screen()
 
+    def filter_row(self, paging):
+        """Returns the row of revision type buttons and the name
+        filter"""
+        actions = self.app.views.actions.revisions
+        paging = paging or {}
+        buttons = [W.get_blank_flow()]
+        for label, revision_type in [
+                ('All', None), ('Themes', 'themes'),
+                ('Plugins', 'plugins'), ('Database', 'databases')]:
+            if paging.get('type') == revision_type:
+                label = '[' + label + ']'
+            buttons.append((
+                len(label) + 8,
+                BoxButton(
+                    label,
+                    on_press=actions.filter_revisions,
+                    user_data=revision_type,
+                    strip_padding=True)))
+        name_filter = DbImportEditMap(
+            self.app,
+            'body',
+            edit_text=paging.get('text', ''),
+            align='left',
+            on_enter=actions.search_revisions,
+            caption='Name Filter: ')
+        buttons.extend([
+            ('weight', 2, W.get_line_box(name_filter, '')),
+            W.get_blank_flow()
+        ])
+        return W.get_col_row(buttons)
+
+    def paging_row(self, paging):
+        """Returns the row with the page position and Prev / Next
+        buttons"""
+        actions = self.app.views.actions.revisions
+        first = paging['offset'] + 1 if paging['total'] else 0
+        last = min(paging['offset'] + paging['limit'], paging['total'])
+        status = 'Revisions %s - %s of %s' % (first, last, paging['total'])
+        if paging.get('retention'):
+            status += '\nLast cleanup: %s revisions removed, %s reclaimed' % (
+                paging['retention']['removed'],
+                human_size(paging['retention']['reclaimed']))
+        row = [
+            W.get_blank_flow(),
+            W.get_text('default', status, 'center')
+        ]
+        if paging['offset'] > 0:
+            row.append((12, BoxButton(
+                'Prev', on_press=actions.page_revisions, user_data=-1,
+                strip_padding=True)))
+        if last < paging['total']:
+            row.append((12, BoxButton(
+                'Next', on_press=actions.page_revisions, user_data=1,
+                strip_padding=True)))
+        row.append(W.get_blank_flow())
+        return W.get_col_row(row)
+
     def after_revert(self, result):
         """Displays results after reverting changes"""
         revision_time = datetime.datetime.strptime(
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Append-only catalog of the revisions made by RevisionActions.auto_bk.
+
+Each installation's revisions directory holds a catalog.jsonl. Every
+backup appends one JSON line describing it, and removing a revision
+appends a 'delete' record naming it. The file is replayed once and then
+read incrementally from the last offset, so listing revisions never
+scans the revision directories."""
+import os
+import json
+import time
+from threading import Lock
+from logmod import Log
+
+L = Log()
+
+CATALOG_NAME = 'catalog.jsonl'
+REVISION_TYPES = ('themes', 'plugins', 'databases')
+
+
+class RevisionCatalog(object):
+    """The catalog at path. Use RevisionCatalog.get(path), so all threads
+    share one instance per file.
+
+    Entries are dicts with 'id', 'type', 'name', 'timestamp', 'created',
+    'used', 'size', 'stored', 'files', 'status' and 'path', the file name
+    of the revision in its type directory"""
+    instances = {}
+    instances_lock = Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.offset = 0
+        self.revisions = {}
+        # entries removed from the catalog whose files may still exist
+        self.deleted = {}
+
+    @classmethod
+    def get(cls, path):
+        """Returns the shared catalog for path"""
+        with cls.instances_lock:
+            if path not in cls.instances:
+                cls.instances[path] = cls(path)
+            return cls.instances[path]
+
+    @classmethod
+    def for_install(cls, temp_dir, install_dir):
+        """Returns the catalog of an installation's revisions"""
+        return cls.get(os.path.join(temp_dir, install_dir, CATALOG_NAME))
+
+    def write(self, record):
+        """Appends a record with a single write, so concurrent writers
+        never interleave"""
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        data = str.encode(json.dumps(record, sort_keys=True) + '\n')
+        fd = os.open(
+            self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def append(self, entry):
+        """Records a new revision"""
+        entry = dict(entry)
+        entry.setdefault('id', '%s/%s' % (entry['type'], entry['path']))
+        entry['op'] = 'add'
+        self.write(entry)
+        return entry['id']
+
+    def delete(self, revision_id, reclaimed=0):
+        """Records that a revision has been removed"""
+        self.write({'op': 'delete', 'id': revision_id,
+                    'reclaimed': reclaimed})
+
+    def touch(self, revision_id):
+        """Records that a revision has been used, for LRU eviction"""
+        self.write({'op': 'touch', 'id': revision_id, 'used': time.time()})
+
+    def refresh(self):
+        """Applies the records appended since the last read"""
+        with self.lock:
+            try:
+                with open(self.path, 'rb') as catalog_file:
+                    catalog_file.seek(self.offset)
+                    data = catalog_file.read()
+            except (OSError, IOError):
+                return
+            # a record still being written is left for the next read
+            end = data.rfind(b'\n') + 1
+            self.offset += end
+            for line in data[:end].splitlines():
+                try:
+                    record = json.loads(line.decode('UTF-8'))
+                except ValueError:
+                    L.warning('Bad catalog line in %s: %s', self.path, line)
+                    continue
+                operation = record.pop('op', 'add')
+                if operation == 'delete':
+                    entry = self.revisions.pop(record['id'], None)
+                    if entry:
+                        self.deleted[record['id']] = entry
+                elif operation == 'touch':
+                    if record['id'] in self.revisions:
+                        self.revisions[record['id']]['used'] = record['used']
+                else:
+                    record.setdefault('used', record.get('created', 0))
+                    self.revisions[record['id']] = record
+
+    def directory(self):
+        """Returns the installation's revision directory"""
+        return os.path.dirname(self.path)
+
+    def entries(self):
+        """Returns every live entry, newest first"""
+        self.refresh()
+        with self.lock:
+            entries = list(self.revisions.values())
+        return sorted(
+            entries, key=lambda entry: (entry['timestamp'], entry['id']),
+            reverse=True)
+
+    def query(self, revision_type=None, text=None, offset=0, limit=20,
+              status='ok'):
+        """Returns (page, total). page is a list of
+        (timestamp, {type: entry}), newest first, for the revisions that
+        have an entry matching the filters. Entries made by one auto_bk
+        call share a timestamp, and form one revision.
+        total is the number of matching revisions"""
+        groups = {}
+        order = []
+        matched = set()
+        for entry in self.entries():
+            if status and entry['status'] != status:
+                continue
+            timestamp = entry['timestamp']
+            if timestamp not in groups:
+                groups[timestamp] = {}
+                order.append(timestamp)
+            groups[timestamp][entry['type']] = entry
+            if (not revision_type or entry['type'] == revision_type) and \
+                    (not text or text.lower() in entry['name'].lower()):
+                matched.add(timestamp)
+        order = [timestamp for timestamp in order if timestamp in matched]
+        page = [
+            (timestamp, groups[timestamp])
+            for timestamp in order[offset:offset + limit]]
+        return page, len(order)
+
+
+def revision_size(path):
+    """Returns (bytes, files) of a revision file or directory"""
+    if os.path.isfile(path):
+        return os.path.getsize(path), 1
+    size = files = 0
+    for root, _dirs, names in os.walk(path):
+        for name in names:
+            size += os.path.getsize(os.path.join(root, name))
+            files += 1
+    return size, files
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""Direct MySQL / MariaDB access to installation databases.
+
+Credentials are read from wp-config.php with WpConfigParser. Queries go
+through PyMySQL when it is installed, otherwise through a single long
+running `mysql --batch` client process per installation. Connections are
+kept in DbConnections, so each installation pays the connection cost
+once."""
+import os
+import re
+import time
+import uuid
+import shutil
+import tempfile
+import subprocess
+from threading import Lock
+from logmod import Log
+from wpconfig_parser import WpConfigParser, WpConfigParseError
+try:
+    import pymysql
+    import pymysql.cursors
+except ImportError:
+    pymysql = None
+
+L = Log()
+
+
+class DbError(Exception):
+    """Raised when a query fails, or the connection is lost"""
+
+
+def escape_string(value):
+    """Escapes a value for use inside a single quoted SQL string"""
+    return str(value).replace('\\', '\\\\').replace("'", "\\'").replace(
+        '\0', '\\0').replace('\n', '\\n').replace('\r', '\\r').replace(
+            '\x1a', '\\Z')
+
+
+def literal(value):
+    """Returns SQL source for a python value"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + escape_string(value) + "'"
+
+
+def quote_name(name):
+    """Quotes a table or column name"""
+    return '`' + str(name).replace('`', '``') + '`'
+
+
+def format_query(sql, args=None):
+    """Substitutes %s placeholders in sql with SQL literals of args.
+    Only used for the `mysql --batch` backend; PyMySQL binds arguments
+    itself, with the connection's charset and SQL mode"""
+    if not args:
+        return sql
+    return sql % tuple(literal(arg) for arg in args)
+
+
+class DbCredentials(object):
+    """Connection details for an installation, from its wp-config.php"""
+
+    def __init__(self, install_path):
+        config_path = os.path.join(install_path, 'wp-config.php')
+        constants = {}
+        self.table_prefix = 'wp_'
+        for directive in WpConfigParser.parse_file(config_path):
+            if directive['type'] == 'constant':
+                constants[directive['name']] = directive['value']
+            elif directive['name'] == 'table_prefix':
+                self.table_prefix = str(directive['value'])
+        self.name = str(constants.get('DB_NAME', ''))
+        self.user = str(constants.get('DB_USER', ''))
+        self.password = str(constants.get('DB_PASSWORD', ''))
+        self.charset = str(constants.get('DB_CHARSET', '') or 'utf8mb4')
+        self.host, self.port, self.socket = self.split_host(
+            str(constants.get('DB_HOST', 'localhost')))
+        if not self.name or not self.user:
+            raise WpConfigParseError('DB_NAME or DB_USER is not defined')
+
+    @staticmethod
+    def split_host(db_host):
+        """Splits DB_HOST the way WordPress' wpdb does, into
+        (host, port, socket)"""
+        host, port, socket = db_host, None, None
+        match = re.match(r'^\[(.+)\](?::(.*))?$', db_host)
+        if match:
+            host, rest = match.group(1), match.group(2)
+        elif db_host.count(':') == 1:
+            host, rest = db_host.split(':')
+        else:
+            rest = None
+        if rest:
+            if rest.isdigit():
+                port = int(rest)
+            else:
+                socket = rest
+        return host or 'localhost', port, socket
+
+
+class PyMysqlClient(object):
+    """DB client using PyMySQL"""
+
+    def __init__(self, credentials):
+        options = {
+            'user': credentials.user,
+            'password': credentials.password,
+            'database': credentials.name,
+            'charset': credentials.charset,
+            'cursorclass': pymysql.cursors.DictCursor,
+            'autocommit': True
+        }
+        if credentials.socket:
+            options['unix_socket'] = credentials.socket
+        else:
+            options['host'] = credentials.host
+            if credentials.port:
+                options['port'] = credentials.port
+        self.lock = Lock()
+        try:
+            self.connection = pymysql.connect(**options)
+        except pymysql.MySQLError as error:
+            raise DbError(str(error))
+
+    def query(self, sql, args=None):
+        """Runs sql, with its %s placeholders bound to args by PyMySQL.
+        Returns the result rows as dicts"""
+        with self.lock:
+            try:
+                with self.connection.cursor() as cursor:
+                    cursor.execute(sql, args or None)
+                    rows = cursor.fetchall()
+            except pymysql.MySQLError as error:
+                raise DbError(str(error))
+        return [
+            dict((key, self.as_text(value)) for key, value in row.items())
+            for row in rows]
+
+    @staticmethod
+    def as_text(value):
+        """Matches the mysql client backend, which returns text"""
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, bytes):
+            return value.decode('UTF-8', 'replace')
+        return str(value)
+
+    def alive(self):
+        """True while the connection is usable"""
+        try:
+            self.connection.ping(reconnect=False)
+        except pymysql.MySQLError:
+            return False
+        return True
+
+    def close(self):
+        """Closes the connection"""
+        try:
+            self.connection.close()
+        except pymysql.MySQLError:
+            pass
+
+
+class MysqlClient(object):
+    """DB client driving a single long running `mysql --batch` process.
+
+    Each query is followed by a SELECT of a unique marker, so the end of
+    its output can be found. Errors are recognised by the client's
+    'ERROR nnnn' lines, as stderr is merged into stdout"""
+    ERROR_RE = re.compile(r'^ERROR \d+ \([0-9A-Z]+\)( at line \d+)?: ')
+    UNESCAPES = {'t': '\t', 'n': '\n', '\\': '\\', '0': '\0'}
+
+    def __init__(self, credentials, temp_dir):
+        self.lock = Lock()
+        self.marker = 'wpui-' + uuid.uuid4().hex
+        options_fd, options_path = tempfile.mkstemp(
+            prefix='.wpui-my-', suffix='.cnf', dir=temp_dir)
+        with os.fdopen(options_fd, 'w') as options_file:
+            options_file.write(self.options(credentials))
+        try:
+            self.proc = subprocess.Popen(
+                [
+                    'mysql',
+                    '--defaults-extra-file=' + options_path,
+                    '--batch',
+                    '--force',
+                    '--unbuffered',
+                    '--default-character-set=' + credentials.charset,
+                    credentials.name
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+            # the options file is read at connect time, so it can be
+            # removed once the first query has been answered
+            self.query('SELECT 1')
+        except OSError as error:
+            raise DbError(str(error))
+        finally:
+            os.remove(options_path)
+
+    @staticmethod
+    def options(credentials):
+        """Returns the [client] options file contents"""
+        lines = ['[client]', 'user="%s"' % escape_string(credentials.user),
+                 'password="%s"' % escape_string(credentials.password)]
+        if credentials.socket:
+            lines.append('socket="%s"' % credentials.socket)
+        else:
+            lines.append('host="%s"' % credentials.host)
+            if credentials.port:
+                lines.append('port=%s' % credentials.port)
+        return '\n'.join(lines) + '\n'
+
+    def query(self, sql, args=None):
+        """Runs sql. Returns the result rows as dicts of text values,
+        with None for NULL"""
+        statement = format_query(sql, args).strip().rstrip(';')
+        with self.lock:
+            if self.proc.poll() is not None:
+                raise DbError('mysql client has exited')
+            request = "%s;\nSELECT '%s' AS wpui_marker;\n" % (
+                statement, self.marker)
+            try:
+                self.proc.stdin.write(request.encode('UTF-8'))
+                self.proc.stdin.flush()
+            except (OSError, ValueError) as error:
+                raise DbError(str(error))
+            lines = []
+            while True:
+                line = self.proc.stdout.readline()
+                if not line:
+                    raise DbError('mysql client has exited')
+                line = line.decode('UTF-8', 'replace').rstrip('\n')
+                if line == self.marker and lines and \
+                        lines[-1] == 'wpui_marker':
+                    lines.pop()
+                    break
+                lines.append(line)
+        for line in lines:
+            if self.ERROR_RE.match(line):
+                raise DbError(line)
+        if not lines:
+            return []
+        columns = lines[0].split('\t')
+        return [
+            dict(zip(columns, [
+                self.unescape(value) for value in line.split('\t')]))
+            for line in lines[1:]]
+
+    def unescape(self, value):
+        """Reverses the escaping done by `mysql --batch`"""
+        if value == 'NULL':
+            return None
+        if '\\' not in value:
+            return value
+        return re.sub(
+            r'\\(.)',
+            lambda match: self.UNESCAPES.get(
+                match.group(1), match.group(1)),
+            value)
+
+    def alive(self):
+        """True while the client process is running"""
+        return self.proc.poll() is None
+
+    def close(self):
+        """Ends the client process"""
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+
+
+class DbConnections(object):
+    """Keeps one DB client per installation. Installations that fail to
+    connect are retried after retry_delay seconds, and callers use wp-cli
+    until then"""
+    clients = {}
+    failed = {}
+    lock = Lock()
+
+    @classmethod
+    def get(cls, app, install_path=None):
+        """Returns a connected client for the installation, or None if
+        direct access is disabled or not possible"""
+        settings = getattr(app.settings, 'database', {})
+        if not settings.get('direct_access', False):
+            return None
+        if not install_path:
+            install_path = app.state.active_installation['directory']
+        with cls.lock:
+            client = cls.clients.get(install_path)
+            if client and client.alive():
+                return client
+            if client:
+                del cls.clients[install_path]
+            if time.time() - cls.failed.get(install_path, 0) < \
+                    settings.get('retry_delay', 60):
+                return None
+            try:
+                client = cls.connect(app, install_path, settings)
+            except (DbError, WpConfigParseError, OSError) as error:
+                L.warning('No direct DB connection for %s: %s',
+                          install_path, error)
+                cls.failed[install_path] = time.time()
+                return None
+            client.credentials = DbCredentials(install_path)
+            cls.clients[install_path] = client
+            return client
+
+    @staticmethod
+    def connect(app, install_path, settings):
+        """Opens a client using the backend chosen in settings"""
+        credentials = DbCredentials(install_path)
+        backend = settings.get('client', 'auto')
+        if backend in ('auto', 'pymysql') and pymysql:
+            return PyMysqlClient(credentials)
+        if backend == 'pymysql':
+            raise DbError('PyMySQL is not installed')
+        if not shutil.which('mysql'):
+            raise DbError('mysql client not found')
+        return MysqlClient(credentials, app.state.temp_dir)
+
+    @classmethod
+    def close(cls, install_path):
+        """Closes the client for install_path, e.g. after wp-config.php
+        DB credentials change"""
+        with cls.lock:
+            client = cls.clients.pop(install_path, None)
+            cls.failed.pop(install_path, None)
+        if client:
+            client.close()
+
+    @classmethod
+    def close_all(cls):
+        """Closes every client"""
+        with cls.lock:
+            clients, cls.clients = cls.clients, {}
+        for client in clients.values():
+            client.close()
+
+
+def human_size(size):
+    """Formats a byte count the way `wp db size --human-readable` does"""
+    size = float(size)
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            break
+        size = size / 1024
+    else:
+        unit = 'TB'
+    if unit == 'B':
+        return '%d %s' % (size, unit)
+    return '%s %s' % (('%.2f' % size).rstrip('0').rstrip('.'), unit)
+
+
+def get_table_status(client):
+    """Returns size, table list and table status of the client's database
+    from information_schema, in one round trip"""
+    return client.query(
+        "SELECT TABLE_NAME, ENGINE, TABLE_ROWS, "
+        "DATA_LENGTH + INDEX_LENGTH AS TABLE_SIZE, "
+        "CREATE_TIME, UPDATE_TIME, AUTO_INCREMENT, TABLE_COMMENT "
+        "FROM information_schema.TABLES "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE' "
+        "ORDER BY TABLE_NAME")
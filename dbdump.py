@@ -0,0 +1,800 @@
+# -*- coding: utf-8 -*-
+"""Streaming, compressed database dumps.
+
+`wp db export -` is read as it is produced and written through gzip or
+zstd, so no uncompressed copy of the dump ever touches the disk.
+Progress is reported as JSON lines on a pipe, and the write rate can be
+limited for shared hosts. Compressed dumps are imported by streaming
+them, decompressed, into `wp db import -`."""
+import io
+import os
+import json
+import gzip
+import time
+import shutil
+import tempfile
+import subprocess
+from threading import Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+from logmod import Log
+from database import DbError, get_table_status, quote_name
+from jobs import Job, DONE
+
+L = Log()
+
+# Extension appended to '.sql' for each compression
+COMPRESSIONS = {
+    'zstd': '.zst',
+    'gzip': '.gz',
+    'none': ''
+}
+DUMP_EXTENSIONS = ('.sql', '.sql.gz', '.sql.zst')
+# Parallel dumps are directories of per-table files plus a manifest
+DUMP_DIR_EXTENSION = '.sqld'
+INCREMENTAL_EXTENSION = '.sqli'
+MANIFEST = 'manifest.json'
+CHUNK_SIZE = 65536
+TABLE_MARKER = b'\nCREATE TABLE '
+
+
+def choose_compression(setting):
+    """Returns the compression to use for the export_compression
+    setting. zstd is only used when its binary is installed"""
+    if setting in ('auto', 'zstd') and shutil.which('zstd'):
+        return 'zstd'
+    if setting == 'none':
+        return 'none'
+    if setting == 'zstd':
+        L.warning('zstd is not installed, using gzip')
+    return 'gzip'
+
+
+def dump_base(path):
+    """Returns path without any dump extension"""
+    for extension in DUMP_EXTENSIONS + (
+            DUMP_DIR_EXTENSION, INCREMENTAL_EXTENSION):
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+
+def dump_path(path, compression):
+    """Returns path with the dump extension for compression"""
+    return dump_base(path) + '.sql' + COMPRESSIONS[compression]
+
+
+def find_dump(path):
+    """Returns the existing dump for path, which may have been written
+    with any compression or as a parallel dump, or path itself if none
+    exists"""
+    for compression in COMPRESSIONS:
+        candidate = dump_path(path, compression)
+        if os.path.isfile(candidate):
+            return candidate
+    for extension in (DUMP_DIR_EXTENSION, INCREMENTAL_EXTENSION):
+        candidate = dump_base(path) + extension
+        if os.path.isfile(os.path.join(candidate, MANIFEST)):
+            return candidate
+    return path
+
+
+class RateLimiter(object):
+    """Sleeps as needed to keep the average rate under rate bytes per
+    second. A rate of 0 disables the limit"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.time()
+        self.total = 0
+
+    def consume(self, count):
+        """Accounts for count bytes, sleeping if they came too fast"""
+        if not self.rate:
+            return
+        self.total += count
+        delay = self.start + float(self.total) / self.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CompressedWriter(object):
+    """Writes a file through gzip, zstd or no compression"""
+
+    def __init__(self, path, compression, level=6):
+        self.path = path
+        self.proc = None
+        if compression == 'gzip':
+            self.file = gzip.open(path, 'wb', compresslevel=level)
+        elif compression == 'zstd':
+            self.file = open(path, 'wb')
+            self.proc = subprocess.Popen(
+                ['zstd', '-q', '-c', '-T0', '-%d' % level],
+                stdin=subprocess.PIPE,
+                stdout=self.file)
+        else:
+            self.file = open(path, 'wb')
+
+    def write(self, data):
+        """Writes a chunk of uncompressed data"""
+        if self.proc:
+            self.proc.stdin.write(data)
+        else:
+            self.file.write(data)
+
+    def close(self):
+        """Finishes the file. Returns True on success"""
+        success = True
+        if self.proc:
+            self.proc.stdin.close()
+            success = self.proc.wait() == 0
+        self.file.close()
+        return success
+
+    def abort(self):
+        """Closes and removes the partial file"""
+        try:
+            if self.proc:
+                self.proc.kill()
+                self.proc.wait()
+            self.file.close()
+            os.remove(self.path)
+        except OSError as error:
+            L.warning('Could not remove partial dump %s: %s',
+                      self.path, error)
+
+
+def open_dump(path):
+    """Returns (stream, proc) where stream reads the uncompressed SQL of
+    the dump at path. proc is the decompressor process, if any"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb'), None
+    if path.endswith('.zst'):
+        proc = subprocess.Popen(
+            ['zstd', '-q', '-d', '-c', path],
+            stdout=subprocess.PIPE)
+        return proc.stdout, proc
+    return open(path, 'rb'), None
+
+
+def is_compressed(path):
+    """True if path is a compressed dump"""
+    return path.endswith(('.gz', '.zst'))
+
+
+def wp_args(arguments, install_path):
+    """Returns the popen arguments for a wp-cli command"""
+    return ['wp'] + arguments + [
+        '--path=' + install_path, '--skip-themes', '--skip-plugins']
+
+
+class DumpError(Exception):
+    """Raised when wp-cli or a compressor fails during a dump"""
+
+
+def export_stream(install_path, arguments, sink):
+    """Runs `wp db export -` with the extra arguments, passing each chunk
+    of output to sink. Raises DumpError if the export fails, times out
+    or is cancelled"""
+    job = Job(wp_args(['db', 'export', '-'] + arguments, install_path),
+              interactive=True)
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            proc = job.start(stdout=subprocess.PIPE, stderr=stderr)
+            try:
+                sink(proc.stdout)
+            finally:
+                if proc.poll() is None and not job.reason:
+                    # sink gave up, or the job was stopped mid-read
+                    proc.stdout.close()
+                status = job.finish()
+        except (OSError, IOError) as error:
+            if job.proc and job.proc.poll() is None:
+                job.stop()
+                job.finish()
+            raise DumpError(job.reason and job.message() or str(error))
+        if status != DONE:
+            stderr.seek(0)
+            raise DumpError(job.reason and job.message() or stderr.read(
+            ).decode('UTF-8', 'replace').strip() or 'wp db export failed')
+
+
+class DbDump(object):
+    """Streams `wp db export -` into a compressed file.
+
+    If progress_fd is given, JSON lines with 'bytes', 'tables',
+    'total_tables' and 'done' are written to it, followed by a final
+    line with 'done' set and either 'path' or 'error'"""
+    REPORT_INTERVAL = 0.25
+
+    def __init__(self, install_path, file_path, settings,
+                 progress_fd=None, total_tables=None):
+        self.install_path = install_path
+        self.compression = choose_compression(
+            settings.get('export_compression', 'auto'))
+        self.level = settings.get('export_compress_level', 6)
+        self.limiter = RateLimiter(
+            settings.get('export_rate_limit_kb', 0) * 1024)
+        self.path = dump_path(file_path, self.compression)
+        self.progress_fd = progress_fd
+        self.total_tables = total_tables
+        self.bytes = 0
+        self.tables = 0
+        self.last_report = 0
+        self.report_lock = Lock()
+
+    def report(self, done=False, error=None):
+        """Writes a progress line, at most every REPORT_INTERVAL seconds
+        unless done"""
+        with self.report_lock:
+            if self.progress_fd is None:
+                return
+            now = time.time()
+            if not done and now - self.last_report < self.REPORT_INTERVAL:
+                return
+            self.last_report = now
+            data = {
+                'bytes': self.bytes,
+                'tables': self.tables,
+                'total_tables': self.total_tables,
+                'done': done
+            }
+            if done:
+                data['error'] = error
+                data['path'] = None if error else self.path
+            try:
+                os.write(self.progress_fd,
+                         str.encode(json.dumps(data) + '\n'))
+            except OSError as os_error:
+                L.warning('Progress pipe closed: %s', os_error)
+                self.progress_fd = None
+
+    def copy(self, source, writer, count_tables=True):
+        """Copies a wp-cli output stream to writer, keeping count of bytes
+        and tables and applying the rate limit"""
+        tail = b''
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            writer.write(chunk)
+            with self.report_lock:
+                self.bytes += len(chunk)
+                if count_tables:
+                    self.tables += (tail + chunk).count(TABLE_MARKER)
+            tail = chunk[-len(TABLE_MARKER) + 1:]
+            self.report()
+            self.limiter.consume(len(chunk))
+
+    def run(self):
+        """Runs the export. Returns the path written, or None"""
+        L.debug('Exporting %s to %s', self.install_path, self.path)
+        error = None
+        writer = None
+        try:
+            writer = CompressedWriter(
+                self.path, self.compression, self.level)
+            export_stream(
+                self.install_path, [],
+                lambda stdout: self.copy(stdout, writer))
+            if not writer.close():
+                raise DumpError('Compressor failed')
+        except (DumpError, OSError, IOError) as dump_error:
+            error = str(dump_error)
+            L.warning('Database export failed: %s', error)
+            if writer:
+                writer.abort()
+        self.report(done=True, error=error)
+        return None if error else self.path
+
+
+class ParallelDump(DbDump):
+    """Dumps a database as a directory of per-table compressed files and
+    a manifest, using up to settings['export_workers'] threads.
+
+    With export_snapshot set, a single `--single-transaction` dump is
+    split into the table files as it streams, so all tables come from
+    one consistent snapshot and only compression runs in parallel.
+    Otherwise each table is exported by its own wp-cli process.
+    The directory is built under a '.partial' name and renamed once the
+    manifest is written, so an incomplete dump is never used"""
+    TABLE_START = b'-- Table structure for table `'
+    # (prefix, placeholder) of the view sections of a snapshot dump. The
+    # placeholder tables let views that use other views be created in
+    # any order
+    VIEW_STARTS = (
+        (b'-- Temporary view structure for view `', True),
+        (b'-- Temporary table structure for view `', True),
+        (b'-- Final view structure for view `', False))
+    ROUTINE_STARTS = {
+        b'-- Dumping events for database ': 'events',
+        b'-- Dumping routines for database ': 'routines'}
+    FOOTER_START = b'/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */'
+
+    def __init__(self, install_path, file_path, settings, tables,
+                 progress_fd=None):
+        super(ParallelDump, self).__init__(
+            install_path, file_path, settings,
+            progress_fd=progress_fd, total_tables=len(tables))
+        self.path = dump_base(file_path) + DUMP_DIR_EXTENSION
+        self.table_names = tables
+        self.workers = max(1, int(settings.get('export_workers', 4)))
+        self.snapshot = settings.get('export_snapshot', True)
+
+    def table_file(self, index):
+        """Returns the file name for the index'th table"""
+        return '%04d.sql%s' % (index, COMPRESSIONS[self.compression])
+
+    def run(self):
+        """Runs the export. Returns the directory written, or None"""
+        L.debug('Parallel export of %s to %s', self.install_path, self.path)
+        partial = self.path + '.partial'
+        error = None
+        try:
+            if os.path.isdir(partial):
+                shutil.rmtree(partial)
+            os.makedirs(partial)
+            if not self.table_names:
+                tables = []
+            elif self.snapshot:
+                tables = self.dump_snapshot(partial)
+            else:
+                tables = self.dump_tables(partial)
+            with open(os.path.join(partial, MANIFEST), 'w') as manifest_file:
+                json.dump(self.manifest(tables), manifest_file, indent=1)
+            os.rename(partial, self.path)
+        except (DumpError, OSError, IOError) as dump_error:
+            error = str(dump_error)
+            L.warning('Parallel database export failed: %s', error)
+            shutil.rmtree(partial, ignore_errors=True)
+        self.report(done=True, error=error)
+        return None if error else self.path
+
+    def manifest(self, tables):
+        """Returns the manifest for the dumped tables"""
+        return {
+            'version': 1,
+            'created': time.time(),
+            'compression': self.compression,
+            'snapshot': bool(self.snapshot),
+            'tables': tables
+        }
+
+    def export_filter(self):
+        """Returns extra `wp db export` arguments selecting the tables
+        of a snapshot dump. All tables are dumped by default"""
+        return []
+
+    def dump_table(self, directory, index, table):
+        """Exports a single table into its own file"""
+        file_name = self.table_file(index)
+        writer = CompressedWriter(
+            os.path.join(directory, file_name), self.compression, self.level)
+        try:
+            export_stream(
+                self.install_path, ['--tables=' + table],
+                lambda stdout: self.copy(stdout, writer, False))
+        except DumpError:
+            writer.abort()
+            raise
+        if not writer.close():
+            raise DumpError('Compressor failed for ' + table)
+        with self.report_lock:
+            self.tables += 1
+        self.report()
+        return {'name': table, 'file': file_name}
+
+    def dump_tables(self, directory):
+        """Exports every table concurrently"""
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [
+                pool.submit(self.dump_table, directory, index, table)
+                for index, table in enumerate(self.table_names)]
+            return [future.result() for future in futures]
+
+    def section(self, line):
+        """Returns the manifest entry for the dump section that line
+        starts, or None. Views, events and routines are marked with their
+        'kind', as they can only be restored once every table is"""
+        if line.startswith(self.TABLE_START):
+            return {'name': self.quoted_name(line, self.TABLE_START)}
+        for start, placeholder in self.VIEW_STARTS:
+            if line.startswith(start):
+                entry = {'name': self.quoted_name(line, start),
+                         'kind': 'view'}
+                if placeholder:
+                    entry['placeholder'] = True
+                return entry
+        for start, name in self.ROUTINE_STARTS.items():
+            if line.startswith(start):
+                return {'name': name, 'kind': 'routines'}
+        return None
+
+    @staticmethod
+    def quoted_name(line, start):
+        """Returns the `quoted` name following start in a section line"""
+        name = line[len(start):].rstrip()
+        return name.rstrip(b'`').decode('UTF-8', 'replace')
+
+    def dump_snapshot(self, directory):
+        """Splits one consistent export into per-table files. The
+        statements before the first table and after the last one are kept
+        as header.sql and footer.sql, and wrap each table on import.
+        View, event and routine sections get files of their own.
+        Compression of each file runs in the pool while the next one
+        is read"""
+        tables = []
+        state = {'writer': None, 'kind': None}
+        header = open(os.path.join(directory, 'header.sql'), 'wb')
+        footer = open(os.path.join(directory, 'footer.sql'), 'wb')
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        # bounds the data read ahead of the compressors
+        slots = BoundedSemaphore(self.workers * 4)
+        pending = []
+
+        def finish_section():
+            if state['writer']:
+                pending.append(pool.submit(state['writer'].close))
+                if not state['kind']:
+                    with self.report_lock:
+                        self.tables += 1
+                state['writer'] = None
+
+        def start_section(entry):
+            finish_section()
+            entry['file'] = self.table_file(len(tables))
+            tables.append(entry)
+            state['kind'] = entry.get('kind')
+            state['writer'] = QueuedWriter(
+                pool, slots, CompressedWriter(
+                    os.path.join(directory, entry['file']),
+                    self.compression, self.level))
+            return state['writer']
+
+        def split(stdout):
+            target = header
+            for line in iter(stdout.readline, b''):
+                entry = self.section(line)
+                if entry:
+                    target = start_section(entry)
+                elif line.startswith(self.FOOTER_START):
+                    finish_section()
+                    target = footer
+                target.write(line)
+                with self.report_lock:
+                    self.bytes += len(line)
+                self.report()
+                self.limiter.consume(len(line))
+            finish_section()
+
+        try:
+            export_stream(
+                self.install_path,
+                ['--single-transaction'] + self.export_filter(), split)
+            for future in pending:
+                if not future.result():
+                    raise DumpError('Compressor failed')
+        except (DumpError, OSError, IOError):
+            if state['writer']:
+                state['writer'].writer.abort()
+            raise
+        finally:
+            pool.shutdown(wait=True)
+            header.close()
+            footer.close()
+        return tables
+
+
+class IncrementalDump(ParallelDump):
+    """Dumps only the tables that changed since the previous incremental
+    revision in the same directory.
+
+    Tables are fingerprinted before the dump, with CHECKSUM TABLE, or
+    with information_schema metadata when incremental_fingerprint is
+    'metadata' and the table reports an UPDATE_TIME. The manifest links
+    to its parent revision, and each unchanged table names the revision
+    that holds its dump as 'source', so any revision in the chain can be
+    restored on its own. Every incremental_full_every revisions all
+    tables are dumped again, starting a new chain"""
+
+    def __init__(self, client, install_path, file_path, settings,
+                 progress_fd=None):
+        super(IncrementalDump, self).__init__(
+            install_path, file_path, settings, [], progress_fd=progress_fd)
+        self.client = client
+        self.path = dump_base(file_path) + INCREMENTAL_EXTENSION
+        self.fingerprint_mode = settings.get(
+            'incremental_fingerprint', 'checksum')
+        self.full_every = max(1, int(settings.get(
+            'incremental_full_every', 10)))
+        self.fingerprints = {}
+        self.parent = None
+        self.parent_name = None
+
+    def get_fingerprints(self):
+        """Returns {table: fingerprint} for every table"""
+        return table_fingerprints(self.client, self.fingerprint_mode)
+
+    def find_parent(self):
+        """Loads the newest complete incremental revision next to this one
+        whose table sources all still exist"""
+        directory = os.path.dirname(self.path)
+        candidates = []
+        for entry in os.listdir(directory):
+            if not entry.endswith(INCREMENTAL_EXTENSION):
+                continue
+            manifest = read_manifest(os.path.join(directory, entry))
+            if manifest:
+                candidates.append((manifest['created'], entry, manifest))
+        for _created, entry, manifest in sorted(candidates, reverse=True):
+            sources = set(
+                table.get('source', entry) for table in manifest['tables'])
+            if all(os.path.isdir(os.path.join(directory, source))
+                   for source in sources):
+                self.parent, self.parent_name = manifest, entry
+                return
+            L.warning('Revision %s has missing sources, skipping', entry)
+
+    def run(self):
+        """Fingerprints the tables and dumps the changed ones.
+        Returns the revision directory written, or None"""
+        try:
+            self.fingerprints = self.get_fingerprints()
+            self.find_parent()
+        except (DbError, OSError) as error:
+            L.warning('Incremental backup not possible: %s', error)
+            return None
+        previous = {}
+        if self.parent and self.parent.get('chain_length', 0) + 1 < \
+                self.full_every:
+            previous = dict(
+                (table['name'], table) for table in self.parent['tables'])
+        self.table_names = [
+            name for name, fingerprint in self.fingerprints.items()
+            if previous.get(name, {}).get('fingerprint') != fingerprint]
+        self.total_tables = len(self.table_names)
+        self.reused = [
+            table for name, table in previous.items()
+            if name in self.fingerprints and name not in self.table_names]
+        L.debug('Incremental dump of %s: %s changed, %s reused',
+                self.install_path, len(self.table_names), len(self.reused))
+        return super(IncrementalDump, self).run()
+
+    def export_filter(self):
+        """Limits the snapshot dump to the changed tables"""
+        return ['--tables=' + ','.join(self.table_names)]
+
+    def manifest(self, tables):
+        """Adds fingerprints, the reused tables and the chain links"""
+        manifest = super(IncrementalDump, self).manifest(tables)
+        for table in tables:
+            table['fingerprint'] = self.fingerprints.get(table['name'])
+        for table in self.reused:
+            table = dict(table)
+            table.setdefault('source', self.parent_name)
+            manifest['tables'].append(table)
+        manifest['incremental'] = True
+        if self.reused:
+            manifest['parent'] = self.parent_name
+            manifest['chain_length'] = self.parent.get('chain_length', 0) + 1
+        else:
+            manifest['parent'] = None
+            manifest['chain_length'] = 0
+        return manifest
+
+
+def table_fingerprints(client, mode='checksum', tables=None):
+    """Returns {table: fingerprint} for every table, or for the names in
+    tables. The fingerprint changes when the table's data does. In
+    'metadata' mode it is built from information_schema where the engine
+    keeps UPDATE_TIME, otherwise from CHECKSUM TABLE"""
+    fingerprints = {}
+    checksum = []
+    for table in get_table_status(client):
+        name = table['TABLE_NAME']
+        if tables is not None and name not in tables:
+            continue
+        if mode == 'metadata' and table['UPDATE_TIME']:
+            fingerprints[name] = 'meta:' + ':'.join(
+                str(table[key]) for key in (
+                    'CREATE_TIME', 'UPDATE_TIME', 'TABLE_ROWS',
+                    'TABLE_SIZE', 'AUTO_INCREMENT'))
+        else:
+            fingerprints[name] = str(table['CREATE_TIME'])
+            checksum.append(name)
+    if checksum:
+        for row in client.query(
+                'CHECKSUM TABLE ' +
+                ', '.join(quote_name(name) for name in checksum)):
+            name = row['Table'].split('.', 1)[-1]
+            fingerprints[name] = 'sum:%s:%s' % (
+                row['Checksum'], fingerprints.get(name))
+    return fingerprints
+
+
+def read_manifest(path):
+    """Returns the manifest of the dump directory at path, or None if it
+    is incomplete or unreadable"""
+    try:
+        with open(os.path.join(path, MANIFEST)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, IOError, ValueError):
+        return None
+
+
+class QueuedWriter(object):
+    """Hands writes for a CompressedWriter to a thread pool in order, so
+    reading the dump is not held up by compression. Writes are batched to
+    CHUNK_SIZE, and each batch holds one of slots until it is written"""
+
+    def __init__(self, pool, slots, writer):
+        self.pool = pool
+        self.slots = slots
+        self.writer = writer
+        self.buffer = []
+        self.size = 0
+        self.last = None
+
+    def write(self, data):
+        """Queues data to be written"""
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Submits the buffered data after any earlier writes"""
+        data, self.buffer, self.size = b''.join(self.buffer), [], 0
+        previous = self.last
+
+        def write():
+            try:
+                if previous:
+                    previous.result()
+                self.writer.write(data)
+            finally:
+                self.slots.release()
+        self.slots.acquire()
+        self.last = self.pool.submit(write)
+
+    def close(self):
+        """Writes what is left and closes the file. Runs in the pool, so
+        it only waits for this writer's own earlier writes"""
+        if self.buffer:
+            data, self.buffer = b''.join(self.buffer), []
+            if self.last:
+                self.last.result()
+            self.writer.write(data)
+        elif self.last:
+            self.last.result()
+        return self.writer.close()
+
+
+def import_stream(install_path, streams):
+    """Pipes the byte streams, in order, into one `wp db import -`.
+    Returns (stdout, stderr) like Call.wpcli, stderr saying so if the
+    import timed out or was cancelled"""
+    job = Job(wp_args(['db', 'import', '-'], install_path),
+              interactive=True)
+    with tempfile.TemporaryFile() as stdout, \
+            tempfile.TemporaryFile() as stderr:
+        try:
+            proc = job.start(
+                stdin=subprocess.PIPE, stdout=stdout, stderr=stderr)
+            try:
+                for stream in streams:
+                    shutil.copyfileobj(stream, proc.stdin, CHUNK_SIZE)
+            finally:
+                try:
+                    proc.stdin.close()
+                finally:
+                    job.finish()
+        except (OSError, IOError) as error:
+            if not job.reason:
+                return None, str(error)
+        stdout.seek(0)
+        stderr.seek(0)
+        error = stderr.read().decode('UTF-8', 'replace')
+        if job.reason:
+            error = (error + '\n' + job.message()).strip()
+        return stdout.read().decode('UTF-8', 'replace'), error
+
+
+def import_dump(install_path, path):
+    """Imports a compressed dump by streaming it into `wp db import -`.
+    Returns (stdout, stderr) like Call.wpcli"""
+    stream, decompressor = open_dump(path)
+    try:
+        result = import_stream(install_path, [stream])
+    finally:
+        stream.close()
+        if decompressor:
+            decompressor.wait()
+    if result[0] is None:
+        L.warning('Database import of %s failed: %s', path, result[1])
+    return result
+
+
+def entry_streams(entries, wrapper):
+    """Yields the header of wrapper, the uncompressed SQL of each dump
+    directory entry in turn, and the footer. Each file is opened only
+    when it is reached, and closed once it has been read"""
+    yield io.BytesIO(wrapper[0])
+    for entry in entries:
+        stream, decompressor = open_dump(
+            os.path.join(entry['directory'], entry['file']))
+        try:
+            yield stream
+        finally:
+            stream.close()
+            if decompressor:
+                decompressor.wait()
+    yield io.BytesIO(wrapper[1])
+
+
+def import_entries(install_path, entries, wrapper):
+    """Imports entries of a parallel dump, in order, through one
+    `wp db import -`, wrapped in the dump's header and footer"""
+    streams = entry_streams(entries, wrapper)
+    try:
+        return import_stream(install_path, streams)
+    finally:
+        streams.close()
+
+
+def read_wrapper(directory):
+    """Returns the (header, footer) SQL of a snapshot dump directory"""
+    wrapper = []
+    for name in ('header.sql', 'footer.sql'):
+        part_path = os.path.join(directory, name)
+        if os.path.isfile(part_path):
+            with open(part_path, 'rb') as part:
+                wrapper.append(part.read())
+        else:
+            wrapper.append(b'')
+    return tuple(wrapper)
+
+
+def import_dump_dir(install_path, directory, workers=4):
+    """Imports a parallel or incremental dump, restoring up to workers
+    tables concurrently. Tables of an incremental dump are read from the
+    revision named by their 'source'. Views, events and routines are
+    restored after every table has been.
+    Returns (stdout, stderr) like Call.wpcli"""
+    manifest = read_manifest(directory)
+    if not manifest:
+        return None, 'No manifest in ' + directory
+    parent_dir = os.path.dirname(directory.rstrip(os.sep))
+    sources = {}
+    for table in manifest['tables']:
+        source = table.get('source')
+        source_dir = os.path.join(parent_dir, source) if source \
+            else directory
+        if source_dir not in sources:
+            if source and not read_manifest(source_dir):
+                return None, 'Revision %s of %s is missing' % (
+                    source, directory)
+            sources[source_dir] = read_wrapper(source_dir)
+        table['directory'] = source_dir
+    tables = [table for table in manifest['tables'] if 'kind' not in table]
+    later = [table for table in manifest['tables'] if 'kind' in table]
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+        results = list(pool.map(
+            lambda table: (table['name'], import_entries(
+                install_path, [table], sources[table['directory']])),
+            tables))
+    errors = [
+        '%s: %s' % (name, error.strip())
+        for name, (output, error) in results
+        if output is None or 'Success' not in output]
+    if later and not errors:
+        # views may select from any table, and each other, so they are
+        # created in dump order once all tables exist
+        output, error = import_entries(
+            install_path, later, sources[later[0]['directory']])
+        if output is None or 'Success' not in output:
+            errors.append('views: ' + error.strip())
+    if errors:
+        L.warning('Parallel import of %s failed: %s', directory, errors)
+        return None, '\n'.join(errors)
+    return ("Success: Imported %s tables from '%s'." % (
+        len(results), directory), '')
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""Database search over direct database connections.
+
+Replaces `wp db search`, which holds every match in memory before
+printing. Text columns of all tables are searched in parallel, each
+worker on its own connection, with a LIKE (or REGEXP, for /queries/)
+prefilter, reading rows in primary key batches. Matches are produced
+by a generator as they are found, so the first page shows while the
+rest of the database is still being searched, and the search can be
+cancelled between batches."""
+import re
+from weakref import WeakSet
+from queue import Queue, Empty, Full
+from threading import Thread, Event, Lock, local
+from concurrent.futures import ThreadPoolExecutor
+from logmod import Log
+from database import DbError, quote_name
+
+L = Log()
+
+TEXT_TYPES = (
+    'char', 'varchar', 'tinytext', 'text', 'mediumtext', 'longtext')
+# marks the end of a table in the results queue
+TABLE_DONE = object()
+
+
+class DbSearchEngine(object):
+    """A search of every text column of a database for query.
+
+    connect is called to open one client per worker thread. settings is
+    the settings.database section. A query written as /pattern/ is a
+    MySQL regular expression, anything else is matched literally, and
+    both ignore case the way the columns' collations do"""
+    # searches not yet finished, so they can be stopped on exit
+    engines = WeakSet()
+
+    def __init__(self, connect, query, settings):
+        self.connect = connect
+        self.regex = len(query) > 2 and query[0] == query[-1] == '/'
+        self.query = query[1:-1] if self.regex else query
+        self.workers = max(1, int(settings.get('search_workers', 4)))
+        self.batch_size = max(1, int(settings.get('search_batch', 500)))
+        self.context = int(settings.get('search_context', 40))
+        self.cancelled = Event()
+        self.finished = False
+        # set when cancel stopped the search before the end
+        self.stopped = False
+        self.queue = Queue(maxsize=self.batch_size)
+        self.local = local()
+        self.clients = []
+        self.lock = Lock()
+        self.generator = None
+        self.pages = []
+        self.page_lock = Lock()
+        DbSearchEngine.engines.add(self)
+
+    def client(self):
+        """Returns the calling thread's client"""
+        if not getattr(self.local, 'client', None):
+            self.local.client = self.connect()
+            with self.lock:
+                self.clients.append(self.local.client)
+        return self.local.client
+
+    def condition(self, column):
+        """Returns SQL that is true when column matches the query"""
+        if self.regex:
+            return '%s REGEXP %%s' % quote_name(column)
+        return '%s LIKE %%s' % quote_name(column)
+
+    def argument(self):
+        """Returns the query as the argument of condition"""
+        if self.regex:
+            return self.query
+        return '%' + self.query.replace('\\', '\\\\').replace(
+            '%', '\\%').replace('_', '\\_') + '%'
+
+    def tables(self):
+        """Returns (table, primary key columns, text columns) of every
+        base table with text columns"""
+        rows = self.client().query(
+            "SELECT c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE, c.COLUMN_KEY "
+            "FROM information_schema.COLUMNS c "
+            "JOIN information_schema.TABLES t "
+            "ON t.TABLE_SCHEMA = c.TABLE_SCHEMA "
+            "AND t.TABLE_NAME = c.TABLE_NAME "
+            "WHERE c.TABLE_SCHEMA = DATABASE() "
+            "AND t.TABLE_TYPE = 'BASE TABLE' "
+            "ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION")
+        tables = {}
+        for row in rows:
+            primary, columns = tables.setdefault(
+                row['TABLE_NAME'], ([], []))
+            if row['COLUMN_KEY'] == 'PRI':
+                primary.append(row['COLUMN_NAME'])
+            if row['DATA_TYPE'].lower() in TEXT_TYPES:
+                columns.append(row['COLUMN_NAME'])
+        return [(table, primary, columns)
+                for table, (primary, columns) in sorted(tables.items())
+                if columns]
+
+    def search_table(self, table, primary, columns):
+        """Yields the matches in table, in primary key order, as dicts
+        of 'table', 'column', 'row' and 'value'. Tables without a primary
+        key are read by offset"""
+        client = self.client()
+        argument = self.argument()
+        matches = ', '.join(
+            '%s AS %s' % (self.condition(column),
+                          quote_name('match_%d' % index))
+            for index, column in enumerate(columns))
+        selected = primary + [
+            column for column in columns if column not in primary]
+        select = 'SELECT %s, %s FROM %s WHERE (%s)' % (
+            ', '.join(quote_name(column) for column in selected),
+            matches, quote_name(table),
+            ' OR '.join(self.condition(column) for column in columns))
+        select_args = [argument] * (len(columns) * 2)
+        key_list = ', '.join(quote_name(column) for column in primary)
+        last = None
+        offset = 0
+        while not self.cancelled.is_set():
+            sql = select
+            args = list(select_args)
+            if primary:
+                if last is not None:
+                    sql += ' AND (%s) > (%s)' % (
+                        key_list, ', '.join(['%s'] * len(primary)))
+                    args += last
+                sql += ' ORDER BY %s LIMIT %d' % (key_list, self.batch_size)
+            else:
+                sql += ' LIMIT %d OFFSET %d' % (self.batch_size, offset)
+                offset += self.batch_size
+            batch = client.query(sql, args)
+            for row in batch:
+                row_id = ','.join(str(row[column]) for column in primary)
+                for index, column in enumerate(columns):
+                    if row['match_%d' % index] == '1':
+                        yield {
+                            'table': table,
+                            'column': column,
+                            'row': row_id,
+                            'value': self.snippet(row[column] or '')
+                        }
+            if len(batch) < self.batch_size:
+                return
+            if primary:
+                last = [batch[-1][column] for column in primary]
+
+    def snippet(self, value):
+        """Returns the part of value around the first match"""
+        if self.regex:
+            try:
+                match = re.search(self.query, value, re.IGNORECASE)
+            except re.error:
+                match = None
+            start = match.start() if match else 0
+        else:
+            start = max(0, value.lower().find(self.query.lower()))
+        begin = max(0, start - self.context)
+        end = start + len(self.query) + self.context
+        return '%s%s%s' % (
+            '...' if begin else '', value[begin:end],
+            '...' if end < len(value) else '')
+
+    def put(self, item):
+        """Queues item for the results generator, unless cancelled"""
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=0.2)
+                return True
+            except Full:
+                continue
+        return False
+
+    def worker(self, table, primary, columns):
+        """Searches one table on a pool thread"""
+        try:
+            for result in self.search_table(table, primary, columns):
+                if not self.put(result):
+                    return
+        except DbError as error:
+            L.warning('DB search of %s failed: %s', table, error)
+        finally:
+            self.put(TABLE_DONE)
+
+    def results(self):
+        """Yields every match, as the workers find them"""
+        pool = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='db_search')
+        try:
+            tables = self.tables()
+            for table in tables:
+                pool.submit(self.worker, *table)
+            remaining = len(tables)
+            while remaining and not self.cancelled.is_set():
+                try:
+                    item = self.queue.get(timeout=0.2)
+                except Empty:
+                    continue
+                if item is TABLE_DONE:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            self.finished = True
+            self.cancelled.set()
+            # workers stop after their current batch, don't wait for them
+            Thread(target=self.close, args=[pool], name='db_search_close',
+                   daemon=True).start()
+
+    def close(self, pool):
+        """Closes the clients once the workers have stopped"""
+        pool.shutdown(wait=True)
+        for client in self.clients:
+            client.close()
+
+    def page(self, index, size):
+        """Returns (matches on page index, whether there may be more).
+        Pages are read from the generator as they are asked for, and kept
+        for paging back"""
+        with self.page_lock:
+            return self.read_page(index, size)
+
+    def read_page(self, index, size):
+        """Does the work of page, with page_lock held"""
+        if self.generator is None:
+            self.generator = self.results()
+        while len(self.pages) <= index and not self.finished:
+            page = []
+            try:
+                while len(page) < size:
+                    page.append(next(self.generator))
+            except StopIteration:
+                pass
+            except DbError as error:
+                L.warning('DB search failed: %s', error)
+                self.cancel()
+            if page or not self.pages:
+                self.pages.append(page)
+            if len(page) < size:
+                break
+        if index >= len(self.pages):
+            return [], False
+        more = index + 1 < len(self.pages) or not self.finished
+        return self.pages[index], more
+
+    def cancel(self):
+        """Stops the search. Matches already found stay pageable"""
+        if not self.finished:
+            self.stopped = True
+        self.cancelled.set()
+        # a suspended generator only ends when resumed, so end it here
+        # unless page is reading from it
+        if self.page_lock.acquire(blocking=False):
+            try:
+                if self.generator is not None:
+                    self.generator.close()
+                self.finished = True
+            finally:
+                self.page_lock.release()
+
+    @classmethod
+    def cancel_all(cls):
+        """Stops every search, whose workers would otherwise wait for
+        their results to be read"""
+        for engine in list(cls.engines):
+            engine.cancel()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Operations run across many installations at once.
+
+Installations are marked for the fleet in the Installs view, and the
+Fleet view runs one operation on each of them through a JobQueue. The
+steps of an installation form a group, so at most installation_limit of
+them change it at once, while the wpcli and database limits of the fleet
+section in settings.json bound the PHP processes and database scans
+running across the whole fleet. Operations that change an installation
+first back up its database, and the plugins or themes they update, as a
+revision of that installation; if the backup fails, the change is
+skipped. An installation that fails does not stop the others; its row in
+the summary says why."""
+import os
+from collections import OrderedDict
+from logmod import Log
+from jobs import DONE
+from jobqueue import JobQueue, TaskFailed
+from database import DbConnections, DbError
+from searchreplace import SearchReplaceEngine
+from wpconfig_parser import WpConfigEditor, WpConfigParseError
+from wpcli import Call, ListingCache
+
+L = Log()
+
+# label, the fields the operator fills in, the resource each step
+# takes a slot of, and what is backed up before the change: None for
+# nothing, otherwise the database along with the plugin named in the
+# first field, all plugins or all themes
+OPERATIONS = OrderedDict([
+    ('plugin-update', ('Update plugin', ['Plugin'], 'wpcli', 'plugin')),
+    ('plugin-update-all', ('Update all plugins', [], 'wpcli', 'plugins')),
+    ('theme-update-all', ('Update all themes', [], 'wpcli', 'themes')),
+    ('core-update', ('Update WordPress core', [], 'wpcli', 'database')),
+    ('config-set', ('Set wp-config directive', ['Directive', 'Value'],
+                    'wpcli', 'database')),
+    ('search-replace-dry-run', ('Search-replace dry run',
+                                ['Search', 'Replace'], 'database', None)),
+    ('search-replace', ('Search-replace', ['Search', 'Replace'],
+                        'database', 'database'))
+])
+
+
+def last_line(*outputs):
+    """Returns the last non blank line of outputs"""
+    lines = [line for output in outputs for line in output.splitlines()
+             if line.strip()]
+    return lines[-1].strip() if lines else ''
+
+
+class FleetOperation(object):
+    """One of OPERATIONS, with the values of its fields, run on one
+    installation at a time by run"""
+
+    def __init__(self, app, operation, values):
+        if operation not in OPERATIONS:
+            raise ValueError('Unknown fleet operation %s' % operation)
+        self.app = app
+        self.operation = operation
+        self.label, self.fields, self.resource, self.backup = OPERATIONS[
+            operation]
+        self.values = list(values)
+        if self.operation in ('plugin-update', 'config-set'):
+            # names, unlike search terms, can't hold spaces at the ends
+            self.values[0] = self.values[0].strip()
+        if len(self.values) != len(self.fields) or \
+                (self.values and not self.values[0]):
+            raise ValueError('%s needs %s' % (
+                self.label, ', '.join(self.fields)))
+
+    def describe(self):
+        """Returns the operation and its values as one line"""
+        if not self.values:
+            return self.label
+        return '%s: %s' % (self.label, ' -> '.join(self.values))
+
+    def backup_source(self, install_path):
+        """Returns (kind, name, path) of the plugins or themes backed up
+        with the database before the operation changes install_path, or
+        (None, None, None) if only the database is. Raises TaskFailed if
+        the path can not be found"""
+        if self.backup == 'plugin':
+            return 'plugin', self.values[0], self.wp_path(
+                install_path, ['plugin', 'path', self.values[0], '--dir'])
+        if self.backup == 'plugins':
+            return 'plugin', 'all_plugins', self.wp_path(
+                install_path, ['plugin', 'path', '--dir'])
+        if self.backup == 'themes':
+            return 'theme', 'all_themes', self.wp_path(
+                install_path, ['theme', 'path'])
+        return None, None, None
+
+    def wp_path(self, install_path, arguments):
+        """Returns the path printed by a `wp ... path` command"""
+        result, error = Call.wpcli(
+            self.app, arguments, install_path=install_path)
+        if not result or not result.strip():
+            raise TaskFailed('Backup failed: %s' % (
+                last_line(error) or 'path not found'))
+        return result.strip()
+
+    def run(self, install_path):
+        """Runs the operation on install_path. A JobQueue task: returns
+        a message, or raises TaskFailed"""
+        try:
+            if self.operation == 'plugin-update':
+                return self.wpcli(install_path,
+                                  ['plugin', 'update', self.values[0]])
+            if self.operation == 'plugin-update-all':
+                return self.wpcli(install_path,
+                                  ['plugin', 'update', '--all'])
+            if self.operation == 'theme-update-all':
+                return self.wpcli(install_path, ['theme', 'update', '--all'])
+            if self.operation == 'core-update':
+                self.wpcli(install_path, ['core', 'update'])
+                return self.wpcli(install_path, ['core', 'update-db'])
+            if self.operation == 'config-set':
+                return self.set_config(install_path, *self.values)
+            return self.search_replace(
+                install_path, self.values[0], self.values[1],
+                self.operation == 'search-replace-dry-run')
+        finally:
+            # the installation changed behind the caches' backs
+            ListingCache.forget(install_path)
+            workers = Call.get_workers(self.app)
+            if workers:
+                workers.recycle(install_path)
+
+    def wpcli(self, install_path, arguments):
+        """Runs a wp-cli command on install_path. Returns its last line
+        of output, or raises TaskFailed with it"""
+        result, error, status = Call.run_job(
+            self.app, arguments, install_path)
+        if status != DONE:
+            raise TaskFailed(last_line(result, error) or status)
+        return last_line(result, error) or 'Done'
+
+    def set_config(self, install_path, name, value):
+        """Sets a wp-config.php directive by editing the file, or with
+        `wp config set` if it can not be edited statically"""
+        editor = WpConfigEditor(os.path.join(install_path, 'wp-config.php'))
+        editor.set(name, value)
+        try:
+            results = editor.apply()
+        except (WpConfigParseError, OSError) as error:
+            L.warning('%s wp-config.php edit failed, using wp-cli: %s',
+                      install_path, error)
+            return self.wpcli(install_path, ['config', 'set', name, value])
+        finally:
+            if name.startswith('DB_'):
+                DbConnections.close(install_path)
+        if not results.get(name):
+            raise TaskFailed('%s was not set' % name)
+        return '%s set' % name
+
+    def search_replace(self, install_path, search, replace, dry_run):
+        """Replaces search with replace throughout the database, over a
+        direct connection when possible, otherwise with `wp
+        search-replace`"""
+        settings = getattr(self.app.settings, 'database', {})
+        if settings.get('native_search_replace', False) and \
+                DbConnections.get(self.app, install_path):
+            queue = JobQueue.current()
+            engine = SearchReplaceEngine(
+                lambda: DbConnections.connect(
+                    self.app, install_path, settings),
+                search, replace, settings, dry_run=dry_run,
+                cancelled=lambda: queue is not None and queue.cancelled)
+            try:
+                results = engine.run()
+            except (DbError, WpConfigParseError, OSError) as error:
+                raise TaskFailed(str(error))
+            if not dry_run:
+                self.wpcli(install_path, ['cache', 'flush'])
+            return '%s %s in %s columns' % (
+                results['count'],
+                'matches' if dry_run else 'replacements',
+                len([result for result in results['results']
+                     if result['count'] != '0']))
+        arguments = ['search-replace', search, replace, '--all-tables',
+                     '--precise']
+        if dry_run:
+            arguments.append('--dry-run')
+        return self.wpcli(install_path, arguments)
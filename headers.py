@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Plugin and theme headers read straight from disk.
+
+WordPress learns a plugin's name, version and description from the
+comment block at the top of its main file, and a theme's from style.css,
+reading only the first 8 KB of each with get_file_data. The scanner does
+the same, so plugins and themes can be described without bootstrapping
+WordPress through wp-cli. Directories are scanned in parallel. Whether a
+plugin or theme is active, or has an update, is not in the headers, and
+is left to the caller."""
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from logmod import Log
+from wpconfig_parser import WpConfigParser, WpConfigParseError
+
+L = Log()
+
+# get_file_data reads no further than this
+HEADER_BYTES = 8192
+PLUGIN_HEADERS = {
+    'Name': 'Plugin Name',
+    'PluginURI': 'Plugin URI',
+    'Version': 'Version',
+    'Description': 'Description',
+    'Author': 'Author',
+    'AuthorURI': 'Author URI',
+    'TextDomain': 'Text Domain',
+    'DomainPath': 'Domain Path',
+    'Network': 'Network',
+    'RequiresWP': 'Requires at least',
+    'RequiresPHP': 'Requires PHP',
+    'UpdateURI': 'Update URI',
+    'RequiresPlugins': 'Requires Plugins'
+}
+THEME_HEADERS = {
+    'Name': 'Theme Name',
+    'ThemeURI': 'Theme URI',
+    'Description': 'Description',
+    'Author': 'Author',
+    'AuthorURI': 'Author URI',
+    'Version': 'Version',
+    'Template': 'Template',
+    'Status': 'Status',
+    'Tags': 'Tags',
+    'TextDomain': 'Text Domain',
+    'DomainPath': 'Domain Path',
+    'RequiresWP': 'Requires at least',
+    'RequiresPHP': 'Requires PHP',
+    'UpdateURI': 'Update URI'
+}
+HEADER_PATTERNS = dict(
+    (header, re.compile(
+        r'^(?:[ \t]*<\?php)?[ \t/*#@]*' + re.escape(header) + r':(.*)$',
+        re.MULTILINE | re.IGNORECASE))
+    for header in set(PLUGIN_HEADERS.values()) | set(THEME_HEADERS.values()))
+# what _cleanup_header_comment strips from the end of a value
+COMMENT_END_RE = re.compile(r'\s*(?:\*/|\?>).*')
+
+
+def get_file_data(path, headers):
+    """Returns {key: value} for the headers, {key: header name}, found
+    in the first HEADER_BYTES of path. Missing headers are ''"""
+    with open(path, 'rb') as header_file:
+        data = header_file.read(HEADER_BYTES)
+    text = data.decode('UTF-8', 'replace').replace('\r', '\n')
+    values = {}
+    for key, header in headers.items():
+        match = HEADER_PATTERNS[header].search(text)
+        values[key] = COMMENT_END_RE.sub(
+            '', match.group(1)).strip() if match else ''
+    return values
+
+
+def content_roots(install_path):
+    """Returns (plugin root, theme root) of the installation, from the
+    WP_PLUGIN_DIR and WP_CONTENT_DIR constants in wp-config.php where
+    they are set to a path, or None for a root that can't be known
+    without WordPress"""
+    content_dir = os.path.join(install_path, 'wp-content')
+    plugin_dir = None
+    try:
+        config = os.path.join(install_path, 'wp-config.php')
+        constant = WpConfigParser.get_constant(config, 'WP_CONTENT_DIR')
+        if constant is not None:
+            content_dir = constant if isinstance(constant, str) and \
+                os.path.isabs(constant) else None
+        constant = WpConfigParser.get_constant(config, 'WP_PLUGIN_DIR')
+        if constant is not None:
+            plugin_dir = constant if isinstance(constant, str) and \
+                os.path.isabs(constant) else False
+    except (WpConfigParseError, OSError) as error:
+        L.debug('Content roots of %s not read: %s', install_path, error)
+        return None, None
+    if plugin_dir is None and content_dir:
+        plugin_dir = os.path.join(content_dir, 'plugins')
+    theme_dir = os.path.join(content_dir, 'themes') if content_dir else None
+    return plugin_dir or None, theme_dir
+
+
+def plugin_files(root, name):
+    """Returns the candidate main files of the plugin name under root:
+    the PHP files at the top of its directory, or name.php"""
+    directory = os.path.join(root, name)
+    if os.path.isdir(directory):
+        return sorted(
+            os.path.join(directory, entry) for entry in os.listdir(directory)
+            if entry.endswith('.php'))
+    single = os.path.join(root, name + '.php')
+    return [single] if os.path.isfile(single) else []
+
+
+def read_plugin(root, name):
+    """Returns the headers of the plugin name under root, with 'File',
+    its main file relative to root as active_plugins stores it, or None
+    if no file of it has a Plugin Name header"""
+    for path in plugin_files(root, name):
+        try:
+            plugin = get_file_data(path, PLUGIN_HEADERS)
+        except (OSError, IOError) as error:
+            L.debug('Unreadable plugin file %s: %s', path, error)
+            continue
+        if plugin['Name']:
+            plugin['File'] = os.path.relpath(path, root)
+            return plugin
+    return None
+
+
+def read_theme(root, name):
+    """Returns the style.css headers of the theme name under root, or
+    None if it has no Theme Name header"""
+    path = os.path.join(root, name, 'style.css')
+    try:
+        theme = get_file_data(path, THEME_HEADERS)
+    except (OSError, IOError):
+        return None
+    return theme if theme['Name'] else None
+
+
+def scan(root, read, workers=8):
+    """Returns {name: headers} for every plugin or theme under root,
+    reading the directories in parallel. read is read_plugin or
+    read_theme"""
+    try:
+        names = [
+            entry[:-4] if entry.endswith('.php') else entry
+            for entry in os.listdir(root)
+            if not entry.startswith('.') and (
+                entry.endswith('.php') or
+                os.path.isdir(os.path.join(root, entry)))]
+    except OSError as error:
+        L.warning('Could not scan %s: %s', root, error)
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, workers),
+                            thread_name_prefix='header_scan') as pool:
+        found = pool.map(lambda name: (name, read(root, name)), names)
+        return dict((name, headers) for name, headers in found if headers)
+
+
+def scan_plugins(root, workers=8):
+    """Returns {name: headers} for every plugin under root"""
+    return scan(root, read_plugin, workers)
+
+
+def scan_themes(root, workers=8):
+    """Returns {name: headers} for every theme under root"""
+    return scan(root, read_theme, workers)
+
+
+def is_multisite(install_path):
+    """True if wp-config.php enables multisite, where network activation
+    also decides a plugin's status"""
+    try:
+        return bool(WpConfigParser.get_constant(
+            os.path.join(install_path, 'wp-config.php'), 'MULTISITE'))
+    except (WpConfigParseError, OSError):
+        return True
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""Queue of the steps of bulk plugin and theme operations.
+
+Each task names the tasks it must run after, and a resource: 'backup',
+'download', 'wpcli' or 'database'. A task starts once everything it runs
+after is done and its resource has a free slot, so independent steps,
+like the backups and downloads of different plugins, run in parallel up
+to the configured limits, while wp-cli changes to an installation run one
+at a time. Tasks can also belong to a group, such as the installation
+they change, with at most group_limit of a group running at once. A task
+whose prerequisite fails is skipped. Cancelling a queue, with the cancel
+key in the view showing it, cancels the tasks not started yet and stops
+the wp-cli jobs of those running; other queues carry on."""
+import os
+import time
+from weakref import WeakSet
+from collections import OrderedDict
+from threading import Condition, Lock
+from concurrent.futures import ThreadPoolExecutor
+from logmod import Log
+from jobs import Job
+
+L = Log()
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+CANCELLED = 'cancelled'
+RESOURCES = ('backup', 'download', 'wpcli', 'database')
+
+
+class TaskFailed(Exception):
+    """Raised by a task's function to fail it with a message"""
+
+
+class QueueTask(object):
+    """One step of a JobQueue"""
+
+    def __init__(self, task_id, label, func, resource, after, group=None):
+        self.task_id = task_id
+        self.label = label
+        self.func = func
+        self.resource = resource
+        self.after = list(after)
+        self.group = group
+        self.status = PENDING
+        self.message = ''
+        self.started = None
+        self.finished = None
+
+    def duration(self):
+        """Returns the seconds the task ran for, so far"""
+        if not self.started:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+
+class JobQueue(object):
+    """Runs tasks in dependency order, with at most limits[resource]
+    running at once per resource, and at most group_limit per group if
+    it is set. Tasks added before start run once it is called; tasks can
+    be added until the queue has finished. progress_fd, if given, is
+    written a byte whenever a task changes status, for a watch_pipe
+    callback to show rows, and is closed once the queue has finished"""
+    # queues not yet finished, so they can be cancelled on exit
+    queues = WeakSet()
+
+    def __init__(self, limits=None, progress_fd=None, group_limit=0):
+        limits = limits or {}
+        self.limits = dict(
+            (resource, max(1, int(limits.get(resource, 1))))
+            for resource in RESOURCES)
+        self.progress_fd = progress_fd
+        self.progress_lock = Lock()
+        self.tasks = OrderedDict()
+        self.running = dict((resource, 0) for resource in RESOURCES)
+        self.group_limit = int(group_limit or 0)
+        self.group_running = {}
+        self.condition = Condition()
+        self.started = None
+        self.ended = None
+        self.closed = False
+        self.cancelled = False
+        # operations adding their steps, which keep the queue open
+        self.holds = 0
+        self.pool = ThreadPoolExecutor(
+            max_workers=sum(self.limits.values()),
+            thread_name_prefix='job_queue')
+        JobQueue.queues.add(self)
+
+    def add(self, task_id, label, func, resource='wpcli', after=(),
+            group=None):
+        """Adds a task. func is called with no arguments, and returns a
+        message, or raises TaskFailed. after lists the ids of tasks, added
+        before, that must be done first. A task_id used before may be
+        added again once its task has finished, and it runs again.
+        Returns False if the queue has finished or been cancelled"""
+        if resource not in RESOURCES:
+            raise ValueError('Unknown resource %s' % resource)
+        with self.condition:
+            if self.closed or self.cancelled:
+                return False
+            unknown = [name for name in after if name not in self.tasks]
+            if unknown:
+                raise ValueError('%s runs after unknown tasks %s' % (
+                    task_id, unknown))
+            if self.active(task_id):
+                raise ValueError('%s is already queued' % task_id)
+            # a new attempt at a finished task is listed last
+            self.tasks.pop(task_id, None)
+            self.tasks[task_id] = QueueTask(
+                task_id, label, func, resource, after, group)
+            started = self.started
+        if started:
+            self.dispatch()
+        return True
+
+    def active(self, task_id):
+        """True if the task task_id is waiting to run or running"""
+        with self.condition:
+            task = self.tasks.get(task_id)
+            return task is not None and task.status in (PENDING, RUNNING)
+
+    def hold(self):
+        """Keeps the queue open while an operation adds its steps, even
+        if every task added before finishes meanwhile. Returns False if
+        the queue has already finished or been cancelled; otherwise
+        release must be called once the steps are added"""
+        with self.condition:
+            if self.closed or self.cancelled:
+                return False
+            self.holds += 1
+            return True
+
+    def release(self):
+        """Ends a hold"""
+        with self.condition:
+            self.holds -= 1
+        self.dispatch()
+
+    def cancel(self):
+        """Cancels the tasks not started yet, and stops the jobs of those
+        running"""
+        with self.condition:
+            if self.closed:
+                return
+            self.cancelled = True
+        self.dispatch()
+        Job.stop_owned(self)
+
+    @classmethod
+    def cancel_all(cls):
+        """Cancels every queue, on exit"""
+        for queue in list(cls.queues):
+            queue.cancel()
+
+    @staticmethod
+    def current():
+        """Returns the queue whose task the calling thread is running, or
+        None"""
+        return getattr(Job.context, 'owner', None)
+
+    def start(self):
+        """Starts running the tasks added so far, and those added later"""
+        with self.condition:
+            if self.started is None:
+                self.started = time.time()
+        self.dispatch()
+
+    def dispatch(self):
+        """Starts every task that can run now, and closes the queue once
+        nothing is left to run"""
+        changed = False
+        with self.condition:
+            for task in self.tasks.values():
+                if task.status != PENDING:
+                    continue
+                statuses = [self.tasks[name].status for name in task.after]
+                if self.cancelled:
+                    self.settle(task, CANCELLED, 'Cancelled')
+                elif any(status in (FAILED, SKIPPED, CANCELLED)
+                         for status in statuses):
+                    self.settle(task, SKIPPED, 'A step before it failed')
+                elif all(status == DONE for status in statuses) and \
+                        self.running[task.resource] < \
+                        self.limits[task.resource] and \
+                        self.group_free(task.group):
+                    task.status = RUNNING
+                    task.started = time.time()
+                    self.running[task.resource] += 1
+                    self.group_running[task.group] = \
+                        self.group_running.get(task.group, 0) + 1
+                    self.pool.submit(self.run, task)
+                else:
+                    continue
+                changed = True
+            if not self.closed and not self.holds and all(
+                    task.status not in (PENDING, RUNNING)
+                    for task in self.tasks.values()):
+                self.closed = True
+                self.ended = time.time()
+                changed = True
+                self.condition.notify_all()
+        if changed:
+            self.changed()
+        if self.closed:
+            self.pool.shutdown(wait=False)
+
+    def group_free(self, group):
+        """True if another task of group can start. Called with
+        condition held"""
+        return group is None or not self.group_limit or \
+            self.group_running.get(group, 0) < self.group_limit
+
+    @staticmethod
+    def settle(task, status, message):
+        """Ends a task that did not run"""
+        task.status = status
+        task.message = message
+        task.finished = time.time()
+
+    def run(self, task):
+        """Runs a task on the pool"""
+        # the jobs the task starts are the queue's to stop
+        Job.context.owner = self
+        try:
+            message = task.func()
+            status = DONE
+        except TaskFailed as error:
+            message, status = str(error), FAILED
+        except Exception as error:  # pylint: disable=broad-except
+            L.warning('Task %s failed: %s', task.task_id, error)
+            message, status = 'Error: %s' % error, FAILED
+        finally:
+            Job.context.owner = None
+        with self.condition:
+            task.status = status
+            task.message = message or ''
+            task.finished = time.time()
+            self.running[task.resource] -= 1
+            self.group_running[task.group] -= 1
+        self.dispatch()
+
+    def changed(self):
+        """Writes to progress_fd that a task changed, closing it after
+        the queue's last change"""
+        with self.progress_lock:
+            if self.progress_fd is None:
+                return
+            try:
+                os.write(self.progress_fd, b'.')
+            except OSError as error:
+                L.warning('Job queue progress not shown: %s', error)
+            if self.closed:
+                os.close(self.progress_fd)
+                self.progress_fd = None
+
+    def wait(self):
+        """Blocks until every task has finished"""
+        with self.condition:
+            while not self.closed:
+                self.condition.wait()
+
+    def rows(self):
+        """Returns (label, status, message, seconds) of every task, in
+        the order they were added"""
+        with self.condition:
+            return [(task.label, task.status, task.message, task.duration())
+                    for task in self.tasks.values()]
+
+    def records(self):
+        """Returns a dict of the group, label, status, message and
+        seconds of every task, in the order they were added"""
+        with self.condition:
+            return [{'group': task.group or '', 'label': task.label,
+                     'status': task.status, 'message': task.message,
+                     'seconds': task.duration()}
+                    for task in self.tasks.values()]
+
+    def summary(self):
+        """Returns a line counting the tasks by status"""
+        with self.condition:
+            counts = OrderedDict()
+            for task in self.tasks.values():
+                counts[task.status] = counts.get(task.status, 0) + 1
+        return '%s in %.1fs' % (', '.join(
+            '%s %s' % (count, status) for status, count in counts.items()),
+            (self.ended or time.time()) - (self.started or time.time()))
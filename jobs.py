@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""wp-cli processes run as jobs, with timeouts and cancellation.
+
+Each job runs in a process group of its own, so stopping it also stops
+whatever wp-cli started, like mysqldump or a download. A job is stopped
+with SIGTERM, then SIGKILL if the group is still there grace_period
+seconds later. It ends with one of the statuses done, failed, timed-out
+or cancelled.
+
+Timeouts are configured per command in settings.json's jobs section,
+keyed by the command's leading words, e.g. "db export" or "plugin
+update". Interactive jobs are those whose output a view is waiting for;
+the cancel key stops them, except for those started by the tasks of a
+JobQueue, which cancelling that queue stops."""
+import os
+import signal
+import subprocess
+from threading import Lock, Timer, local
+from logmod import Log
+
+L = Log()
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+TIMED_OUT = 'timed-out'
+CANCELLED = 'cancelled'
+
+
+class Job(object):
+    """A command run with a timeout, that can be stopped from another
+    thread. popen_args is the command line. Options, like the timeouts,
+    are set once for all jobs with Job.configure"""
+    settings = {}
+    active = set()
+    active_lock = Lock()
+    # counts presses of the cancel key, so work that has not started a
+    # job yet can tell it was cancelled meanwhile
+    cancellations = 0
+    # owner is the JobQueue whose task the thread is running
+    context = local()
+
+    def __init__(self, popen_args, interactive=False, timeout=None):
+        self.args = popen_args
+        self.interactive = interactive
+        self.timeout = timeout if timeout is not None else self.get_timeout(
+            popen_args)
+        self.grace_period = self.settings.get('grace_period', 5)
+        self.proc = None
+        self.status = None
+        self.reason = None
+        self.timer = None
+        self.killer = None
+        self.lock = Lock()
+        self.owner = getattr(Job.context, 'owner', None)
+
+    @classmethod
+    def configure(cls, settings):
+        """Sets the jobs section of settings.json"""
+        cls.settings = settings or {}
+
+    @classmethod
+    def get_timeout(cls, popen_args):
+        """Returns the timeout for a wp-cli command line: the entry of
+        the timeouts setting matching most of its leading words, or the
+        default timeout"""
+        words = [arg for arg in popen_args[1:] if not arg.startswith('-')]
+        timeouts = cls.settings.get('timeouts', {})
+        for length in range(len(words), 0, -1):
+            key = ' '.join(words[:length])
+            if key in timeouts:
+                return timeouts[key]
+        return cls.settings.get('timeout', 0)
+
+    def start(self, **popen_options):
+        """Starts the process. popen_options are passed to Popen"""
+        self.proc = subprocess.Popen(
+            self.args, start_new_session=True, **popen_options)
+        self.status = RUNNING
+        with Job.active_lock:
+            Job.active.add(self)
+        if self.timeout:
+            self.timer = Timer(self.timeout, self.stop, [TIMED_OUT])
+            self.timer.daemon = True
+            self.timer.start()
+        return self.proc
+
+    def signal_group(self, signum):
+        """Sends signum to the job's process group"""
+        try:
+            os.killpg(self.proc.pid, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def stop(self, reason=CANCELLED):
+        """Stops the job: SIGTERM, then SIGKILL after grace_period"""
+        with self.lock:
+            if self.status != RUNNING or self.reason:
+                return
+            self.reason = reason
+        L.warning('Stopping %s: %s', self.args, reason)
+        self.signal_group(signal.SIGTERM)
+        self.killer = Timer(self.grace_period, self.signal_group,
+                            [signal.SIGKILL])
+        self.killer.daemon = True
+        self.killer.start()
+
+    def finish(self):
+        """Records the status once the process has exited"""
+        returncode = self.proc.wait()
+        for timer in (self.timer, self.killer):
+            if timer:
+                timer.cancel()
+        with Job.active_lock:
+            Job.active.discard(self)
+        if self.reason:
+            # children may outlive the group leader
+            self.signal_group(signal.SIGKILL)
+        with self.lock:
+            self.status = self.reason or (DONE if returncode == 0
+                                          else FAILED)
+        if self.status != DONE:
+            L.warning('Job %s %s, exit status %s',
+                      self.args, self.status, returncode)
+        return self.status
+
+    def message(self):
+        """Returns a line describing how the job ended"""
+        if self.status == TIMED_OUT:
+            return 'Error: timed out after %ss' % self.timeout
+        if self.status == CANCELLED:
+            return 'Error: cancelled'
+        if self.status == FAILED:
+            return 'Error: failed with exit status %s' % (
+                self.proc.returncode)
+        return 'Success: done'
+
+    def communicate(self):
+        """Runs the job to the end. Returns decoded (stdout, stderr);
+        stderr says why if the job was stopped"""
+        self.start(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        data, error = self.proc.communicate()
+        self.finish()
+        error = error.decode('UTF-8', 'replace')
+        if self.reason:
+            error = (error + '\n' + self.message()).strip()
+        return data.decode('UTF-8', 'replace'), error
+
+    def lines(self):
+        """Runs the job, yielding its output lines as bytes. status is
+        set once the generator is exhausted"""
+        self.start(stdout=subprocess.PIPE)
+        try:
+            for line in iter(self.proc.stdout.readline, b''):
+                yield line
+        finally:
+            self.proc.stdout.close()
+            if self.status == RUNNING and self.proc.poll() is None:
+                # the reader gave up early
+                self.stop(CANCELLED)
+            self.finish()
+
+    @classmethod
+    def cancel_interactive(cls):
+        """Stops every interactive job no JobQueue task started. Bound to
+        the cancel key"""
+        cls.cancellations += 1
+        with cls.active_lock:
+            jobs = [job for job in cls.active
+                    if job.interactive and job.owner is None]
+        for job in jobs:
+            job.stop(CANCELLED)
+        return len(jobs)
+
+    @classmethod
+    def stop_owned(cls, owner):
+        """Stops every job started by the tasks of owner, a JobQueue"""
+        with cls.active_lock:
+            jobs = [job for job in cls.active if job.owner is owner]
+        for job in jobs:
+            job.stop(CANCELLED)
+
+    @classmethod
+    def stop_all(cls):
+        """Stops every job, on exit"""
+        with cls.active_lock:
+            jobs = list(cls.active)
+        for job in jobs:
+            job.stop(CANCELLED)
+
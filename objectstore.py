@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""Content addressed file store for theme and plugin revisions.
+
+Every file is stored once under objects/, named by the hash of its
+contents. A revision is a JSON manifest listing the files, directories
+and symlinks of the backed up directory, so backing up mostly unchanged
+code only stores the files that changed. Files are copied into and out
+of the store with reflinks where the filesystem supports them, so no
+data is copied on btrfs or xfs. Hardlinks are not used: WordPress edits
+files in place, which would change a stored object shared with the live
+tree."""
+import os
+import json
+import uuid
+import errno
+import fcntl
+import ctypes
+import shutil
+import hashlib
+import tempfile
+from threading import Lock, Condition
+from logmod import Log
+
+L = Log()
+
+# ioctl request number of FICLONE, from linux/fs.h
+FICLONE = 0x40049409
+# renameat2 arguments, from linux/fcntl.h and linux/fs.h
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+try:
+    RENAMEAT2 = ctypes.CDLL(None, use_errno=True).renameat2
+except (OSError, AttributeError):
+    RENAMEAT2 = None
+MANIFEST_EXTENSION = '.manifest'
+HASH_CHUNK_SIZE = 1048576
+
+
+class ObjectStore(object):
+    """Object store rooted at root, shared by all installations.
+    Use ObjectStore.get(root), so threads share one instance per root.
+
+    Hashes are cached by path, size, mtime, ctime and inode in
+    stat_cache.json, so unchanged files are not read again"""
+    instances = {}
+    instances_lock = Lock()
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.stat_cache_path = os.path.join(root, 'stat_cache.json')
+        self.stat_cache = None
+        self.reflink = True
+        self.lock = Lock()
+        # snapshots in progress, and whether collect is running
+        self.activity = Condition()
+        self.active = 0
+        self.collecting = False
+
+    @classmethod
+    def get(cls, root):
+        """Returns the shared store for root"""
+        with cls.instances_lock:
+            if root not in cls.instances:
+                cls.instances[root] = cls(root)
+            return cls.instances[root]
+
+    def object_path(self, digest):
+        """Returns the path of the object with digest"""
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def load_stat_cache(self):
+        """Reads the stat cache, if it has not been read yet"""
+        with self.lock:
+            if self.stat_cache is not None:
+                return
+            try:
+                with open(self.stat_cache_path) as cache_file:
+                    self.stat_cache = json.load(cache_file)
+            except (OSError, IOError, ValueError):
+                self.stat_cache = {}
+
+    def save_stat_cache(self):
+        """Atomically writes the stat cache. Called with lock held"""
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.stat-')
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(self.stat_cache, cache_file)
+        os.replace(temp_path, self.stat_cache_path)
+
+    @staticmethod
+    def stat_key(file_stat):
+        """Returns what must be unchanged for a cached hash to be used"""
+        return [file_stat.st_size, file_stat.st_mtime_ns,
+                file_stat.st_ctime_ns, file_stat.st_ino]
+
+    @staticmethod
+    def hash_file(path):
+        """Returns the content hash of the file at path"""
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def clone(self, src, dest):
+        """Copies src to dest, as a reflink when the filesystem allows"""
+        if self.reflink:
+            try:
+                with open(src, 'rb') as source, open(dest, 'wb') as target:
+                    fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                return
+            except OSError:
+                # not supported here, don't try again for this store
+                self.reflink = False
+        shutil.copyfile(src, dest)
+
+    def add(self, path, file_stat):
+        """Stores the file at path if its contents are not stored yet.
+        Returns (digest, stored) where stored is True for a new object"""
+        key = self.stat_key(file_stat)
+        with self.lock:
+            cached = self.stat_cache.get(path)
+        if cached and cached[:4] == key:
+            digest = cached[4]
+        else:
+            digest = self.hash_file(path)
+            with self.lock:
+                self.stat_cache[path] = key + [digest]
+        object_path = self.object_path(digest)
+        if os.path.isfile(object_path):
+            return digest, False
+        object_dir = os.path.dirname(object_path)
+        os.makedirs(object_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=object_dir, prefix='.tmp-')
+        os.close(fd)
+        try:
+            self.clone(path, temp_path)
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, object_path)
+        except (OSError, IOError):
+            os.remove(temp_path)
+            raise
+        return digest, True
+
+    def snapshot(self, src, manifest_path):
+        """Stores the directory src and writes its manifest.
+        Returns a dict of files, bytes, new_files and new_bytes"""
+        with self.activity:
+            while self.collecting:
+                self.activity.wait()
+            self.active += 1
+        try:
+            return self.store_tree(src, manifest_path)
+        finally:
+            with self.activity:
+                self.active -= 1
+                self.activity.notify_all()
+
+    def store_tree(self, src, manifest_path):
+        """Does the work of snapshot"""
+        self.load_stat_cache()
+        manifest = {
+            'version': 1,
+            'source': src,
+            'dirs': [],
+            'files': [],
+            'symlinks': []
+        }
+        stats = {'files': 0, 'bytes': 0, 'new_files': 0, 'new_bytes': 0}
+        for root, dirs, files in os.walk(src):
+            relative_root = os.path.relpath(root, src)
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                relative = os.path.normpath(
+                    os.path.join(relative_root, name))
+                file_stat = os.lstat(path)
+                if os.path.islink(path):
+                    manifest['symlinks'].append(
+                        [relative, os.readlink(path)])
+                elif name in dirs:
+                    manifest['dirs'].append(
+                        [relative, file_stat.st_mode & 0o7777])
+                else:
+                    digest, stored = self.add(path, file_stat)
+                    manifest['files'].append([
+                        relative, digest, file_stat.st_mode & 0o7777,
+                        file_stat.st_size, file_stat.st_mtime])
+                    stats['files'] += 1
+                    stats['bytes'] += file_stat.st_size
+                    if stored:
+                        stats['new_files'] += 1
+                        stats['new_bytes'] += file_stat.st_size
+        manifest['root_mode'] = os.stat(src).st_mode & 0o7777
+        manifest['stats'] = stats
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(manifest_path), prefix='.manifest-')
+        with os.fdopen(fd, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temp_path, manifest_path)
+        with self.lock:
+            self.save_stat_cache()
+        L.debug('Stored %s in %s: %s', src, manifest_path, stats)
+        return stats
+
+    @staticmethod
+    def read_manifest(manifest_path):
+        """Returns the manifest at manifest_path"""
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    def materialize(self, manifest_path, dest):
+        """Recreates the directory described by the manifest at dest,
+        which must not exist yet"""
+        manifest = self.read_manifest(manifest_path)
+        os.makedirs(dest)
+        for relative, _mode in manifest['dirs']:
+            os.makedirs(os.path.join(dest, relative), exist_ok=True)
+        for relative, target in manifest['symlinks']:
+            os.symlink(target, os.path.join(dest, relative))
+        for relative, digest, mode, _size, mtime in manifest['files']:
+            path = os.path.join(dest, relative)
+            self.clone(self.object_path(digest), path)
+            os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+        # directory modes last, in case one is not writable
+        for relative, mode in reversed(manifest['dirs']):
+            os.chmod(os.path.join(dest, relative), mode)
+        os.chmod(dest, manifest.get('root_mode', 0o755))
+
+    def collect(self, referenced, since):
+        """Removes every object that is not in the set of digests
+        returned by referenced, and was not written at or after since.
+        referenced is called once snapshots in progress have finished,
+        while new ones are held back, so it sees every manifest written
+        before the collection. It returns None when the objects in use
+        can not be known, and then nothing is removed.
+        Returns (objects, bytes) removed"""
+        with self.activity:
+            while self.active or self.collecting:
+                self.activity.wait()
+            self.collecting = True
+        try:
+            digests = referenced()
+            if digests is None or not os.path.isdir(self.objects):
+                return 0, 0
+            removed = reclaimed = 0
+            for prefix in os.listdir(self.objects):
+                prefix_dir = os.path.join(self.objects, prefix)
+                for name in os.listdir(prefix_dir):
+                    if prefix + name in digests:
+                        continue
+                    path = os.path.join(prefix_dir, name)
+                    object_stat = os.lstat(path)
+                    # stored by a snapshot that ran during the pass. In
+                    # whole seconds, as some filesystems keep no more
+                    if object_stat.st_mtime >= int(since):
+                        continue
+                    os.remove(path)
+                    removed += 1
+                    reclaimed += object_stat.st_size
+            L.debug('Collected %s objects, %s bytes', removed, reclaimed)
+            return removed, reclaimed
+        finally:
+            with self.activity:
+                self.collecting = False
+                self.activity.notify_all()
+
+    def referenced(self, directory):
+        """Returns the digests used by every manifest found under
+        directory, or None if one of them can not be read"""
+        digests = set()
+        for root, dirs, files in os.walk(directory):
+            if root == self.root and 'objects' in dirs:
+                dirs.remove('objects')
+            for name in files:
+                if not name.endswith(MANIFEST_EXTENSION):
+                    continue
+                manifest_path = os.path.join(root, name)
+                try:
+                    manifest = self.read_manifest(manifest_path)
+                except (OSError, IOError, ValueError) as error:
+                    L.warning('Unreadable manifest %s: %s',
+                              manifest_path, error)
+                    # its objects can not be known, so keep everything
+                    return None
+                digests.update(
+                    digest for _path, digest, _mode, _size, _mtime
+                    in manifest['files'])
+        return digests
+
+
+def exchange(path_a, path_b):
+    """Atomically swaps two paths with renameat2(RENAME_EXCHANGE).
+    Returns False if the C library or filesystem does not support it"""
+    if RENAMEAT2 is None:
+        return False
+    if RENAMEAT2(AT_FDCWD, os.fsencode(path_a), AT_FDCWD,
+                 os.fsencode(path_b), RENAME_EXCHANGE) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP):
+        return False
+    raise OSError(error, os.strerror(error), path_a)
+
+
+def replace_tree(staging, dest):
+    """Puts the directory staging in place of dest, on the same
+    filesystem. Where renameat2 is available the two are exchanged
+    atomically, otherwise dest is renamed aside first and is missing for
+    the moment between the two renames. Returns the path now holding the
+    old dest, for the caller to remove, or None if dest did not exist"""
+    if not os.path.lexists(dest):
+        os.rename(staging, dest)
+        return None
+    if exchange(staging, dest):
+        return staging
+    aside = '%s.old-%s' % (staging, uuid.uuid4().hex[:8])
+    os.rename(dest, aside)
+    try:
+        os.rename(staging, dest)
+    except OSError:
+        os.rename(aside, dest)
+        raise
+    return aside
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Retention of the revisions written by RevisionActions.auto_bk.
+
+Revisions are the entries of each installation's RevisionCatalog that
+share a timestamp. The engine keeps, per installation, the newest
+keep_last revisions and the newest revision of each of the latest
+keep_hourly hours, keep_daily days and keep_weekly weeks. Everything
+else is removed. If the stored size of all installations is still over
+max_total_mb, the least recently used revisions are evicted, though never
+the newest revision of an installation. Removed revisions are recorded in
+the catalog. Afterwards, objects and database dumps no live revision
+uses are deleted."""
+import os
+import time
+import shutil
+import datetime
+from threading import Thread, Lock
+from logmod import Log
+from catalog import RevisionCatalog, CATALOG_NAME, revision_size
+from dbdump import read_manifest, INCREMENTAL_EXTENSION
+from objectstore import ObjectStore, MANIFEST_EXTENSION
+
+L = Log()
+
+
+class RetentionEngine(object):
+    """Applies settings.revisions retention policies to temp_dir"""
+    lock = Lock()
+    running = False
+    pending = False
+    last_report = None
+
+    def __init__(self, temp_dir, settings):
+        self.temp_dir = temp_dir
+        self.keep_last = max(1, int(settings.get('keep_last', 10)))
+        self.buckets = [
+            ('hourly', int(settings.get('keep_hourly', 24))),
+            ('daily', int(settings.get('keep_daily', 7))),
+            ('weekly', int(settings.get('keep_weekly', 4)))
+        ]
+        self.max_total = int(settings.get('max_total_mb', 0)) * 1048576
+
+    @classmethod
+    def schedule(cls, app):
+        """Runs the engine in a background thread. A request made while
+        it is running starts one more pass when it finishes"""
+        settings = getattr(app.settings, 'revisions', {})
+        if not settings.get('retention_enabled', True):
+            return
+        with cls.lock:
+            if cls.running:
+                cls.pending = True
+                return
+            cls.running = True
+        engine = cls(app.settings.app['temp_dir'].name, settings)
+        Thread(target=engine.run_pending, name='retention_thread',
+               daemon=True).start()
+
+    def run_pending(self):
+        """Runs passes until no more have been requested"""
+        while True:
+            try:
+                report = self.run()
+            except (OSError, IOError) as error:
+                L.warning('Revision retention failed: %s', error)
+            else:
+                RetentionEngine.last_report = report
+            with RetentionEngine.lock:
+                if not RetentionEngine.pending:
+                    RetentionEngine.running = False
+                    return
+                RetentionEngine.pending = False
+
+    def catalogs(self):
+        """Returns the catalog of every installation under temp_dir"""
+        catalogs = []
+        if not os.path.isdir(self.temp_dir):
+            return catalogs
+        for install_dir in os.listdir(self.temp_dir):
+            if os.path.isfile(os.path.join(
+                    self.temp_dir, install_dir, CATALOG_NAME)):
+                catalogs.append(
+                    RevisionCatalog.for_install(self.temp_dir, install_dir))
+        return catalogs
+
+    @staticmethod
+    def revisions(catalog):
+        """Returns the catalog's revisions, newest first, as
+        (timestamp, [entries])"""
+        revisions = {}
+        for entry in catalog.entries():
+            revisions.setdefault(entry['timestamp'], []).append(entry)
+        return sorted(revisions.items(), reverse=True)
+
+    @staticmethod
+    def bucket(created, period):
+        """Returns the hour, day or ISO week containing created"""
+        moment = datetime.datetime.fromtimestamp(created)
+        if period == 'hourly':
+            return moment.strftime('%Y%m%d%H')
+        if period == 'daily':
+            return moment.strftime('%Y%m%d')
+        return '%s-%s' % moment.isocalendar()[:2]
+
+    def expired(self, revisions):
+        """Returns the timestamps of revisions no policy keeps"""
+        keep = set(timestamp for timestamp, _entries
+                   in revisions[:self.keep_last])
+        for period, count in self.buckets:
+            seen = []
+            for timestamp, entries in revisions:
+                bucket = self.bucket(
+                    max(entry['created'] for entry in entries), period)
+                if bucket not in seen:
+                    if len(seen) == count:
+                        break
+                    seen.append(bucket)
+                    keep.add(timestamp)
+        return [timestamp for timestamp, _entries in revisions
+                if timestamp not in keep]
+
+    def evict(self, catalogs):
+        """Returns (catalog, timestamp) of the least recently used
+        revisions to remove to bring the total stored size under
+        max_total"""
+        candidates = []
+        total = 0
+        for catalog in catalogs:
+            revisions = self.revisions(catalog)
+            for index, (timestamp, entries) in enumerate(revisions):
+                stored = sum(entry.get('stored', 0) for entry in entries)
+                total += stored
+                if index > 0:
+                    used = max(entry.get('used', 0) for entry in entries)
+                    candidates.append((used, stored, catalog, timestamp))
+        evicted = []
+        for _used, stored, catalog, timestamp in sorted(
+                candidates, key=lambda candidate: candidate[0]):
+            if total <= self.max_total:
+                break
+            evicted.append((catalog, timestamp))
+            total -= stored
+        if total > self.max_total:
+            L.warning('Revisions still use %s bytes, over the %s byte cap',
+                      total, self.max_total)
+        return evicted
+
+    def remove(self, catalog, timestamp):
+        """Removes a revision from the catalog, and deletes its theme
+        and plugin manifests. Database dumps are left for collect, as
+        later incremental revisions may use their tables.
+        Returns the bytes freed"""
+        reclaimed = 0
+        for entry in catalog.entries():
+            if entry['timestamp'] != timestamp:
+                continue
+            path = os.path.join(
+                catalog.directory(), entry['type'], entry['path'])
+            freed = 0
+            if path.endswith(MANIFEST_EXTENSION) and os.path.isfile(path):
+                freed = os.path.getsize(path)
+                os.remove(path)
+            catalog.delete(entry['id'], freed)
+            reclaimed += freed
+        return reclaimed
+
+    def collect(self, catalogs, since):
+        """Deletes objects no manifest on disk uses, other than those
+        stored since the pass started, and the dumps of removed revisions
+        that no live incremental revision uses. Returns the bytes freed"""
+        reclaimed = 0
+        for catalog in catalogs:
+            databases = os.path.join(catalog.directory(), 'databases')
+            sources = set()
+            for entry in catalog.entries():
+                if entry['path'].endswith(INCREMENTAL_EXTENSION):
+                    manifest = read_manifest(
+                        os.path.join(databases, entry['path'])) or {}
+                    sources.update(
+                        table['source'] for table in manifest.get(
+                            'tables', []) if table.get('source'))
+            if os.path.isdir(databases) and any(
+                    name.endswith('.partial')
+                    for name in os.listdir(databases)):
+                # a dump in progress may be using a removed revision
+                continue
+            for revision_id, entry in list(catalog.deleted.items()):
+                if entry['type'] != 'databases' or \
+                        entry['path'] in sources:
+                    continue
+                path = os.path.join(databases, entry['path'])
+                if os.path.exists(path):
+                    size, _files = revision_size(path)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                    reclaimed += size
+                del catalog.deleted[revision_id]
+        store = ObjectStore.get(self.temp_dir)
+        # manifests are read once snapshots are held back, so a revision
+        # taken after the catalogs were read keeps its objects
+        _objects, freed = store.collect(
+            lambda: store.referenced(self.temp_dir), since)
+        return reclaimed + freed
+
+    def run(self):
+        """Applies the policies to every installation.
+        Returns a report of revisions removed and bytes reclaimed"""
+        start = time.time()
+        catalogs = self.catalogs()
+        removed = reclaimed = 0
+        for catalog in catalogs:
+            for timestamp in self.expired(self.revisions(catalog)):
+                reclaimed += self.remove(catalog, timestamp)
+                removed += 1
+        if self.max_total:
+            for catalog, timestamp in self.evict(catalogs):
+                reclaimed += self.remove(catalog, timestamp)
+                removed += 1
+        if removed:
+            reclaimed += self.collect(catalogs, start)
+        report = {
+            'removed': removed,
+            'reclaimed': reclaimed,
+            'time': time.time(),
+            'duration': time.time() - start
+        }
+        L.info('Revision retention removed %s revisions, reclaimed %s '
+               'bytes in %.2fs', removed, reclaimed, report['duration'])
+        return report
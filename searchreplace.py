@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""Search and replace over a direct database connection.
+
+Replaces `wp search-replace --all-tables --precise`, which unserializes
+every row in PHP. Rows are read in primary key batches, and only rows
+where a string column contains the search term are fetched, using a
+binary LIKE prefilter. Values are read and written as hex, so the bytes
+are compared and written exactly as stored. PHP serialized values are
+rewritten by walking the serialized data and fixing the length prefix
+of every string value changed, without unserializing it; array keys
+and property names are kept as they are. Tables are processed
+in parallel, each worker on its own connection. A run can be cancelled
+between batches; the rows already replaced stay replaced.
+
+A dry run records, with each table's checksum, the primary keys of the
+rows it would change. Given that plan, the real run only reads those
+rows, unless the table's checksum has changed since, in which case the
+table is scanned again."""
+import re
+import binascii
+from threading import Lock, local
+from concurrent.futures import ThreadPoolExecutor
+from logmod import Log
+from database import DbError, get_table_status, quote_name
+from dbdump import table_fingerprints
+
+L = Log()
+
+# Columns that can hold the search term
+STRING_TYPES = (
+    'char', 'varchar', 'tinytext', 'text', 'mediumtext', 'longtext',
+    'binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob')
+SERIALIZED_RE = re.compile(
+    br'^(?:[aOC]:\d+:[{"]|[sE]:\d+:"|[bid]:[^;]*;|N;)')
+
+
+class SerializedError(ValueError):
+    """Raised when a value is not valid PHP serialized data"""
+
+
+class SearchReplaceCancelled(DbError):
+    """Raised by SearchReplaceEngine.run when it is cancelled"""
+
+
+def replace_value(value, search, replace):
+    """Returns value, bytes, with search replaced by replace. PHP
+    serialized values keep their structure, with string lengths fixed
+    up. Values that only look serialized are replaced as plain text, as
+    `wp search-replace` does"""
+    if search not in value:
+        return value
+    if SERIALIZED_RE.match(value):
+        try:
+            result, end = replace_serialized(value, 0, search, replace)
+            if end == len(value):
+                return result
+        except (SerializedError, ValueError, IndexError):
+            pass
+    return value.replace(search, replace)
+
+
+def read_until(data, pos, terminator):
+    """Returns (data from pos up to terminator, position after it)"""
+    end = data.index(terminator, pos)
+    return data[pos:end], end + len(terminator)
+
+
+def expect(data, pos, token):
+    """Returns the position after token, which must be at pos"""
+    if data[pos:pos + len(token)] != token:
+        raise SerializedError('expected %r at %s' % (token, pos))
+    return pos + len(token)
+
+
+def read_string(data, pos):
+    """Reads a serialized string body, 'N:"...";' or 'N:"...":', from
+    pos. Returns (string, position after it)"""
+    length, pos = read_until(data, pos, b':')
+    start = expect(data, pos, b'"')
+    end = start + int(length)
+    if end > len(data):
+        raise SerializedError('string overruns the value')
+    return data[start:end], expect(data, end, b'"')
+
+
+def copy_key(data, pos):
+    """Returns (the serialized array key or property name at pos, as
+    is, position after it). Keys are never rewritten: they are code, not
+    content, and private and protected property names such as
+    "\\0Class\\0prop" must keep matching their class"""
+    kind = data[pos:pos + 1]
+    start = pos
+    pos = expect(data, pos + 1, b':')
+    if kind == b'i':
+        _key, pos = read_until(data, pos, b';')
+    elif kind == b's':
+        _key, pos = read_string(data, pos)
+        pos = expect(data, pos, b';')
+    else:
+        raise SerializedError('invalid key type %r at %s' % (kind, start))
+    return data[start:pos], pos
+
+
+def replace_serialized(data, pos, search, replace):
+    """Rewrites the serialized value at pos. Returns (rewritten value,
+    position after it)"""
+    kind = data[pos:pos + 1]
+    pos = expect(data, pos + 1, b':') if kind != b'N' else pos + 1
+    if kind == b'N':
+        return b'N;', expect(data, pos, b';')
+    if kind in (b'b', b'i', b'd', b'r', b'R'):
+        scalar, pos = read_until(data, pos, b';')
+        return kind + b':' + scalar + b';', pos
+    if kind == b's':
+        string, pos = read_string(data, pos)
+        pos = expect(data, pos, b';')
+        # strings often hold serialized data of their own
+        string = replace_value(string, search, replace)
+        return b's:%d:"%s";' % (len(string), string), pos
+    if kind == b'E':
+        # enum case names are code, not content
+        string, pos = read_string(data, pos)
+        return b'E:%d:"%s";' % (len(string), string), \
+            expect(data, pos, b';')
+    if kind == b'a':
+        count, pos = read_until(data, pos, b':')
+        prefix = b'a:' + count + b':{'
+    elif kind == b'O':
+        class_name, pos = read_string(data, pos)
+        pos = expect(data, pos, b':')
+        count, pos = read_until(data, pos, b':')
+        prefix = b'O:%d:"%s":%s:{' % (len(class_name), class_name, count)
+    elif kind == b'C':
+        # the payload is in a format only the class knows, keep it as is
+        start = pos - 2
+        _class_name, pos = read_string(data, pos)
+        pos = expect(data, pos, b':')
+        length, pos = read_until(data, pos, b':')
+        pos = expect(data, pos, b'{') + int(length)
+        return data[start:pos + 1], expect(data, pos, b'}')
+    else:
+        raise SerializedError('unknown type %r at %s' % (kind, pos))
+    pos = expect(data, pos, b'{')
+    parts = [prefix]
+    for _index in range(int(count)):
+        key, pos = copy_key(data, pos)
+        value, pos = replace_serialized(data, pos, search, replace)
+        parts.extend((key, value))
+    parts.append(b'}')
+    return b''.join(parts), expect(data, pos, b'}')
+
+
+def like_pattern(search):
+    """Returns a LIKE pattern, as bytes, matching values containing
+    search"""
+    escaped = search.replace(b'\\', b'\\\\').replace(
+        b'%', b'\\%').replace(b'_', b'\\_')
+    return b'%' + escaped + b'%'
+
+
+def hex_literal(value):
+    """Returns SQL for value, bytes, that is compared and stored as
+    exactly those bytes"""
+    if not value:
+        return "''"
+    return "UNHEX('%s')" % binascii.hexlify(value).decode('ascii')
+
+
+class SearchReplaceEngine(object):
+    """Search and replace across every table of a database.
+
+    connect is called to open one client per worker thread. settings is
+    the settings.database section. plan is the plan attribute of a dry
+    run engine, for the real run to reuse. cancelled, if given, is
+    checked before each batch of rows, and stops the run when it returns
+    True"""
+
+    def __init__(self, connect, search_term, replace_term, settings,
+                 dry_run=True, plan=None, cancelled=None):
+        self.connect = connect
+        self.cancelled = cancelled
+        self.search = search_term.encode('UTF-8')
+        self.replace = replace_term.encode('UTF-8')
+        self.dry_run = dry_run
+        self.batch_size = max(1, int(settings.get('search_replace_batch',
+                                                  1000)))
+        self.workers = max(1, int(settings.get('search_replace_workers',
+                                               4)))
+        self.local = local()
+        self.clients = []
+        self.clients_lock = Lock()
+        self.planned = None
+        if plan and (plan['search'], plan['replace']) == (
+                search_term, replace_term):
+            self.planned = plan['tables']
+        # the rows this run matched, for a real run to reuse
+        self.plan = {
+            'search': search_term,
+            'replace': replace_term,
+            'tables': {}
+        }
+
+    def client(self):
+        """Returns the calling thread's client"""
+        if not getattr(self.local, 'client', None):
+            self.local.client = self.connect()
+            with self.clients_lock:
+                self.clients.append(self.local.client)
+        return self.local.client
+
+    def check_cancelled(self):
+        """Raises SearchReplaceCancelled if the run has been cancelled"""
+        if self.cancelled and self.cancelled():
+            raise SearchReplaceCancelled('Search & Replace cancelled')
+
+    @staticmethod
+    def columns(client, table):
+        """Returns (primary key columns, string columns) of table"""
+        rows = client.query(
+            "SELECT COLUMN_NAME, DATA_TYPE, COLUMN_KEY "
+            "FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+            "ORDER BY ORDINAL_POSITION", [table])
+        primary = [row['COLUMN_NAME'] for row in rows
+                   if row['COLUMN_KEY'] == 'PRI']
+        strings = [row['COLUMN_NAME'] for row in rows
+                   if row['DATA_TYPE'].lower() in STRING_TYPES]
+        return primary, strings
+
+    def rows(self, client, table, primary, columns, keys=None):
+        """Yields, in primary key order, the rows of table where a column
+        contains the search term, as (key values, {column: bytes}).
+        keys, if given, limits the rows read to those primary keys"""
+        pattern = hex_literal(like_pattern(self.search))
+        prefilter = ' OR '.join(
+            '%s LIKE %s' % (quote_name(column), pattern)
+            for column in columns)
+        key_list = ', '.join(quote_name(column) for column in primary)
+        select = 'SELECT %s, %s FROM %s WHERE (%s)' % (
+            key_list,
+            ', '.join('HEX(%s) AS %s' % (
+                quote_name(column), quote_name('hex_' + column))
+                for column in columns),
+            quote_name(table), prefilter)
+        if keys is not None:
+            row_key = '(%s)' % ', '.join(['%s'] * len(primary))
+            for start in range(0, len(keys), self.batch_size):
+                batch_keys = keys[start:start + self.batch_size]
+                self.check_cancelled()
+                batch = client.query(
+                    select + ' AND (%s) IN (%s) ORDER BY %s' % (
+                        key_list, ', '.join([row_key] * len(batch_keys)),
+                        key_list),
+                    [value for key in batch_keys for value in key])
+                for row in batch:
+                    yield self.split_row(row, primary, columns)
+            return
+        last = None
+        while True:
+            sql = select
+            args = None
+            if last is not None:
+                sql += ' AND (%s) > (%s)' % (
+                    key_list, ', '.join(['%s'] * len(primary)))
+                args = last
+            self.check_cancelled()
+            batch = client.query(
+                sql + ' ORDER BY %s LIMIT %d' % (key_list, self.batch_size),
+                args)
+            for row in batch:
+                yield self.split_row(row, primary, columns)
+            if len(batch) < self.batch_size:
+                return
+            last = [batch[-1][column] for column in primary]
+
+    @staticmethod
+    def split_row(row, primary, columns):
+        """Returns (key values, {column: bytes}) of a row read by rows"""
+        return [row[column] for column in primary], dict(
+            (column, binascii.unhexlify(row['hex_' + column]))
+            for column in columns
+            if row['hex_' + column] is not None)
+
+    def update(self, client, table, primary, key, changes):
+        """Writes the changed columns of one row"""
+        client.query(
+            'UPDATE %s SET %s WHERE %s' % (
+                quote_name(table),
+                ', '.join('%s = %s' % (quote_name(column), hex_literal(value))
+                          for column, value in changes.items()),
+                ' AND '.join('%s = %%s' % quote_name(column)
+                             for column in primary)),
+            key)
+
+    def run_table(self, table):
+        """Searches, and unless dry_run replaces, one table.
+        Returns its result dicts, one per string column"""
+        client = self.client()
+        primary, columns = self.columns(client, table)
+        if not columns:
+            return []
+        if not primary:
+            # rows can't be addressed, `wp search-replace` skips these too
+            L.warning('Search & Replace skipped %s: no primary key', table)
+            return [{'table': table, 'column': column, 'count': '0'}
+                    for column in columns]
+        keys = None
+        fingerprint = None
+        if self.dry_run or self.planned is not None:
+            fingerprint = table_fingerprints(
+                client, 'checksum', [table]).get(table)
+        planned = (self.planned or {}).get(table)
+        if planned and planned['fingerprint'] == fingerprint:
+            keys = planned['keys']
+        elif self.planned is not None:
+            L.debug('Search & Replace rescanning %s, it changed since '
+                    'the dry run', table)
+        counts = dict((column, 0) for column in columns)
+        matched = []
+        for key, values in self.rows(
+                client, table, primary, columns, keys):
+            changes = {}
+            for column, value in values.items():
+                replaced = replace_value(value, self.search, self.replace)
+                if replaced != value:
+                    changes[column] = replaced
+                    counts[column] += 1
+            if changes:
+                matched.append(key)
+                if not self.dry_run:
+                    self.update(client, table, primary, key, changes)
+        if self.dry_run:
+            with self.clients_lock:
+                self.plan['tables'][table] = {
+                    'fingerprint': fingerprint,
+                    'keys': matched
+                }
+        return [{'table': table, 'column': column,
+                 'count': str(counts[column])} for column in columns]
+
+    def run(self):
+        """Processes every table. Returns results in the shape of
+        DatabaseInformation.search_replace: {'results': [{'table',
+        'column', 'count'}], 'count'}"""
+        try:
+            tables = [row['TABLE_NAME']
+                      for row in get_table_status(self.client())]
+            with ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='search_replace') as pool:
+                table_results = list(pool.map(self.run_table, tables))
+        finally:
+            for client in self.clients:
+                client.close()
+        results = [result for table_result in table_results
+                   for result in table_result]
+        count = sum(int(result['count']) for result in results)
+        L.debug('Search & Replace: %s replacements in %s tables',
+                count, len(tables))
+        return {'results': results, 'count': str(count)}
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""Puts the application modules, which live at the top of the repository,
+on the import path of the tests"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
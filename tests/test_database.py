@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""SQL literals, the two client backends' query handling and reconnecting
+in DbConnections, without a database server"""
+import os
+import shutil
+import tempfile
+import unittest
+from threading import Lock
+from types import SimpleNamespace
+from unittest import mock
+import database
+from database import (
+    DbConnections, DbError, MysqlClient, PyMysqlClient, format_query,
+    literal)
+
+WP_CONFIG = """<?php
+define( 'DB_NAME', 'wordpress' );
+define( 'DB_USER', 'wp' );
+define( 'DB_PASSWORD', 'secret' );
+define( 'DB_HOST', 'localhost' );
+$table_prefix = 'wp_';
+"""
+
+
+class LiteralTest(unittest.TestCase):
+    """literal and format_query, used by the mysql client backend"""
+
+    def test_literals(self):
+        self.assertEqual(literal(None), 'NULL')
+        self.assertEqual(literal(True), '1')
+        self.assertEqual(literal(False), '0')
+        self.assertEqual(literal(42), '42')
+        self.assertEqual(literal(1.5), '1.5')
+        self.assertEqual(literal("it's"), "'it\\'s'")
+        self.assertEqual(literal('a\\b\nc\0'), "'a\\\\b\\nc\\0'")
+
+    def test_format_query(self):
+        self.assertEqual(
+            format_query('SELECT * FROM t WHERE a = %s AND b = %s',
+                         ['x', None]),
+            "SELECT * FROM t WHERE a = 'x' AND b = NULL")
+        self.assertEqual(
+            format_query('SELECT 100%s', None), 'SELECT 100%s')
+        self.assertEqual(
+            format_query("SELECT 'x' LIKE '50%%' AND y = %s", [1]),
+            "SELECT 'x' LIKE '50%' AND y = 1")
+
+
+class FakeCursor(object):
+    """Records what PyMySQL's cursor was asked to execute"""
+
+    def __init__(self, executed, rows):
+        self.executed = executed
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, args=None):
+        self.executed.append((sql, args))
+
+    def fetchall(self):
+        return self.rows
+
+
+class PyMysqlClientTest(unittest.TestCase):
+    """Arguments are left to PyMySQL to bind"""
+
+    def client(self, rows):
+        client = PyMysqlClient.__new__(PyMysqlClient)
+        client.lock = Lock()
+        client.executed = []
+        client.connection = SimpleNamespace(
+            cursor=lambda: FakeCursor(client.executed, rows))
+        return client
+
+    def test_arguments_are_bound_by_pymysql(self):
+        client = self.client([{'a': b'x', 'b': 3, 'c': None}])
+        rows = client.query('SELECT a FROM t WHERE a = %s', ["it's"])
+        self.assertEqual(client.executed,
+                         [('SELECT a FROM t WHERE a = %s', ["it's"])])
+        self.assertEqual(rows, [{'a': 'x', 'b': '3', 'c': None}])
+
+    def test_no_arguments(self):
+        client = self.client([])
+        client.query("SELECT 1 LIKE '%'", [])
+        self.assertEqual(client.executed, [("SELECT 1 LIKE '%'", None)])
+
+
+class FakeStdin(object):
+    """Collects what is written to the mysql client"""
+
+    def __init__(self):
+        self.written = b''
+
+    def write(self, data):
+        self.written += data
+
+    def flush(self):
+        pass
+
+
+class FakeProcess(object):
+    """A `mysql --batch` process answering with prepared output lines"""
+
+    def __init__(self, lines):
+        self.stdin = FakeStdin()
+        self.lines = [line.encode('UTF-8') + b'\n' for line in lines]
+        self.stdout = SimpleNamespace(readline=self.readline)
+
+    def readline(self):
+        return self.lines.pop(0) if self.lines else b''
+
+    @staticmethod
+    def poll():
+        return None
+
+
+class MysqlClientTest(unittest.TestCase):
+    """Output parsing of the mysql client backend"""
+
+    def client(self, lines):
+        client = MysqlClient.__new__(MysqlClient)
+        client.lock = Lock()
+        client.marker = 'wpui-marker'
+        client.proc = FakeProcess(lines)
+        return client
+
+    def test_rows_end_at_marker(self):
+        client = self.client([
+            'option_name\toption_value',
+            'siteurl\thttp://example.com',
+            'blogdescription\tNULL',
+            'wpui_marker', 'wpui-marker',
+            'later\toutput'])
+        rows = client.query(
+            'SELECT option_name, option_value FROM wp_options '
+            'WHERE option_name IN (%s, %s);', ['siteurl', 'blogdescription'])
+        self.assertEqual(rows, [
+            {'option_name': 'siteurl', 'option_value': 'http://example.com'},
+            {'option_name': 'blogdescription', 'option_value': None}])
+        self.assertEqual(
+            client.proc.stdin.written.decode('UTF-8'),
+            "SELECT option_name, option_value FROM wp_options "
+            "WHERE option_name IN ('siteurl', 'blogdescription');\n"
+            "SELECT 'wpui-marker' AS wpui_marker;\n")
+
+    def test_marker_value_without_header_is_a_row(self):
+        client = self.client([
+            'value', 'wpui-marker', 'wpui_marker', 'wpui-marker'])
+        self.assertEqual(client.query('SELECT 1'),
+                         [{'value': 'wpui-marker'}])
+
+    def test_statement_without_result(self):
+        client = self.client(['wpui_marker', 'wpui-marker'])
+        self.assertEqual(client.query('UPDATE t SET a = 1'), [])
+
+    def test_error_line(self):
+        client = self.client([
+            "ERROR 1146 (42S02) at line 1: Table 'wp.t' doesn't exist",
+            'wpui_marker', 'wpui-marker'])
+        with self.assertRaisesRegex(DbError, '^ERROR 1146'):
+            client.query('SELECT * FROM t')
+
+    def test_exited_client(self):
+        client = self.client(['value'])
+        with self.assertRaisesRegex(DbError, 'exited'):
+            client.query('SELECT 1')
+
+    def test_unescape(self):
+        client = self.client([])
+        self.assertIsNone(client.unescape('NULL'))
+        self.assertEqual(client.unescape('plain'), 'plain')
+        self.assertEqual(client.unescape('a\\tb\\nc\\\\d\\0'),
+                         'a\tb\nc\\d\0')
+        self.assertEqual(client.unescape('\\NULL'), 'NULL')
+
+
+class FakeClient(object):
+    """A client whose liveness the test controls"""
+
+    def __init__(self):
+        self.is_alive = True
+        self.closed = False
+
+    def alive(self):
+        return self.is_alive
+
+    def close(self):
+        self.closed = True
+
+
+class DbConnectionsTest(unittest.TestCase):
+    """Clients are reused while alive, and failed installations are only
+    retried after retry_delay"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'wp-config.php'), 'w') as \
+                config:
+            config.write(WP_CONFIG)
+        self.app = SimpleNamespace(
+            settings=SimpleNamespace(database={
+                'direct_access': True, 'retry_delay': 60}),
+            state=SimpleNamespace(
+                active_installation={'directory': self.directory}))
+        self.results = []
+        self.connects = 0
+        self.now = 1000.0
+        patches = [
+            mock.patch.object(DbConnections, 'clients', {}),
+            mock.patch.object(DbConnections, 'failed', {}),
+            mock.patch.object(DbConnections, 'connect', self.connect),
+            mock.patch.object(database.time, 'time', lambda: self.now)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def connect(self, app, install_path, settings):
+        self.connects += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def test_disabled(self):
+        self.app.settings.database['direct_access'] = False
+        self.assertIsNone(DbConnections.get(self.app))
+        self.assertEqual(self.connects, 0)
+
+    def test_client_is_reused(self):
+        client = FakeClient()
+        self.results = [client]
+        self.assertIs(DbConnections.get(self.app), client)
+        self.assertIs(DbConnections.get(self.app, self.directory), client)
+        self.assertEqual(self.connects, 1)
+        self.assertEqual(client.credentials.name, 'wordpress')
+        self.assertEqual(client.credentials.table_prefix, 'wp_')
+
+    def test_failure_is_retried_after_delay(self):
+        client = FakeClient()
+        self.results = [DbError('refused'), client]
+        self.assertIsNone(DbConnections.get(self.app))
+        self.now += 59
+        self.assertIsNone(DbConnections.get(self.app))
+        self.assertEqual(self.connects, 1)
+        self.now += 2
+        self.assertIs(DbConnections.get(self.app), client)
+        self.assertEqual(self.connects, 2)
+
+    def test_dead_client_is_replaced(self):
+        first, second = FakeClient(), FakeClient()
+        self.results = [first, second]
+        self.assertIs(DbConnections.get(self.app), first)
+        first.is_alive = False
+        self.assertIs(DbConnections.get(self.app), second)
+        self.assertEqual(self.connects, 2)
+
+    def test_close_forgets_failure(self):
+        client = FakeClient()
+        self.results = [DbError('refused'), client]
+        self.assertIsNone(DbConnections.get(self.app))
+        DbConnections.close(self.directory)
+        self.assertIs(DbConnections.get(self.app), client)
+        DbConnections.close(self.directory)
+        self.assertTrue(client.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
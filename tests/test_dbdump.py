@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""Snapshot dumps split into per-table files, and their restore, with
+stand-ins for `wp db export -` and `wp db import -`"""
+import os
+import re
+import json
+import shutil
+import tempfile
+import unittest
+from threading import Lock
+from unittest import mock
+from dbdump import (
+    IncrementalDump, ParallelDump, MANIFEST, import_dump_dir, read_manifest)
+
+HEADER = b"""-- MySQL dump 10.13
+/*!40101 SET NAMES utf8mb4 */;
+"""
+OPTIONS = b"""--
+-- Table structure for table `wp_options`
+--
+CREATE TABLE `wp_options` (`option_id` int);
+INSERT INTO `wp_options` VALUES (1);
+"""
+PLACEHOLDER = b"""--
+-- Temporary view structure for view `wp_recent`
+--
+/*!50001 CREATE VIEW `wp_recent` AS SELECT 1 AS `ID`*/;
+"""
+POSTS = b"""--
+-- Table structure for table `wp_posts`
+--
+CREATE TABLE `wp_posts` (`ID` int);
+"""
+ROUTINES = b"""--
+-- Dumping routines for database 'wp'
+--
+"""
+VIEW = b"""--
+-- Final view structure for view `wp_recent`
+--
+/*!50001 VIEW `wp_recent` AS select `ID` from `wp_posts` */;
+"""
+FOOTER = b"""/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
+-- Dump completed
+"""
+SETTINGS = {'export_compression': 'none', 'export_workers': 2}
+
+
+def section(data):
+    """Returns data without the leading '--' line, which mysqldump writes
+    before the section comment and so ends up in the previous file"""
+    return data.split(b'\n', 1)[1]
+
+
+class ImportRecorder(object):
+    """Stands in for import_stream, keeping the SQL of each import"""
+
+    def __init__(self, output='Success: Imported.'):
+        self.output = output
+        self.imports = []
+        self.lock = Lock()
+
+    def __call__(self, install_path, streams):
+        data = b''.join(stream.read() for stream in streams)
+        with self.lock:
+            self.imports.append(data)
+        return self.output, ''
+
+
+class SnapshotDumpTest(unittest.TestCase):
+    """dump_snapshot and import_dump_dir"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def dump(self, data):
+        def export(install_path, arguments, sink):
+            self.assertIn('--single-transaction', arguments)
+            sink(open(os.path.join(self.directory, 'export.sql'), 'rb'))
+        with open(os.path.join(self.directory, 'export.sql'), 'wb') as sql:
+            sql.write(data)
+        with mock.patch('dbdump.export_stream', export):
+            path = ParallelDump(
+                '/var/www/site', os.path.join(self.directory, 'db'),
+                SETTINGS, ['wp_options', 'wp_posts']).run()
+        self.assertEqual(path, os.path.join(self.directory, 'db.sqld'))
+        with open(os.path.join(path, MANIFEST)) as manifest:
+            return path, json.load(manifest)
+
+    def read(self, path, name):
+        with open(os.path.join(path, name), 'rb') as part:
+            return part.read()
+
+    def test_views_get_their_own_entries(self):
+        path, manifest = self.dump(
+            HEADER + OPTIONS + PLACEHOLDER + POSTS + ROUTINES + VIEW +
+            FOOTER)
+        self.assertEqual(manifest['tables'], [
+            {'name': 'wp_options', 'file': '0000.sql'},
+            {'name': 'wp_recent', 'kind': 'view', 'placeholder': True,
+             'file': '0001.sql'},
+            {'name': 'wp_posts', 'file': '0002.sql'},
+            {'name': 'routines', 'kind': 'routines', 'file': '0003.sql'},
+            {'name': 'wp_recent', 'kind': 'view', 'file': '0004.sql'}])
+        self.assertEqual(self.read(path, 'header.sql'), HEADER + b'--\n')
+        self.assertEqual(self.read(path, '0000.sql'),
+                         section(OPTIONS) + b'--\n')
+        self.assertEqual(self.read(path, '0002.sql'),
+                         section(POSTS) + b'--\n')
+        self.assertEqual(self.read(path, '0004.sql'), section(VIEW))
+        self.assertEqual(self.read(path, 'footer.sql'), FOOTER)
+
+    def test_views_are_restored_after_tables(self):
+        path, _manifest = self.dump(
+            HEADER + OPTIONS + PLACEHOLDER + POSTS + ROUTINES + VIEW +
+            FOOTER)
+        recorder = ImportRecorder()
+        with mock.patch('dbdump.import_stream', recorder):
+            output, _error = import_dump_dir('/var/www/site', path)
+        self.assertIn('Imported 2 tables', output)
+        self.assertEqual(len(recorder.imports), 3)
+        wrapper = HEADER + b'--\n', FOOTER
+        self.assertEqual(
+            sorted(recorder.imports[:2]),
+            sorted([wrapper[0] + section(OPTIONS) + b'--\n' + wrapper[1],
+                    wrapper[0] + section(POSTS) + b'--\n' + wrapper[1]]))
+        self.assertEqual(
+            recorder.imports[2],
+            wrapper[0] + section(PLACEHOLDER) + b'--\n' +
+            section(ROUTINES) + b'--\n' + section(VIEW) + wrapper[1])
+
+    def test_views_are_skipped_when_a_table_fails(self):
+        path, _manifest = self.dump(
+            HEADER + OPTIONS + PLACEHOLDER + VIEW + FOOTER)
+        recorder = ImportRecorder(output='')
+        with mock.patch('dbdump.import_stream', recorder):
+            output, error = import_dump_dir('/var/www/site', path)
+        self.assertIsNone(output)
+        self.assertTrue(error.startswith('wp_options: '))
+        self.assertEqual(len(recorder.imports), 1)
+
+    def test_dump_without_views(self):
+        path, manifest = self.dump(HEADER + OPTIONS + POSTS + FOOTER)
+        self.assertEqual(
+            [table['name'] for table in manifest['tables']],
+            ['wp_options', 'wp_posts'])
+        recorder = ImportRecorder()
+        with mock.patch('dbdump.import_stream', recorder):
+            output, _error = import_dump_dir('/var/www/site', path)
+        self.assertIn('Imported 2 tables', output)
+        self.assertEqual(len(recorder.imports), 2)
+
+
+class FakeDatabase(object):
+    """A client for a database whose tables each hold one value, the
+    table's version, which is also its checksum"""
+
+    def __init__(self, **tables):
+        self.tables = tables
+
+    def query(self, sql, args=None):
+        """Answers get_table_status and CHECKSUM TABLE"""
+        if 'information_schema' in sql:
+            return [
+                {'TABLE_NAME': name, 'ENGINE': 'InnoDB', 'TABLE_ROWS': '1',
+                 'TABLE_SIZE': '16384', 'CREATE_TIME': '2026-01-01',
+                 'UPDATE_TIME': None, 'AUTO_INCREMENT': None,
+                 'TABLE_COMMENT': ''}
+                for name in sorted(self.tables)]
+        return [
+            {'Table': 'wp.' + name, 'Checksum': self.tables[name]}
+            for name in re.findall(r'`([^`]+)`', sql)]
+
+    def export(self, install_path, arguments, sink):
+        """Stands in for export_stream, dumping the --tables given"""
+        names = [argument[len('--tables='):].split(',')
+                 for argument in arguments
+                 if argument.startswith('--tables=')][0]
+        data = HEADER + b''.join(
+            b'--\n-- Table structure for table `%s`\n--\n'
+            b"INSERT INTO `%s` VALUES ('%s');\n" % (
+                name.encode(), name.encode(), self.tables[name].encode())
+            for name in names) + FOOTER
+        path = os.path.join(tempfile.mkdtemp(), 'export.sql')
+        with open(path, 'wb') as sql:
+            sql.write(data)
+        with open(path, 'rb') as sql:
+            sink(sql)
+        shutil.rmtree(os.path.dirname(path))
+
+
+class IncrementalDumpTest(unittest.TestCase):
+    """Revision chains of IncrementalDump, and their restore"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.database = FakeDatabase(
+            wp_options='o1', wp_posts='p1', wp_users='u1')
+        self.now = 1000.0
+        self.settings = dict(SETTINGS, incremental_full_every=10)
+
+    def revision(self, name):
+        """Dumps the database as revision name. Returns its manifest"""
+        self.now += 1
+        with mock.patch('dbdump.export_stream', self.database.export), \
+                mock.patch('dbdump.time.time', lambda: self.now):
+            path = IncrementalDump(
+                self.database, '/var/www/site',
+                os.path.join(self.directory, name), self.settings).run()
+        self.assertEqual(
+            path, os.path.join(self.directory, name + '.sqli'))
+        return read_manifest(path)
+
+    @staticmethod
+    def sources(manifest):
+        """Returns {table: source revision or None} of a manifest"""
+        return dict((table['name'], table.get('source'))
+                    for table in manifest['tables'])
+
+    def restore(self, name):
+        """Restores revision name. Returns {table: value restored}"""
+        recorder = ImportRecorder()
+        with mock.patch('dbdump.import_stream', recorder):
+            output, error = import_dump_dir(
+                '/var/www/site', os.path.join(self.directory, name))
+        self.assertIsNotNone(output, error)
+        restored = {}
+        for data in recorder.imports:
+            self.assertTrue(data.startswith(HEADER))
+            self.assertTrue(data.endswith(FOOTER))
+            for table, value in re.findall(
+                    rb"INSERT INTO `([^`]+)` VALUES \('([^']+)'\)", data):
+                restored[table.decode()] = value.decode()
+        return restored
+
+    def test_chain_of_revisions(self):
+        first = self.revision('rev1')
+        self.assertIsNone(first['parent'])
+        self.assertEqual(first['chain_length'], 0)
+        self.assertEqual(self.sources(first), {
+            'wp_options': None, 'wp_posts': None, 'wp_users': None})
+        self.database.tables['wp_posts'] = 'p2'
+        second = self.revision('rev2')
+        self.assertEqual(second['parent'], 'rev1.sqli')
+        self.assertEqual(second['chain_length'], 1)
+        self.assertEqual(self.sources(second), {
+            'wp_posts': None, 'wp_options': 'rev1.sqli',
+            'wp_users': 'rev1.sqli'})
+        self.database.tables['wp_users'] = 'u3'
+        third = self.revision('rev3')
+        self.assertEqual(third['parent'], 'rev2.sqli')
+        self.assertEqual(third['chain_length'], 2)
+        self.assertEqual(self.sources(third), {
+            'wp_users': None, 'wp_options': 'rev1.sqli',
+            'wp_posts': 'rev2.sqli'})
+        self.assertEqual(self.restore('rev3.sqli'), {
+            'wp_options': 'o1', 'wp_posts': 'p2', 'wp_users': 'u3'})
+        self.assertEqual(self.restore('rev2.sqli'), {
+            'wp_options': 'o1', 'wp_posts': 'p2', 'wp_users': 'u1'})
+
+    def test_unchanged_database_is_not_dumped_again(self):
+        self.revision('rev1')
+        second = self.revision('rev2')
+        self.assertEqual(set(self.sources(second).values()), {'rev1.sqli'})
+        self.assertEqual(self.restore('rev2.sqli'), {
+            'wp_options': 'o1', 'wp_posts': 'p1', 'wp_users': 'u1'})
+
+    def test_full_every_starts_a_new_chain(self):
+        self.settings['incremental_full_every'] = 3
+        for number in range(1, 4):
+            self.database.tables['wp_posts'] = 'p%d' % number
+            manifest = self.revision('rev%d' % number)
+            self.assertEqual(manifest['chain_length'], number - 1)
+        self.database.tables['wp_posts'] = 'p4'
+        fourth = self.revision('rev4')
+        self.assertIsNone(fourth['parent'])
+        self.assertEqual(fourth['chain_length'], 0)
+        self.assertEqual(set(self.sources(fourth).values()), {None})
+        self.database.tables['wp_posts'] = 'p5'
+        fifth = self.revision('rev5')
+        self.assertEqual(fifth['parent'], 'rev4.sqli')
+
+    def test_revision_with_missing_source_is_not_a_parent(self):
+        self.revision('rev1')
+        self.database.tables['wp_posts'] = 'p2'
+        self.revision('rev2')
+        self.database.tables['wp_users'] = 'u3'
+        self.revision('rev3')
+        shutil.rmtree(os.path.join(self.directory, 'rev2.sqli'))
+        fourth = self.revision('rev4')
+        # rev3 needs rev2, so the chain continues from rev1
+        self.assertEqual(fourth['parent'], 'rev1.sqli')
+        self.assertEqual(fourth['chain_length'], 1)
+        self.assertEqual(self.sources(fourth), {
+            'wp_options': 'rev1.sqli', 'wp_posts': None, 'wp_users': None})
+        self.assertEqual(self.restore('rev4.sqli'), {
+            'wp_options': 'o1', 'wp_posts': 'p2', 'wp_users': 'u3'})
+
+    def test_missing_parent_gives_full_dump(self):
+        self.revision('rev1')
+        shutil.rmtree(os.path.join(self.directory, 'rev1.sqli'))
+        self.database.tables['wp_posts'] = 'p2'
+        second = self.revision('rev2')
+        self.assertIsNone(second['parent'])
+        self.assertEqual(set(self.sources(second).values()), {None})
+
+    def test_restore_with_missing_source(self):
+        self.revision('rev1')
+        self.database.tables['wp_posts'] = 'p2'
+        self.revision('rev2')
+        shutil.rmtree(os.path.join(self.directory, 'rev1.sqli'))
+        recorder = ImportRecorder()
+        with mock.patch('dbdump.import_stream', recorder):
+            output, error = import_dump_dir(
+                '/var/www/site', os.path.join(self.directory, 'rev2.sqli'))
+        self.assertIsNone(output)
+        self.assertIn('rev1.sqli', error)
+        self.assertEqual(recorder.imports, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
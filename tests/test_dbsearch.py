@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Database search, against a client that answers from a list of rows"""
+import re
+import unittest
+from dbsearch import DbSearchEngine
+
+ROWS = [
+    {'ID': str(row_id), 'post_content': content}
+    for row_id, content in enumerate([
+        'Hello world', 'nothing here', 'WORLD news', 'x' * 60 + 'world',
+        'a world of 50% off', 'world_wide'], 1)]
+
+
+class FakeClient(object):
+    """Answers the queries DbSearchEngine makes for a wp_posts table
+    holding ROWS"""
+
+    def __init__(self):
+        self.closed = False
+        self.queries = []
+
+    def query(self, sql, args=None):
+        """Returns the column list, or the next batch of matching rows"""
+        self.queries.append(sql)
+        if 'information_schema' in sql:
+            return [
+                {'TABLE_NAME': 'wp_posts', 'COLUMN_NAME': 'ID',
+                 'DATA_TYPE': 'bigint', 'COLUMN_KEY': 'PRI'},
+                {'TABLE_NAME': 'wp_posts', 'COLUMN_NAME': 'post_content',
+                 'DATA_TYPE': 'longtext', 'COLUMN_KEY': ''}]
+        needle = args[0].strip('%').lower()
+        last = int(args[2]) if len(args) > 2 else 0
+        limit = int(re.search(r'LIMIT (\d+)', sql).group(1))
+        batch = []
+        for row in ROWS:
+            if int(row['ID']) > last and \
+                    needle in row['post_content'].lower():
+                batch.append(dict(row, match_0='1'))
+        return batch[:limit]
+
+    def close(self):
+        """Closes the connection"""
+        self.closed = True
+
+
+class DbSearchEngineTest(unittest.TestCase):
+    """DbSearchEngine"""
+
+    def engine(self, query, **settings):
+        """Returns an engine searching the fake client for query"""
+        self.clients = []
+
+        def connect():
+            client = FakeClient()
+            self.clients.append(client)
+            return client
+        settings.setdefault('search_batch', 2)
+        settings.setdefault('search_workers', 1)
+        settings.setdefault('search_context', 5)
+        return DbSearchEngine(connect, query, settings)
+
+    def test_argument_escapes_like_wildcards(self):
+        self.assertEqual(self.engine('50%_\\').argument(), '%50\\%\\_\\\\%')
+
+    def test_regex_query(self):
+        engine = self.engine('/^wor.d/')
+        self.assertTrue(engine.regex)
+        self.assertEqual(engine.argument(), '^wor.d')
+        self.assertIn('REGEXP', engine.condition('post_content'))
+        self.assertFalse(self.engine('/').regex)
+
+    def test_snippet(self):
+        engine = self.engine('world')
+        self.assertEqual(engine.snippet('Hi world'), 'Hi world')
+        self.assertEqual(engine.snippet('Hello world'), '...ello world')
+        self.assertEqual(engine.snippet('x' * 60 + 'world'),
+                         '...xxxxxworld')
+        self.assertEqual(engine.snippet('the WORLD is big and round'),
+                         'the WORLD is b...')
+
+    def test_pages(self):
+        engine = self.engine('world')
+        first, more = engine.page(0, 3)
+        self.assertEqual([match['row'] for match in first], ['1', '3', '4'])
+        self.assertTrue(more)
+        second, more = engine.page(1, 3)
+        self.assertEqual([match['row'] for match in second], ['5', '6'])
+        self.assertFalse(more)
+        # pages are kept for paging back
+        self.assertEqual(engine.page(0, 3)[0], first)
+        self.assertEqual(engine.page(2, 3), ([], False))
+
+    def test_cancel_keeps_the_pages_read(self):
+        engine = self.engine('world')
+        first, _more = engine.page(0, 1)
+        engine.cancel()
+        self.assertTrue(engine.stopped)
+        self.assertEqual(engine.page(0, 1), (first, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
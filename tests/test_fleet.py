@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Fleet runs back up each installation before changing it"""
+import unittest
+from collections import OrderedDict
+from threading import Lock
+from types import SimpleNamespace
+from unittest import mock
+from actions import FleetActions, RevisionActions
+from fleet import FleetOperation
+from jobqueue import DONE, FAILED, SKIPPED, TaskFailed
+
+SITES = ['/home/a/public_html', '/home/b/public_html']
+
+
+class FakeRevisions(object):
+    """Stands in for RevisionActions, recording the backups made"""
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.events = []
+        self.backups = []
+        self.lock = Lock()
+
+    def record(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def backup_job(self, kind=None, name=None, src=None, install_path=None,
+                   backup_db=None):
+        self.backups.append((install_path, kind, name, src, backup_db))
+        self.record(('backup', install_path))
+        if install_path in self.failing:
+            raise TaskFailed('Backup failed')
+        return 'Backed up'
+
+
+class FleetRunTest(unittest.TestCase):
+    """FleetActions.run with stand-ins for wp-cli and the backups"""
+
+    def run_fleet(self, operation, values, failing=()):
+        self.revisions = FakeRevisions(failing)
+        app = SimpleNamespace(
+            settings=SimpleNamespace(fleet={'installation_limit': 1}),
+            state=SimpleNamespace(
+                fleet=OrderedDict((site, {}) for site in SITES),
+                active_view_name='Installs'),
+            loop=SimpleNamespace(watch_pipe=lambda callback: None))
+        fleet = FleetActions(app, self.revisions)
+
+        def change(operation, install_path):
+            self.revisions.record(('change', install_path))
+            return 'Updated'
+
+        def wpcli(app, arguments, install_path=None):
+            return install_path + '/wp-content/plugins/akismet\n', ''
+
+        with mock.patch.object(FleetOperation, 'run', change), \
+                mock.patch('fleet.Call.wpcli', wpcli):
+            self.assertIsNone(fleet.run(operation, values))
+            fleet.queue.wait()
+        return fleet.queue.records()
+
+    def test_backup_runs_before_the_change(self):
+        records = self.run_fleet('plugin-update', ['akismet'])
+        for site in SITES:
+            events = [event for event, path in self.revisions.events
+                      if path == site]
+            self.assertEqual(events, ['backup', 'change'])
+        self.assertEqual(sorted(self.revisions.backups), [
+            (site, 'plugin', 'akismet',
+             site + '/wp-content/plugins/akismet', True)
+            for site in SITES])
+        self.assertEqual(
+            [(record['group'], record['status']) for record in records],
+            [(SITES[0], DONE), (SITES[0], DONE),
+             (SITES[1], DONE), (SITES[1], DONE)])
+        self.assertTrue(records[0]['label'].startswith('Back up'))
+
+    def test_failed_backup_skips_the_change(self):
+        records = self.run_fleet(
+            'plugin-update-all', [], failing=[SITES[0]])
+        self.assertEqual(
+            [(record['group'], record['status']) for record in records],
+            [(SITES[0], FAILED), (SITES[0], SKIPPED),
+             (SITES[1], DONE), (SITES[1], DONE)])
+        self.assertNotIn(('change', SITES[0]), self.revisions.events)
+        self.assertEqual(
+            sorted(backup[:3] for backup in self.revisions.backups),
+            [(site, 'plugin', 'all_plugins') for site in SITES])
+
+    def test_database_only_backup(self):
+        self.run_fleet('search-replace', ['a.com', 'b.com'])
+        self.assertEqual(
+            sorted(self.revisions.backups),
+            [(site, None, None, None, True) for site in SITES])
+
+    def test_dry_run_is_not_backed_up(self):
+        records = self.run_fleet('search-replace-dry-run', ['a', 'b'])
+        self.assertEqual(self.revisions.backups, [])
+        self.assertEqual(len(records), len(SITES))
+
+
+class BackupOptionsTest(unittest.TestCase):
+    """Revisions of installations other than the active one"""
+
+    def setUp(self):
+        self.revisions = RevisionActions.__new__(RevisionActions)
+        self.revisions.app = SimpleNamespace(
+            settings=SimpleNamespace(
+                datetime={'date_string': '%Y-%m-%d_%H:%M:%S'}),
+            state=SimpleNamespace(
+                active_installation={'directory': SITES[0]}))
+        self.revisions.temp_dir = '/tmp/wpui'
+        self.revisions.options_lock = Lock()
+        self.revisions.last_options = {}
+
+    def test_options_name_the_installation(self):
+        active = self.revisions.next_backup_options()
+        other = self.revisions.next_backup_options(SITES[1])
+        self.assertEqual(active['install_path'], SITES[0])
+        self.assertEqual(active['install_dir'], 'public_html')
+        self.assertEqual(other['install_path'], SITES[1])
+
+    def test_revisions_are_distinct_per_install_dir(self):
+        # both sites' revisions are stored under public_html
+        first = self.revisions.next_backup_options(SITES[0])
+        second = self.revisions.next_backup_options(SITES[1])
+        self.assertNotEqual(first['copy_time'], second['copy_time'])
+        self.assertIs(self.revisions.last_options['public_html'], second)
+        other = self.revisions.next_backup_options('/home/c/blog')
+        self.assertEqual(other['install_dir'], 'blog')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Plugin and theme headers read from disk"""
+import os
+import shutil
+import tempfile
+import unittest
+from headers import (
+    HEADER_BYTES, PLUGIN_HEADERS, THEME_HEADERS, get_file_data,
+    read_plugin, read_theme, scan_plugins)
+
+
+class HeadersTest(unittest.TestCase):
+    """Reads headers from files in a temp directory"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, relative, text, mode='w'):
+        """Writes a file under root. Returns its path"""
+        path = os.path.join(self.root, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode) as header_file:
+            header_file.write(text)
+        return path
+
+    def test_plugin_header_block(self):
+        path = self.write('hello/hello.php', (
+            "<?php\n"
+            "/**\n"
+            " * Plugin Name: Hello Dolly\n"
+            " * Version:     1.7.2\n"
+            " * Update URI:  https://example.com/hello\n"
+            " * Description: Lyrics. */\n"))
+        data = get_file_data(path, PLUGIN_HEADERS)
+        self.assertEqual(data['Name'], 'Hello Dolly')
+        self.assertEqual(data['Version'], '1.7.2')
+        self.assertEqual(data['UpdateURI'], 'https://example.com/hello')
+        self.assertEqual(data['Description'], 'Lyrics.')
+        self.assertEqual(data['Author'], '')
+
+    def test_comment_styles_and_line_endings(self):
+        path = self.write('single.php', (
+            "<?php // Plugin Name: Single ?>\r"
+            "# version: 2.0\r\n"
+            "@Author: Someone\n"))
+        data = get_file_data(path, PLUGIN_HEADERS)
+        self.assertEqual(
+            (data['Name'], data['Version'], data['Author']),
+            ('Single', '2.0', 'Someone'))
+
+    def test_reads_only_the_start_of_the_file(self):
+        path = self.write('late.php', (
+            '<?php\n' + '/' * HEADER_BYTES + '\n/* Plugin Name: Late */'))
+        self.assertEqual(get_file_data(path, PLUGIN_HEADERS)['Name'], '')
+
+    def test_invalid_utf8(self):
+        path = self.write('bytes.php', (
+            b'<?php\n/* Plugin Name: Caf\xe9\n */'), mode='wb')
+        self.assertEqual(get_file_data(path, PLUGIN_HEADERS)['Name'],
+                         'Caf�')
+
+    def test_read_plugin_finds_the_main_file(self):
+        self.write('multi/includes.php', '<?php // helpers')
+        self.write('multi/zz-main.php', '<?php /* Plugin Name: Multi */')
+        self.write('solo.php', '<?php /* Plugin Name: Solo */')
+        self.assertEqual(read_plugin(self.root, 'multi')['File'],
+                         os.path.join('multi', 'zz-main.php'))
+        self.assertEqual(read_plugin(self.root, 'solo')['File'], 'solo.php')
+        self.assertIsNone(read_plugin(self.root, 'missing'))
+        self.assertEqual(
+            sorted(scan_plugins(self.root, workers=2)), ['multi', 'solo'])
+
+    def test_read_theme(self):
+        self.write('child/style.css', (
+            '/*\nTheme Name: Child\nTemplate: parent\nVersion: 1.0\n*/'))
+        theme = read_theme(self.root, 'child')
+        self.assertEqual((theme['Name'], theme['Template']),
+                         ('Child', 'parent'))
+        self.assertEqual(set(theme), set(THEME_HEADERS))
+        self.assertIsNone(read_theme(self.root, 'missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Renders the Installs view's streaming mode"""
+import os
+import unittest
+from collections import OrderedDict
+from types import SimpleNamespace
+import urwid as U
+import body_widgets
+
+
+class InstallsStreamTest(unittest.TestCase):
+    """Feeds installations to an Installs body the way Installations
+    does, and renders the rows flush_rows builds"""
+
+    def setUp(self):
+        self.frame = U.Frame(U.Filler(U.Text('')))
+        self.loop = U.MainLoop(self.frame)
+        self.app = SimpleNamespace(
+            loop=self.loop,
+            frame=self.frame,
+            state=SimpleNamespace(
+                active_view_name='Installs',
+                fleet=OrderedDict(),
+                set_installation=None,
+                mark_for_fleet=None),
+            views=SimpleNamespace(
+                activate=None,
+                actions=SimpleNamespace(wp_config=SimpleNamespace(
+                    rescan_installations=None))))
+        self.body = body_widgets.Installs(
+            self.app, 'Loading', progress_bar=True)
+
+    def flush(self):
+        """Runs the main loop's side of the stream pipe once"""
+        read_fd = self.loop._watch_pipes[self.body.stream_pipe][1]
+        return self.body.flush_rows(os.read(read_fd, 100))
+
+    def render(self):
+        """Returns the rendered list as text"""
+        canvas = U.ListBox(self.body.walker).render((140, 20))
+        return b'\n'.join(canvas.text).decode('utf-8')
+
+    def test_stream_renders(self):
+        probed = {
+            'directory': '/home/user/public_html',
+            'home_url': 'https://example.com',
+            'valid_wp_options': True,
+            'wp_db_check_success': True,
+            'wp_db_error': ''}
+        pending = {
+            'directory': '/home/user/staging',
+            'home_url': '',
+            'valid_wp_options': False,
+            'wp_db_check_success': False,
+            'wp_db_error': ''}
+        self.body.add_installation(probed)
+        self.body.update_installation(probed)
+        self.body.add_installation(pending)
+        self.assertTrue(self.flush())
+        text = self.render()
+        self.assertIn('Location', text)
+        self.assertIn('https://example.com', text)
+        self.assertIn('...', text)
+        self.body.update_installation(pending)
+        self.body.finish_stream()
+        self.assertFalse(self.flush())
+        self.assertNotIn('...', self.render())
+
+    def test_empty_stream(self):
+        self.body.finish_stream()
+        self.assertFalse(self.flush())
+        self.assertIn('There Are No WordPress Installations', self.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""JobQueue ordering, skipping, limits and cancellation"""
+import os
+import time
+import unittest
+from threading import Event, Lock
+from jobqueue import (
+    CANCELLED, DONE, FAILED, SKIPPED, JobQueue, TaskFailed)
+
+
+class Recorder(object):
+    """Task functions that record their order, and how many of them
+    ran at once"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.order = []
+        self.running = 0
+        self.most = 0
+
+    def task(self, name, seconds=0.0, fail=False, gate=None):
+        """Returns a task function"""
+        def func():
+            with self.lock:
+                self.running += 1
+                self.most = max(self.most, self.running)
+            try:
+                if gate:
+                    gate.wait(5)
+                time.sleep(seconds)
+                if fail:
+                    raise TaskFailed('%s failed' % name)
+                return name
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.order.append(name)
+        return func
+
+
+class JobQueueTest(unittest.TestCase):
+    """JobQueue"""
+
+    def setUp(self):
+        self.recorder = Recorder()
+
+    def statuses(self, queue):
+        """Returns {label: status} of queue's tasks"""
+        return dict((label, status)
+                    for label, status, _message, _seconds in queue.rows())
+
+    def test_runs_after_prerequisites(self):
+        queue = JobQueue({'backup': 4, 'wpcli': 1})
+        queue.add('b', 'b', self.recorder.task('b', 0.05), 'backup')
+        queue.add('a', 'a', self.recorder.task('a'), 'wpcli', ['b'])
+        queue.start()
+        queue.wait()
+        self.assertEqual(self.recorder.order, ['b', 'a'])
+        self.assertIn('2 done', queue.summary())
+
+    def test_failure_skips_dependents_only(self):
+        queue = JobQueue({'backup': 2, 'wpcli': 1})
+        queue.add('bad', 'bad', self.recorder.task('bad', fail=True),
+                  'backup')
+        queue.add('good', 'good', self.recorder.task('good'), 'backup')
+        queue.add('after-bad', 'after-bad', self.recorder.task('x'),
+                  'wpcli', ['bad'])
+        queue.add('after-skip', 'after-skip', self.recorder.task('y'),
+                  'wpcli', ['after-bad'])
+        queue.add('after-good', 'after-good', self.recorder.task('z'),
+                  'wpcli', ['good'])
+        queue.start()
+        queue.wait()
+        self.assertEqual(self.statuses(queue), {
+            'bad': FAILED, 'good': DONE, 'after-bad': SKIPPED,
+            'after-skip': SKIPPED, 'after-good': DONE})
+        self.assertEqual(queue.records()[0]['message'], 'bad failed')
+
+    def test_unexpected_error_fails_the_task(self):
+        queue = JobQueue()
+        queue.add('boom', 'boom', lambda: 1 / 0)
+        queue.start()
+        queue.wait()
+        self.assertEqual(self.statuses(queue), {'boom': FAILED})
+
+    def test_resource_limit(self):
+        queue = JobQueue({'download': 2})
+        for index in range(6):
+            queue.add(index, str(index),
+                      self.recorder.task(index, 0.05), 'download')
+        queue.start()
+        queue.wait()
+        self.assertEqual(self.recorder.most, 2)
+
+    def test_group_limit(self):
+        queue = JobQueue({'wpcli': 4}, group_limit=1)
+        for index in range(4):
+            queue.add(index, str(index), self.recorder.task(index, 0.05),
+                      'wpcli', group='site')
+        queue.start()
+        queue.wait()
+        self.assertEqual(self.recorder.most, 1)
+        self.assertEqual(self.recorder.order, [0, 1, 2, 3])
+
+    def test_unknown_resource_and_prerequisite(self):
+        queue = JobQueue()
+        with self.assertRaises(ValueError):
+            queue.add('a', 'a', lambda: '', 'nowhere')
+        with self.assertRaises(ValueError):
+            queue.add('a', 'a', lambda: '', 'wpcli', ['missing'])
+
+    def test_finished_queue_takes_no_tasks(self):
+        queue = JobQueue()
+        queue.add('a', 'a', lambda: '')
+        queue.start()
+        queue.wait()
+        self.assertFalse(queue.add('b', 'b', lambda: ''))
+        self.assertFalse(queue.hold())
+
+    def test_hold_keeps_the_queue_open(self):
+        queue = JobQueue()
+        self.assertTrue(queue.hold())
+        queue.add('a', 'a', lambda: '')
+        queue.start()
+        time.sleep(0.05)
+        self.assertFalse(queue.closed)
+        self.assertTrue(queue.add('b', 'b', lambda: '', after=['a']))
+        queue.release()
+        queue.wait()
+        self.assertEqual(self.statuses(queue), {'a': DONE, 'b': DONE})
+
+    def test_finished_task_can_run_again(self):
+        queue = JobQueue()
+        gate = Event()
+        queue.hold()
+        queue.add('a', 'first', self.recorder.task('first', fail=True))
+        queue.add('gate', 'gate', self.recorder.task('gate', gate=gate))
+        queue.start()
+        while self.statuses(queue)['first'] != FAILED:
+            time.sleep(0.01)
+        self.assertFalse(queue.active('a'))
+        self.assertTrue(queue.active('gate'))
+        with self.assertRaises(ValueError):
+            queue.add('gate', 'gate', lambda: '')
+        queue.add('a', 'second', self.recorder.task('second'))
+        gate.set()
+        queue.release()
+        queue.wait()
+        self.assertEqual([label for label, _status, _message, _seconds
+                          in queue.rows()], ['gate', 'second'])
+        self.assertEqual(self.statuses(queue)['second'], DONE)
+
+    def test_cancel_is_per_queue(self):
+        gate = Event()
+        cancelled = JobQueue()
+        other = JobQueue()
+        for queue in (cancelled, other):
+            queue.add('running', 'running', self.recorder.task(
+                'running', gate=gate))
+            queue.add('waiting', 'waiting', self.recorder.task('waiting'),
+                      after=['running'])
+            queue.start()
+        cancelled.cancel()
+        self.assertFalse(cancelled.add('late', 'late', lambda: ''))
+        gate.set()
+        for queue in (cancelled, other):
+            queue.wait()
+        self.assertEqual(self.statuses(cancelled), {
+            'running': DONE, 'waiting': CANCELLED})
+        self.assertEqual(self.statuses(other), {
+            'running': DONE, 'waiting': DONE})
+
+    def test_cancel_all(self):
+        gate = Event()
+        queues = [JobQueue(), JobQueue()]
+        for queue in queues:
+            queue.add('running', 'running', self.recorder.task(
+                'running', gate=gate))
+            queue.add('waiting', 'waiting', lambda: '', after=['running'])
+            queue.start()
+        JobQueue.cancel_all()
+        gate.set()
+        for queue in queues:
+            queue.wait()
+            self.assertEqual(self.statuses(queue)['waiting'], CANCELLED)
+
+    def test_current(self):
+        queue = JobQueue()
+        queue.add('a', 'a', lambda: str(JobQueue.current() is queue))
+        queue.start()
+        queue.wait()
+        self.assertEqual(queue.records()[0]['message'], 'True')
+        self.assertIsNone(JobQueue.current())
+
+    def test_progress_fd(self):
+        read_fd, write_fd = os.pipe()
+        queue = JobQueue(progress_fd=write_fd)
+        queue.add('a', 'a', lambda: '')
+        queue.start()
+        queue.wait()
+        with os.fdopen(read_fd, 'rb') as progress:
+            # closed after the last change, so this reads to the end
+            self.assertTrue(progress.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
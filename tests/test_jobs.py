@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Job timeouts, cancellation and ownership, with real short lived
+processes"""
+import os
+import signal
+import time
+import unittest
+from jobs import CANCELLED, DONE, FAILED, TIMED_OUT, Job
+
+# a process group that ignores SIGTERM, so only SIGKILL ends it
+IGNORES_TERM = ['sh', '-c', 'trap "" TERM; sleep 30']
+
+
+class JobTest(unittest.TestCase):
+    """Job statuses and stopping"""
+
+    def setUp(self):
+        self.settings = Job.settings
+        Job.configure({'grace_period': 0.5, 'timeouts': {'db export': 60}})
+        self.jobs = []
+
+    def tearDown(self):
+        for job in self.jobs:
+            if job.proc and job.proc.poll() is None:
+                job.signal_group(signal.SIGKILL)
+                job.proc.wait()
+        Job.settings = self.settings
+        Job.context.owner = None
+
+    def job(self, args, **options):
+        job = Job(args, **options)
+        self.jobs.append(job)
+        return job
+
+    def assertGroupGone(self, job):
+        """The job's process group has no processes left, once orphaned
+        children have been reaped"""
+        deadline = time.time() + 2
+        while time.time() < deadline:
+            try:
+                os.killpg(job.proc.pid, 0)
+            except ProcessLookupError:
+                return
+            time.sleep(0.05)
+        self.fail('process group %s is still running' % job.proc.pid)
+
+    def test_done_and_failed(self):
+        job = self.job(['true'])
+        self.assertEqual(job.communicate(), ('', ''))
+        self.assertEqual(job.status, DONE)
+        job = self.job(['sh', '-c', 'echo oops >&2; exit 3'])
+        self.assertEqual(job.communicate(), ('', 'oops\n'))
+        self.assertEqual(job.status, FAILED)
+        self.assertEqual(job.message(), 'Error: failed with exit status 3')
+
+    def test_timeout(self):
+        job = self.job(['sleep', '30'], timeout=0.2)
+        start = time.time()
+        _output, error = job.communicate()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(job.status, TIMED_OUT)
+        self.assertEqual(error, 'Error: timed out after 0.2s')
+        self.assertGroupGone(job)
+
+    def test_timeout_from_settings(self):
+        self.assertEqual(
+            Job.get_timeout(['wp', 'db', 'export', '-', '--path=/x']), 60)
+        self.assertEqual(Job.get_timeout(['wp', 'db', 'check']), 0)
+
+    def test_cancel(self):
+        job = self.job(['sleep', '30'], interactive=True)
+        job.start()
+        self.assertEqual(Job.cancel_interactive(), 1)
+        self.assertEqual(job.finish(), CANCELLED)
+        self.assertEqual(job.message(), 'Error: cancelled')
+        self.assertNotIn(job, Job.active)
+
+    def test_group_is_killed_after_grace_period(self):
+        job = self.job(IGNORES_TERM)
+        job.start()
+        # let sh install its trap before it is signalled
+        time.sleep(0.2)
+        start = time.time()
+        job.stop()
+        self.assertEqual(job.finish(), CANCELLED)
+        elapsed = time.time() - start
+        self.assertGreaterEqual(elapsed, 0.4)
+        self.assertLess(elapsed, 5)
+        self.assertGroupGone(job)
+
+    def test_lines_reader_giving_up_stops_the_job(self):
+        job = self.job(['sh', '-c', 'echo one; echo two; sleep 30'])
+        lines = job.lines()
+        self.assertEqual(next(lines), b'one\n')
+        lines.close()
+        self.assertEqual(job.status, CANCELLED)
+        self.assertGroupGone(job)
+
+    def test_queue_jobs_are_not_cancelled_interactively(self):
+        owner = object()
+        Job.context.owner = owner
+        owned = self.job(['sleep', '30'], interactive=True)
+        Job.context.owner = None
+        unowned = self.job(['sleep', '30'], interactive=True)
+        owned.start()
+        unowned.start()
+        self.assertEqual(Job.cancel_interactive(), 1)
+        self.assertEqual(unowned.finish(), CANCELLED)
+        time.sleep(0.2)
+        self.assertIsNone(owned.proc.poll())
+        Job.stop_owned(owner)
+        self.assertEqual(owned.finish(), CANCELLED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""ObjectStore snapshots and collection"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from objectstore import ObjectStore
+
+
+class ObjectStoreTest(unittest.TestCase):
+    """Snapshots a small tree into a store in a temp directory"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.root = os.path.join(self.directory, 'store')
+        self.src = os.path.join(self.directory, 'plugin')
+        self.revisions = os.path.join(self.root, 'site', 'plugins')
+        os.makedirs(self.revisions)
+        os.makedirs(os.path.join(self.src, 'inc'))
+        self.write('plugin.php', '<?php // plugin')
+        self.write('inc/functions.php', '<?php // functions')
+        self.store = ObjectStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, relative, text):
+        """Writes a file of the source tree"""
+        with open(os.path.join(self.src, relative), 'w') as source_file:
+            source_file.write(text)
+
+    def snapshot(self, name):
+        """Snapshots the source tree. Returns the manifest path"""
+        manifest_path = os.path.join(self.revisions, name + '.manifest')
+        self.store.snapshot(self.src, manifest_path)
+        return manifest_path
+
+    def objects(self):
+        """Returns the number of stored objects"""
+        return sum(len(files) for _root, _dirs, files
+                   in os.walk(self.store.objects))
+
+    def age_objects(self):
+        """Backdates the stored objects, as if an earlier pass wrote
+        them"""
+        for root, _dirs, files in os.walk(self.store.objects):
+            for name in files:
+                os.utime(os.path.join(root, name), (1, 1))
+
+    def test_unchanged_files_are_stored_once(self):
+        self.snapshot('1')
+        self.write('plugin.php', '<?php // changed')
+        self.snapshot('2')
+        self.assertEqual(self.objects(), 3)
+
+    def test_materialize(self):
+        manifest_path = self.snapshot('1')
+        dest = os.path.join(self.directory, 'restored')
+        self.store.materialize(manifest_path, dest)
+        with open(os.path.join(dest, 'inc', 'functions.php')) as restored:
+            self.assertEqual(restored.read(), '<?php // functions')
+
+    def test_collect_keeps_objects_of_manifests_on_disk(self):
+        old = self.snapshot('1')
+        self.write('plugin.php', '<?php // changed')
+        self.snapshot('2')
+        os.remove(old)
+        self.age_objects()
+        removed, _bytes = self.store.collect(
+            lambda: self.store.referenced(self.root), time.time())
+        self.assertEqual((removed, self.objects()), (1, 2))
+
+    def test_collect_keeps_objects_written_during_the_pass(self):
+        since = time.time()
+        manifest_path = self.snapshot('1')
+        os.remove(manifest_path)
+        removed, _bytes = self.store.collect(lambda: set(), since)
+        self.assertEqual((removed, self.objects()), (0, 2))
+
+    def test_unreadable_manifest_keeps_everything(self):
+        self.snapshot('1')
+        with open(os.path.join(self.revisions, 'bad.manifest'), 'w') as bad:
+            bad.write('{')
+        self.age_objects()
+        self.assertIsNone(self.store.referenced(self.root))
+        self.assertEqual(self.store.collect(
+            lambda: self.store.referenced(self.root), time.time()), (0, 0))
+        self.assertEqual(self.objects(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Serialization aware replacement"""
+import binascii
+import unittest
+from searchreplace import (
+    SearchReplaceCancelled, SearchReplaceEngine, SerializedError,
+    hex_literal, like_pattern, replace_serialized, replace_value)
+
+
+class ReplaceValueTest(unittest.TestCase):
+    """replace_value and replace_serialized"""
+
+    def test_plain_text(self):
+        self.assertEqual(
+            replace_value(b'see http://old.test/a', b'http://old.test',
+                          b'https://new.test'),
+            b'see https://new.test/a')
+
+    def test_no_match_is_unchanged(self):
+        value = b'a:1:{i:0;s:3:"abc";}'
+        self.assertIs(replace_value(value, b'xyz', b'q'), value)
+
+    def test_string_length_is_fixed(self):
+        self.assertEqual(
+            replace_value(b's:15:"http://old.test";', b'old', b'brand-new'),
+            b's:21:"http://brand-new.test";')
+
+    def test_multibyte_lengths_are_in_bytes(self):
+        value = 's:9:"caf\xe9 old";'.encode('utf-8')
+        self.assertEqual(
+            replace_value(value, b'old', 'üß'.encode('utf-8')),
+            's:10:"caf\xe9 \xfc\xdf";'.encode('utf-8'))
+
+    def test_nested_arrays(self):
+        value = (b'a:2:{s:4:"home";s:12:"http://a.com";'
+                 b's:5:"links";a:1:{i:0;s:18:"http://a.com/page/";}}')
+        self.assertEqual(
+            replace_value(value, b'a.com', b'example.org'),
+            b'a:2:{s:4:"home";s:18:"http://example.org";'
+            b's:5:"links";a:1:{i:0;s:24:"http://example.org/page/";}}')
+
+    def test_objects(self):
+        value = (b'O:8:"stdClass":2:{s:3:"url";s:12:"http://a.com";'
+                 b's:4:"size";i:3;}')
+        self.assertEqual(
+            replace_value(value, b'a.com', b'b.co'),
+            b'O:8:"stdClass":2:{s:3:"url";s:11:"http://b.co";'
+            b's:4:"size";i:3;}')
+
+    def test_array_keys_are_kept(self):
+        value = (b'a:2:{s:12:"http://a.com";s:5:"a.com";'
+                 b'i:7;s:12:"http://a.com";}')
+        self.assertEqual(
+            replace_value(value, b'a.com', b'b.org'),
+            b'a:2:{s:12:"http://a.com";s:5:"b.org";'
+            b'i:7;s:12:"http://b.org";}')
+
+    def test_property_names_are_kept(self):
+        value = (b'O:4:"Site":2:{s:10:"\0Site\0site";s:5:"Site!";'
+                 b's:7:"\0*\0Site";s:4:"Site";}')
+        self.assertEqual(
+            replace_value(value, b'Site', b'Place'),
+            b'O:4:"Site":2:{s:10:"\0Site\0site";s:6:"Place!";'
+            b's:7:"\0*\0Site";s:5:"Place";}')
+
+    def test_invalid_key(self):
+        with self.assertRaises(SerializedError):
+            replace_serialized(b'a:1:{d:0.5;i:1;}', 0, b'a', b'b')
+
+    def test_serialized_inside_a_string(self):
+        inner = b'a:1:{i:0;s:5:"a.com";}'
+        value = b's:%d:"%s";' % (len(inner), inner)
+        replaced = b'a:1:{i:0;s:7:"b.co.uk";}'
+        self.assertEqual(replace_value(value, b'a.com', b'b.co.uk'),
+                         b's:%d:"%s";' % (len(replaced), replaced))
+
+    def test_scalars_and_custom_payloads_are_kept(self):
+        value = b'a:3:{i:0;b:1;i:1;d:0.5;i:2;C:3:"Foo":5:{a.com}}'
+        self.assertEqual(replace_serialized(value, 0, b'a.com', b'x'),
+                         (value, len(value)))
+
+    def test_broken_serialization_is_replaced_as_text(self):
+        self.assertEqual(replace_value(b's:99:"a.com";', b'a.com', b'b'),
+                         b's:99:"b";')
+
+    def test_unknown_type(self):
+        with self.assertRaises(SerializedError):
+            replace_serialized(b'Z:1;', 0, b'a', b'b')
+
+
+class SqlTest(unittest.TestCase):
+    """like_pattern and hex_literal"""
+
+    def test_like_pattern_escapes_wildcards(self):
+        self.assertEqual(like_pattern(b'50%_a\\b'), b'%50\\%\\_a\\\\b%')
+
+    def test_hex_literal(self):
+        self.assertEqual(hex_literal(b''), "''")
+        self.assertEqual(hex_literal(b'\x00a'), "UNHEX('0061')")
+
+
+class FakeClient(object):
+    """Answers the queries of a real run over one wp_options table whose
+    rows all match"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.updates = []
+
+    def query(self, sql, args=None):
+        """Returns the table, its columns, or the next batch of rows"""
+        if sql.startswith('UPDATE'):
+            self.updates.append(args)
+            return []
+        if 'information_schema.TABLES' in sql:
+            return [{'TABLE_NAME': 'wp_options'}]
+        if 'information_schema.COLUMNS' in sql:
+            return [
+                {'COLUMN_NAME': 'option_id', 'DATA_TYPE': 'bigint',
+                 'COLUMN_KEY': 'PRI'},
+                {'COLUMN_NAME': 'option_value', 'DATA_TYPE': 'longtext',
+                 'COLUMN_KEY': ''}]
+        last = int(args[0]) if args else 0
+        return [{'option_id': str(row_id),
+                 'hex_option_value': binascii.hexlify(value).decode()}
+                for row_id, value in enumerate(self.rows, 1)
+                if row_id > last][:2]
+
+    def close(self):
+        """Closes the connection"""
+
+
+class SearchReplaceEngineTest(unittest.TestCase):
+    """SearchReplaceEngine over a fake client"""
+
+    def setUp(self):
+        self.client = FakeClient([b'http://a.com'] * 5)
+
+    def engine(self, cancelled=None):
+        """Returns a real run replacing a.com, in batches of 2 rows"""
+        return SearchReplaceEngine(
+            lambda: self.client, 'a.com', 'b.com',
+            {'search_replace_batch': 2, 'search_replace_workers': 1},
+            dry_run=False, cancelled=cancelled)
+
+    def test_run(self):
+        results = self.engine().run()
+        self.assertEqual(results['count'], '5')
+        self.assertEqual(len(self.client.updates), 5)
+
+    def test_cancel_between_batches(self):
+        checks = []
+
+        def cancelled():
+            checks.append(True)
+            return len(checks) > 1
+        with self.assertRaises(SearchReplaceCancelled):
+            self.engine(cancelled).run()
+        self.assertEqual(self.client.updates, [['1'], ['2']])
+
+
+if __name__ == '__main__':
+    unittest.main()
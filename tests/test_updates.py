@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Update availability, against a stub update API"""
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from updates import UpdateCache, update_fields, uses_api, version_key
+
+
+class VersionTest(unittest.TestCase):
+    """version_key, update_fields and uses_api"""
+
+    def test_version_order(self):
+        versions = ['1.0-beta', '1.0-RC1', '1.0', '1.0.1', '1.2', '1.10',
+                    '2.0-alpha.2', '2.0']
+        self.assertEqual(sorted(reversed(versions), key=version_key),
+                         versions)
+
+    def test_update_fields(self):
+        entry = {'new_version': '2.0', 'package': 'https://x/p.zip'}
+        self.assertEqual(update_fields('1.9', entry), {
+            'update': 'available', 'update_version': '2.0',
+            'update_package': 'https://x/p.zip'})
+        self.assertEqual(
+            update_fields('1.9', {'new_version': '2.0', 'package': ''})[
+                'update'], 'unavailable')
+        for version, entry in (('2.0', entry), ('2.1', entry),
+                               ('1.0', None), ('1.0', {'new_version': ''})):
+            self.assertEqual(update_fields(version, entry)['update'], 'none')
+        self.assertEqual(update_fields('1.0', {'failed': True})['update'],
+                         'check failed')
+
+    def test_uses_api(self):
+        for uri in ('', None, 'https://wordpress.org/plugins/x/',
+                    'w.org/plugin/x'):
+            self.assertTrue(uses_api(uri), uri)
+        for uri in ('https://example.com/updates', 'false', 'example.com'):
+            self.assertFalse(uses_api(uri), uri)
+
+
+class StubApi(BaseHTTPRequestHandler):
+    """Answers plugin update checks from the server's responses, and
+    records the plugins each request asked about"""
+
+    def do_POST(self):
+        """Handles an update check"""
+        length = int(self.headers['Content-Length'])
+        fields = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        self.server.requests.append(
+            json.loads(fields['plugins'][0])['plugins'])
+        if self.server.fail:
+            self.send_error(500)
+            return
+        body = json.dumps(self.server.response).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keeps the test output quiet"""
+
+
+class UpdateCacheTest(unittest.TestCase):
+    """UpdateCache.add_updates"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), StubApi)
+        self.server.requests = []
+        self.server.fail = False
+        self.server.response = {
+            'plugins': {'akismet/akismet.php': {
+                'new_version': '5.3', 'package': 'https://x/akismet.zip'}},
+            'no_update': {'hello.php': {'new_version': '1.7.2'}}}
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.cache = UpdateCache(self.root, {
+            'plugins_api': 'http://127.0.0.1:%d/' % self.server.server_port,
+            'timeout': 5,
+            'retry_after': 300})
+        self.listing = [
+            {'name': 'akismet', 'status': 'active', 'version': '5.2',
+             'file': 'akismet/akismet.php', 'title': 'Akismet',
+             'headers': {'Name': 'Akismet', 'Version': '5.2',
+                         'Author': 'Automattic', 'UpdateURI': '',
+                         'File': 'akismet/akismet.php'}},
+            {'name': 'hello', 'status': 'inactive', 'version': '1.7.2',
+             'file': 'hello.php', 'title': 'Hello Dolly'},
+            {'name': 'private', 'status': 'active', 'version': '1.0',
+             'file': 'private/private.php', 'title': 'Private',
+             'headers': {'Name': 'Private', 'Version': '1.0',
+                         'UpdateURI': 'https://example.com/private'}},
+            {'name': 'loader', 'status': 'must-use', 'version': '',
+             'file': 'loader.php', 'title': 'loader'}]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def updates(self, listing):
+        """Returns {name: update} of listing"""
+        return dict((item['name'], item['update']) for item in listing)
+
+    def test_one_request_then_cached(self):
+        self.assertEqual(self.updates(
+            self.cache.add_updates('plugin', self.listing)), {
+                'akismet': 'available', 'hello': 'none', 'private': 'none',
+                'loader': 'none'})
+        self.assertEqual(len(self.server.requests), 1)
+        sent = self.server.requests[0]
+        self.assertEqual(sorted(sent), ['akismet/akismet.php', 'hello.php'])
+        self.assertEqual(sent['akismet/akismet.php']['AuthorName'],
+                         'Automattic')
+        self.assertNotIn('File', sent['akismet/akismet.php'])
+        self.assertEqual(sent['hello.php'],
+                         {'Name': 'Hello Dolly', 'Version': '1.7.2'})
+        # another installation, or a new cache on the same file
+        other = UpdateCache(self.root, {'plugins_api': 'http://0.0.0.0:1/'})
+        listing = other.add_updates('plugin', self.listing)
+        self.assertEqual(self.updates(listing)['akismet'], 'available')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_failure_is_reported_and_not_retried_at_once(self):
+        self.server.fail = True
+        for _attempt in range(2):
+            listing = self.cache.add_updates('plugin', self.listing)
+            self.assertEqual(self.updates(listing)['akismet'],
+                             'check failed')
+        self.assertEqual(len(self.server.requests), 1)
+        self.server.fail = False
+        self.cache.failed['plugin'] = 0
+        listing = self.cache.add_updates('plugin', self.listing)
+        self.assertEqual(self.updates(listing)['akismet'], 'available')
+
+
+if __name__ == '__main__':
+    unittest.main()
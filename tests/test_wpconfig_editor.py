@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""WpConfigEditor"""
+import os
+import shutil
+import tempfile
+import unittest
+from wpconfig_parser import WpConfigEditor, WpConfigParseError, WpConfigParser
+
+CONFIG = """<?php
+define( 'DB_NAME', 'wp_db' );
+define( 'WP_DEBUG', false );
+define( 'WP_MEMORY_LIMIT', 256 );
+$table_prefix = 'wp_';
+
+/* That's all, stop editing! Happy publishing. */
+require_once ABSPATH . 'wp-settings.php';
+"""
+
+
+class WpConfigEditorTest(unittest.TestCase):
+    """Applies batches of edits to a wp-config.php in a temp directory"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'wp-config.php')
+        self.write(CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, source):
+        """Replaces the test wp-config.php"""
+        with open(self.path, 'w') as config_file:
+            config_file.write(source)
+
+    def read(self):
+        """Returns the test wp-config.php"""
+        with open(self.path) as config_file:
+            return config_file.read()
+
+    def values(self):
+        """Returns {name: value} of the file's directives"""
+        return dict(
+            (directive.name, directive.value)
+            for directive in WpConfigParser(self.path).directives)
+
+    def test_set_keeps_the_rest_of_the_file(self):
+        editor = WpConfigEditor(self.path)
+        editor.set('DB_NAME', "it's")
+        self.assertEqual(editor.apply(), {'DB_NAME': True})
+        self.assertEqual(self.read(), CONFIG.replace(
+            "'wp_db'", "'it\\'s'"))
+
+    def test_set_coerces_to_the_current_type(self):
+        editor = WpConfigEditor(self.path)
+        editor.set('WP_DEBUG', 'TRUE')
+        editor.set('WP_MEMORY_LIMIT', '512')
+        editor.set('table_prefix', 'site_')
+        editor.apply()
+        values = self.values()
+        self.assertIs(values['WP_DEBUG'], True)
+        self.assertEqual(values['WP_MEMORY_LIMIT'], 512)
+        self.assertEqual(values['table_prefix'], 'site_')
+
+    def test_new_directive_goes_before_the_anchor(self):
+        editor = WpConfigEditor(self.path)
+        editor.set('WP_CACHE', True)
+        editor.apply()
+        source = self.read()
+        self.assertIn("define( 'WP_CACHE', true );\n/* That's all", source)
+
+    def test_delete_removes_the_whole_line(self):
+        editor = WpConfigEditor(self.path)
+        editor.delete('WP_DEBUG')
+        editor.delete('MISSING')
+        editor.delete('table_prefix')
+        self.assertEqual(editor.apply(), {
+            'WP_DEBUG': True, 'MISSING': False, 'table_prefix': False})
+        self.assertEqual(self.read(), CONFIG.replace(
+            "define( 'WP_DEBUG', false );\n", ''))
+
+    def test_batch_is_one_rewrite(self):
+        editor = WpConfigEditor(self.path)
+        editor.set('DB_NAME', 'other')
+        editor.delete('WP_MEMORY_LIMIT')
+        editor.set('WP_CACHE', False)
+        editor.apply()
+        values = self.values()
+        self.assertEqual(values['DB_NAME'], 'other')
+        self.assertNotIn('WP_MEMORY_LIMIT', values)
+        self.assertIs(values['WP_CACHE'], False)
+        self.assertEqual(os.listdir(self.directory), ['wp-config.php'])
+        self.assertEqual(editor.operations, {})
+
+    def test_keeps_the_file_mode(self):
+        os.chmod(self.path, 0o640)
+        editor = WpConfigEditor(self.path)
+        editor.set('DB_NAME', 'other')
+        editor.apply()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+
+    def test_dynamic_file_is_left_alone(self):
+        dynamic = "<?php define( 'DB_NAME', getenv( 'DB_NAME' ) );\n"
+        self.write(dynamic)
+        editor = WpConfigEditor(self.path)
+        editor.set('DB_NAME', 'other')
+        with self.assertRaises(WpConfigParseError):
+            editor.apply()
+        self.assertEqual(self.read(), dynamic)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""wp-config.php tokenizer and static parser"""
+import unittest
+from wpconfig_parser import WpConfigParseError, WpConfigParser, tokenize
+
+CONFIG = """<?php
+/** The name of the database for WordPress */
+define( 'DB_NAME', 'wp_db' );
+define('DB_HOST', "localhost:3306"); // trailing comment
+# hash comment define('NOT_A', 'directive');
+/* block define('NOR_THIS', 1); */
+$table_prefix = 'wp_';
+define( 'WP_DEBUG', false );
+define( 'WP_MEMORY_LIMIT', 256 );
+define( 'WP_CONTENT_DIR', __DIR__ . '/content' );
+define( 'LIST', array( 'a', 'b' ) );
+define( 'MAP', [ 'x' => 1, 'y' => -2.5 ] );
+if ( ! defined( 'ABSPATH' ) ) {
+    define( 'ABSPATH', __DIR__ . '/' );
+}
+require_once ABSPATH . 'wp-settings.php';
+"""
+
+
+def kinds(source):
+    """Returns (kind, value) of each token of source"""
+    return [(token.kind, token.value) for token in tokenize(source)]
+
+
+class TokenizeTest(unittest.TestCase):
+    """tokenize"""
+
+    def test_skips_comments_and_whitespace(self):
+        self.assertEqual(kinds(
+            "<?php // one\n# two\n/* three */ $a = 1;"), [
+                ('variable', 'a'), ('op', '='), ('number', 1), ('op', ';')])
+
+    def test_inline_html_and_close_tag(self):
+        self.assertEqual(kinds("<p>\n<?php $a = 1 ?>\ntail"), [
+            ('inline_html', '<p>\n'), ('variable', 'a'), ('op', '='),
+            ('number', 1), ('op', ';'), ('inline_html', 'tail')])
+
+    def test_comment_ends_at_close_tag(self):
+        self.assertEqual(kinds("<?php // note ?>x"), [
+            ('op', ';'), ('inline_html', 'x')])
+
+    def test_single_quoted_escapes(self):
+        self.assertEqual(kinds(r"<?php 'it\'s \\ \n'"), [
+            ('string', "it's \\ \\n")])
+
+    def test_double_quoted_escapes(self):
+        self.assertEqual(kinds(r'<?php "a\tb\x41\101\u{e9}\$"'), [
+            ('string', 'a\tbAA\xe9$')])
+
+    def test_interpolated_string_is_not_static(self):
+        tokens = tokenize('<?php "plain" "$var" "{$var}"')
+        self.assertEqual([token.static for token in tokens],
+                         [True, False, False])
+
+    def test_numbers(self):
+        self.assertEqual(
+            [value for _, value in kinds(
+                '<?php 10 0x1f 0b101 017 1.5 .5 1e3 1_000')],
+            [10, 31, 5, 15, 1.5, 0.5, 1000.0, 1000])
+
+    def test_longest_operator_wins(self):
+        self.assertEqual(kinds('<?php $a === $b => ...'), [
+            ('variable', 'a'), ('op', '==='), ('variable', 'b'),
+            ('op', '=>'), ('op', '...')])
+
+    def test_offsets(self):
+        source = "<?php define( 'A', 1 );"
+        token = tokenize(source)[2]
+        self.assertEqual(source[token.start:token.end], "'A'")
+
+    def test_unsupported_syntax(self):
+        for source in ('<?= 1 ?>', '<?php /* open', "<?php 'open",
+                       '<?php "open', '<?php $a = <<<EOT\nx\nEOT;'):
+            with self.assertRaises(WpConfigParseError):
+                tokenize(source)
+
+
+class WpConfigParserTest(unittest.TestCase):
+    """WpConfigParser"""
+
+    def parse(self, source):
+        """Returns {name: (value, type)} of source's directives"""
+        parser = WpConfigParser('/srv/site/wp-config.php', source)
+        return dict(
+            (directive.name, (directive.value, directive.type))
+            for directive in parser.directives)
+
+    def test_directives(self):
+        self.assertEqual(self.parse(CONFIG), {
+            'DB_NAME': ('wp_db', 'constant'),
+            'DB_HOST': ('localhost:3306', 'constant'),
+            'table_prefix': ('wp_', 'variable'),
+            'WP_DEBUG': (False, 'constant'),
+            'WP_MEMORY_LIMIT': (256, 'constant'),
+            'WP_CONTENT_DIR': ('/srv/site/content', 'constant'),
+            'LIST': (['a', 'b'], 'constant'),
+            'MAP': ({'x': 1, 'y': -2.5}, 'constant')})
+
+    def test_constants_and_dirname(self):
+        self.assertEqual(self.parse(
+            "<?php define( 'BASE', dirname( __FILE__ ) );\n"
+            "define( 'UP', BASE . '/up' );")['UP'],
+            ('/srv/site/up', 'constant'))
+
+    def test_needs_php(self):
+        for source in (
+                "<?php define( 'A', getenv( 'A' ) );",
+                "<?php define( 'A', \"$b\" );",
+                "<?php define( 'A', UNKNOWN );",
+                "<?php define( 'A', 1 ); define( 'A', 2 );"):
+            with self.assertRaises(WpConfigParseError):
+                self.parse(source)
+
+
+if __name__ == '__main__':
+    unittest.main()
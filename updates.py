@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""Update availability of plugins and themes, shared by installations.
+
+Asking wp-cli for the update fields of a listing makes WordPress contact
+the update API for each installation, though most installations run the
+same plugins at the same versions. The cache keeps the answer per slug
+and installed version for ttl seconds in update_cache.json, next to the
+installation index, and fills what it is missing with one bulk request
+to the update API, in the format WordPress itself sends. Like WordPress,
+it leaves out items whose Update URI header hands their updates to
+another server. When the update API can't be reached, lookups give up
+for retry_after seconds rather than waiting on it each time. Every
+installation's Plugins and Themes views read from the same cache."""
+import os
+import re
+import json
+import time
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+from threading import Lock
+from logmod import Log
+from headers import PLUGIN_HEADERS
+
+L = Log()
+
+CACHE_NAME = 'update_cache.json'
+API_URLS = {
+    'plugin': 'https://api.wordpress.org/plugins/update-check/1.1/',
+    'theme': 'https://api.wordpress.org/themes/update-check/1.1/'
+}
+# Update URI hosts that leave an item to the update API, as
+# wp_update_plugins and wp_update_themes check
+API_HOSTS = ('wordpress.org', 'w.org')
+
+
+def version_key(version):
+    """Returns a sort key for a version string, comparing numeric parts
+    as numbers, and ranking pre-releases before the release"""
+    key = []
+    for part in re.split(r'[.\-+_]', version.lower()):
+        for piece in re.findall(r'\d+|[a-z]+', part):
+            if piece.isdigit():
+                key.append((2, int(piece), ''))
+            else:
+                key.append((0, 0, piece))
+    # 1.0 sorts after 1.0-beta, whose next piece is text
+    key.append((1, 0, ''))
+    return key
+
+
+def uses_api(update_uri):
+    """False if an Update URI header hands the item's updates to a
+    server other than the update API"""
+    if not update_uri:
+        return True
+    if '://' not in update_uri:
+        # sanitize_url assumes http for a URI without a scheme
+        update_uri = 'http://' + update_uri
+    try:
+        return urllib.parse.urlparse(update_uri).hostname in API_HOSTS
+    except ValueError:
+        return False
+
+
+def update_fields(version, entry):
+    """Returns the update, update_version and update_package fields of a
+    listing, as wp-cli gives them, for an item at version. An entry
+    marked failed reports that the update check failed"""
+    if entry and entry.get('failed'):
+        return {'update': 'check failed', 'update_version': '',
+                'update_package': ''}
+    if not entry or not entry.get('new_version'):
+        return {'update': 'none', 'update_version': '',
+                'update_package': ''}
+    if version_key(entry['new_version']) <= version_key(version or ''):
+        return {'update': 'none', 'update_version': '',
+                'update_package': ''}
+    return {
+        'update': 'available' if entry.get('package') else 'unavailable',
+        'update_version': entry['new_version'],
+        'update_package': entry.get('package', '')
+    }
+
+
+def download(url, directory, timeout=30, cancelled=None):
+    """Downloads the package at url into directory. cancelled, if given,
+    is checked between chunks and stops the download when it returns
+    True. Returns the path written"""
+    name = os.path.basename(urllib.parse.urlparse(url).path) or 'package'
+    fd, path = tempfile.mkstemp(dir=directory, suffix='-' + name)
+    try:
+        with os.fdopen(fd, 'wb') as package, urllib.request.urlopen(
+                urllib.request.Request(url, headers={'User-Agent': 'wpui'}),
+                timeout=timeout) as response:
+            for chunk in iter(lambda: response.read(65536), b''):
+                if cancelled and cancelled():
+                    raise OSError('Download of %s cancelled' % url)
+                package.write(chunk)
+    except (urllib.error.URLError, OSError, ValueError):
+        os.remove(path)
+        raise
+    return path
+
+
+class UpdateCache(object):
+    """Update metadata rooted at root, shared by all installations.
+    Use UpdateCache.get(root, settings), so threads share one instance
+    per root. settings is the settings.updates section"""
+    instances = {}
+    instances_lock = Lock()
+
+    def __init__(self, root, settings):
+        self.path = os.path.join(root, CACHE_NAME)
+        self.ttl = int(settings.get('ttl', 43200))
+        self.timeout = int(settings.get('timeout', 30))
+        self.retry_after = int(settings.get('retry_after', 300))
+        self.api_urls = {
+            'plugin': settings.get('plugins_api', API_URLS['plugin']),
+            'theme': settings.get('themes_api', API_URLS['theme'])
+        }
+        self.entries = None
+        self.lock = Lock()
+        # one bulk request at a time per kind, later callers reuse it
+        self.fetch_locks = {'plugin': Lock(), 'theme': Lock()}
+        # when the last request of each kind failed
+        self.failed = {}
+
+    @classmethod
+    def get(cls, root, settings):
+        """Returns the shared cache for root"""
+        with cls.instances_lock:
+            if root not in cls.instances:
+                cls.instances[root] = cls(root, settings)
+            return cls.instances[root]
+
+    @staticmethod
+    def key(kind, slug, version):
+        """Returns the cache key of slug at version"""
+        return '%s:%s@%s' % (kind, slug, version)
+
+    def load(self):
+        """Reads the cache file, if it has not been read yet. Called with
+        lock held"""
+        if self.entries is not None:
+            return
+        try:
+            with open(self.path) as cache_file:
+                self.entries = json.load(cache_file)
+        except (OSError, IOError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        """Atomically writes the cache, dropping expired entries. Called
+        with lock held"""
+        now = time.time()
+        self.entries = dict(
+            (key, entry) for key, entry in self.entries.items()
+            if now - entry['checked'] < self.ttl)
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upd-')
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(self.entries, cache_file)
+            os.replace(temp_path, self.path)
+        except (OSError, IOError) as error:
+            L.warning('Unable to write update cache: %s', error)
+
+    def cached(self, kind, items):
+        """Returns {slug: entry} of the items found in the cache, and
+        not expired"""
+        now = time.time()
+        found = {}
+        with self.lock:
+            self.load()
+            for slug, item in items.items():
+                entry = self.entries.get(
+                    self.key(kind, slug, item['version']))
+                if entry and now - entry['checked'] < self.ttl:
+                    found[slug] = entry
+        return found
+
+    def lookup(self, kind, items):
+        """Returns {slug: entry} for items, {slug: {'version', 'file',
+        'name', 'headers'}}, with entries holding 'new_version' and
+        'package'. Items not cached are looked up in one request. If it
+        fails, or failed less than retry_after seconds ago, their entries
+        are {'failed': True}"""
+        found = self.cached(kind, items)
+        if len(found) == len(items):
+            return found
+        with self.fetch_locks[kind]:
+            # another installation may have just looked them up
+            found = self.cached(kind, items)
+            missing = dict((slug, item) for slug, item in items.items()
+                           if slug not in found)
+            if not missing:
+                return found
+            now = time.time()
+            if now - self.failed.get(kind, 0) < self.retry_after:
+                return self.with_failed(found, missing)
+            try:
+                fetched = self.fetch(kind, missing)
+            except (urllib.error.URLError, OSError, ValueError) as error:
+                L.warning('%s update check failed: %s', kind, error)
+                self.failed[kind] = time.time()
+                return self.with_failed(found, missing)
+            self.failed.pop(kind, None)
+            with self.lock:
+                for slug, item in missing.items():
+                    entry = fetched.get(slug, {})
+                    entry = {
+                        'new_version': entry.get('new_version', ''),
+                        'package': entry.get('package', '') or '',
+                        'checked': now
+                    }
+                    self.entries[self.key(
+                        kind, slug, item['version'])] = entry
+                    found[slug] = entry
+                self.save()
+            L.debug('Checked %s %s updates in one request',
+                    len(missing), kind)
+        return found
+
+    @staticmethod
+    def with_failed(found, missing):
+        """Returns found, with the missing items marked failed"""
+        found = dict(found)
+        found.update((slug, {'failed': True}) for slug in missing)
+        return found
+
+    @staticmethod
+    def plugin_data(slug, item):
+        """Returns what the update request holds about a plugin: its
+        headers, as get_plugins gives them, or for a plugin listed by
+        wp-cli, its name and version"""
+        headers = item.get('headers')
+        if not headers:
+            return {'Name': item.get('name', slug),
+                    'Version': item['version']}
+        data = dict((key, headers.get(key, '')) for key in PLUGIN_HEADERS)
+        data['Title'] = data['Name']
+        data['AuthorName'] = data['Author']
+        return data
+
+    @staticmethod
+    def theme_data(slug, item):
+        """Returns what the update request holds about a theme, the
+        fields wp_update_themes sends"""
+        headers = item.get('headers') or {}
+        name = headers.get('Name') or item.get('name', slug)
+        return {
+            'Name': name,
+            'Title': name,
+            'Version': item['version'],
+            'Author': headers.get('Author', ''),
+            'Author URI': headers.get('AuthorURI', ''),
+            'UpdateURI': headers.get('UpdateURI', ''),
+            'Template': headers.get('Template') or slug,
+            'Stylesheet': slug
+        }
+
+    def fetch(self, kind, items):
+        """Asks the update API about items. Returns {slug: response
+        entry} for the items it knows"""
+        if kind == 'plugin':
+            by_file = dict((item['file'], slug)
+                           for slug, item in items.items())
+            fields = {
+                'plugins': json.dumps({
+                    'plugins': dict(
+                        (item['file'], self.plugin_data(slug, item))
+                        for slug, item in items.items()),
+                    'active': []
+                })
+            }
+        else:
+            by_file = dict((slug, slug) for slug in items)
+            fields = {
+                'themes': json.dumps({
+                    'active': '',
+                    'themes': dict(
+                        (slug, self.theme_data(slug, item))
+                        for slug, item in items.items())
+                })
+            }
+        fields.update({'translations': '[]', 'locale': '[]', 'all': 'true'})
+        request = urllib.request.Request(
+            self.api_urls[kind],
+            data=urllib.parse.urlencode(fields).encode('UTF-8'),
+            headers={'User-Agent': 'wpui'})
+        with urllib.request.urlopen(
+                request, timeout=self.timeout) as response:
+            data = json.loads(response.read().decode('UTF-8'))
+        fetched = {}
+        for section in (kind + 's', 'no_update'):
+            for name, entry in (data.get(section) or {}).items():
+                if name in by_file and isinstance(entry, dict):
+                    fetched[by_file[name]] = entry
+        return fetched
+
+    @classmethod
+    def for_app(cls, app):
+        """Returns the cache kept with app's installation index, or None
+        if it is disabled in settings.json"""
+        settings = getattr(app.settings, 'updates', {})
+        if not settings.get('enabled', True):
+            return None
+        return cls.get(app.state.temp_dir, settings)
+
+    def add_updates(self, kind, listing):
+        """Returns a copy of a plugin or theme listing with the update
+        fields filled in. Items need 'name' and 'version', and plugins
+        'file'. Items read from disk also have their 'headers'. Must-use
+        plugins, drop-ins, and items updated from elsewhere, according to
+        their Update URI, are not looked up"""
+        items = dict(
+            (item['name'], {
+                'version': item.get('version', ''),
+                'file': item.get('file') or item['name'],
+                'name': item.get('title') or item['name'],
+                'headers': item.get('headers')
+            })
+            for item in listing
+            if item.get('status') not in ('must-use', 'dropin') and
+            uses_api((item.get('headers') or {}).get('UpdateURI')))
+        found = self.lookup(kind, items) if items else {}
+        result = []
+        for item in listing:
+            item = dict(item)
+            item.update(update_fields(
+                item.get('version', ''), found.get(item['name'])))
+            result.append(item)
+        return result
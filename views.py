@@ -35,7 +35,7 @@ class Views(object):
         else:
             activating_view = getattr(self, activating_view_name)
 
-        exempt_views = ['Home', 'Installs', 'Quit']
+        exempt_views = ['Home', 'Installs', 'Fleet', 'Quit']
         if any(item in activating_view.name for item in exempt_views):
             if "no_view_chain" not in activating_view.view_type:
                 self.state.view_chain_pos += 1
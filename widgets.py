@@ -24,12 +24,14 @@ class DbSearchEditMap(U.AttrMap):
             on_enter='',
             user_args='',
             edit_pos=None,
-            caption=''):
+            caption='',
+            on_cancel=None):
         self.original_widget = DbSearchEdit(
             app,
             self,
             body_widget=body_widget,
             on_enter=on_enter,
+            on_cancel=on_cancel,
             edit_text=edit_text,
             align=align,
             user_args=user_args,
@@ -51,7 +53,8 @@ class DbSearchEdit(U.Edit):
             align='',
             caption='',
             edit_pos=None,
-            user_args=''):
+            user_args='',
+            on_cancel=None):
         super(DbSearchEdit, self).__init__(
             edit_text=edit_text,
             align=align,
@@ -61,9 +64,14 @@ class DbSearchEdit(U.Edit):
         self.app = app
         self.attr_map = attr_map
         self.on_enter = on_enter
+        self.on_cancel = on_cancel
         self.user_args = user_args
 
     def keypress(self, size, key):
+        if key == 'esc' and self.on_cancel:
+            L.debug('on_cancel action: %s', self.on_cancel)
+            self.on_cancel(self)
+            return None
         if key != 'enter':
             return super(DbSearchEdit, self).keypress(size, key)
         if not self.user_args:
@@ -1,13 +1,30 @@
 # -*- coding: utf-8 -*-
 """Contains wp-cli calling and parsing classes / methods"""
 import os
+import re
 import getpass
 import subprocess
 import json
+import time
 from datetime import datetime
-from threading import Thread
+from collections import OrderedDict
+from threading import Thread, Lock, Timer, Event
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
 from logmod import Log
+from wpconfig_parser import WpConfigParser, WpConfigParseError
+from wpconfig_parser import WpConfigEditor
+from database import DbConnections, DbError, get_table_status, human_size
+from database import quote_name
+from dbdump import DbDump, ParallelDump, DUMP_EXTENSIONS, MANIFEST
+from dbdump import DUMP_DIR_EXTENSION, is_compressed, import_dump
+from dbdump import import_dump_dir
+from searchreplace import SearchReplaceEngine
+from dbsearch import DbSearchEngine
+from jobs import Job
+from headers import content_roots, read_plugin, read_theme, is_multisite
+from headers import get_file_data, scan_plugins, scan_themes, PLUGIN_HEADERS
+from updates import UpdateCache
 
 
 L = Log()
@@ -16,8 +33,9 @@ L = Log()
 class Installations(object):
     """Class used for obtaining installation dir and details"""
 
-    def __init__(self, app):
+    def __init__(self, app, rescan=False, listener=None):
         self.app = app
+        self.listener = listener
         L.debug('Installations Initialized')
         self.username = getpass.getuser()
         self.homedir = os.path.expanduser('~%s' % self.username)
@@ -26,34 +44,196 @@ class Installations(object):
         if not os.path.isdir(self.app.state.temp_dir):
             os.mkdir(self.app.state.temp_dir)
         L.debug("Homedir: %s", self.homedir)
-        self.installations = self.get_installation_dirs()
+        self.index = InstallationIndex(
+            self.app.settings.app.get('index_ttl', 86400),
+            os.path.join(self.app.state.temp_dir, 'installations.json'))
+        self.installations = None
+        self.from_index = False
+        self.progress = 0
+        self.progress_lock = Lock()
+        # set once app.action_pipe is closed. Its fd number may be reused
+        # by then, so nothing may be written to it afterwards
+        self.progress_closed = False
+        if not rescan:
+            self.installations = self.index.load()
+        if self.installations is not None:
+            self.from_index = True
+            self.close_progress()
+            for installation in self.installations:
+                self.notify('add_installation', installation)
+                # the index holds the probe results, so the row's cells
+                # are filled in straight away
+                self.notify('update_installation', installation)
+            L.debug(
+                "WP Installations loaded from index for user %s: %s",
+                self.username, self.installations)
+            return
+        if self.listener:
+            self.close_progress()
+            self.stream_installations()
+        else:
+            self.installations = self.get_installation_dirs()
         if self.installations:
-            self.get_installation_details()
+            if not self.listener:
+                self.get_installation_details()
             L.debug(
                 "WP Installation for user %s: %s",
                 self.username, self.installations)
         else:
+            self.close_progress()
             L.warning("No WP Installations available for this User!")
+        self.index.save(self.installations, discovered=True)
+
+    def notify(self, event, installation):
+        """Passes an installation to the listener's event method,
+        if there is a listener"""
+        if self.listener:
+            getattr(self.listener, event)(installation)
+
+    def stream_installations(self):
+        """Probes each installation as soon as it is discovered, rather
+        than after the whole homedir has been scanned. The listener is
+        told about every installation when it is found, and again when
+        its probe completes"""
+        self.installations = []
+        max_workers = max(1, int(self.app.settings.app.get(
+            'scan_workers', 4)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            probes = []
+            for installation in self.iter_installation_dirs():
+                self.installations.append(installation)
+                self.notify('add_installation', installation)
+                probes.append(
+                    executor.submit(self.probe_installation, installation))
+            for probe in probes:
+                try:
+                    probe.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    L.warning('Installation probe failed: %s', error)
+
+    def revalidate(self):
+        """Re-probes the installations loaded from the index that are
+        stale. If the index's last discovery is older than the ttl, the
+        home directory is scanned again as well, and new or removed
+        installations are merged in. Returns True if anything changed"""
+        rediscover = self.index.discovery_expired()
+        if rediscover:
+            known = dict(
+                (installation['directory'], installation)
+                for installation in self.installations)
+            installations = [
+                known.get(installation['directory'], installation)
+                for installation in self.get_installation_dirs()]
+        else:
+            installations = [
+                installation for installation in self.installations
+                if self.index.fingerprint(installation['directory'])]
+        changed = [
+            installation['directory'] for installation in installations] != [
+                installation['directory']
+                for installation in self.installations]
+        if changed:
+            old_dirs = set(
+                installation['directory']
+                for installation in self.installations)
+            new_dirs = set(
+                installation['directory'] for installation in installations)
+            for installation in self.installations:
+                if installation['directory'] not in new_dirs:
+                    self.notify('remove_installation', installation)
+            for installation in installations:
+                if installation['directory'] not in old_dirs:
+                    self.notify('add_installation', installation)
+        self.installations = installations
+        stale = self.index.stale(self.installations)
+        L.debug('Stale installations: %s', stale)
+        if stale:
+            max_workers = max(1, int(self.app.settings.app.get(
+                'scan_workers', 4)))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(self.probe_installation, stale))
+        if stale or changed or rediscover:
+            self.index.save(self.installations, discovered=rediscover)
+        return bool(stale or changed)
+
+    def close_progress(self):
+        """Completes the view's progress bar. Later progress is
+        dropped"""
+        with self.progress_lock:
+            if self.progress_closed:
+                return
+            self.progress_closed = True
+            try:
+                os.close(self.app.action_pipe)
+            except OSError:
+                L.warning('self.app.action_pipe already closed')
 
     def get_installation_dirs(self):
-        """Gets installation directory list using os.walk"""
-        installations = []
+        """Gets installation directory list using os.scandir.
+
+        Directories are pruned before they are visited: hidden directories,
+        names in settings.app['scan_ignore'], anything deeper than
+        settings.app['scan_max_depth'] below the homedir, and the contents
+        of a directory already found to hold wp-config.php (only WordPress'
+        own directories are pruned there when scan_nested_installs is
+        set). DirEntry type information is used, so no extra stat calls
+        are made for the directories that are walked"""
+        return list(self.iter_installation_dirs())
+
+    def iter_installation_dirs(self):
+        """Generator behind get_installation_dirs, yielding each
+        installation dict as soon as it is found"""
         L.debug("%s Homedir: %s", self.username, self.homedir)
-        for root, _, files in os.walk(self.homedir, topdown=True):
-            if 'wp-config.php' in files:
-                if '/.' not in root:
-                    _x = {
-                        'directory': root,
-                        'home_url': '',
-                        'valid_wp_options': False,
-                        'wp_db_check_success': False,
-                        'wp_db_error': ''
-                    }
-                    installations.append(_x)
-        return installations
+        settings = self.app.settings.app
+        max_depth = settings.get('scan_max_depth', 8)
+        ignore = set(settings.get('scan_ignore', []))
+        nested = settings.get('scan_nested_installs', False)
+        wp_dirs = set(['wp-admin', 'wp-includes', 'wp-content'])
+        stack = [(self.homedir, 0)]
+        while stack:
+            root, depth = stack.pop()
+            subdirs = []
+            is_wp_root = False
+            try:
+                with os.scandir(root) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if not entry.name.startswith('.') and \
+                                        entry.name not in ignore:
+                                    subdirs.append(entry)
+                            elif entry.name == 'wp-config.php':
+                                is_wp_root = True
+                        except OSError:
+                            continue
+            except OSError as error:
+                L.debug('Unable to scan %s: %s', root, error)
+                continue
+            if is_wp_root:
+                _x = {
+                    'directory': root,
+                    'home_url': '',
+                    'valid_wp_options': False,
+                    'wp_db_check_success': False,
+                    'wp_db_error': '',
+                    'db_name': ''
+                }
+                yield _x
+                if not nested:
+                    continue
+                subdirs = [
+                    entry for entry in subdirs if entry.name not in wp_dirs]
+            if depth >= max_depth:
+                continue
+            # pushed in reverse so directories are visited in listing order
+            for entry in reversed(subdirs):
+                stack.append((entry.path, depth + 1))
 
     def get_installation_details(self):
-        """Getter for installation details"""
+        """Getter for installation details. Installations are probed
+        concurrently by up to settings.app['scan_workers'] threads. Each
+        probe fills in its own installation dict, so the list keeps its
+        discovery order whichever probe finishes first"""
         L.debug('Start get_installation_details')
         self.progress = 0
         if self.installations:
@@ -61,41 +241,307 @@ class Installations(object):
         else:
             progress_sections = 100
         progress_increments = progress_sections / 2
-        for installation in self.installations:
-            L.debug('installation: %s', installation)
-            self.progress = self.progress + progress_increments
+        max_workers = max(1, int(self.app.settings.app.get(
+            'scan_workers', 4)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            probes = [
+                executor.submit(
+                    self.probe_installation,
+                    installation,
+                    progress_increments)
+                for installation in self.installations]
+            for probe in probes:
+                try:
+                    probe.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    L.warning('Installation probe failed: %s', error)
+        self.close_progress()
+
+    def probe_installation(self, installation, progress_increments=0):
+        """Runs db check, and option get home if wp_options is valid,
+        for a single installation"""
+        L.debug('installation: %s', installation)
+        installation['valid_wp_options'] = False
+        installation['wp_db_check_success'] = False
+        installation['wp_db_error'] = ''
+        installation['db_name'] = WpConfig.get_db_name(
+            self.app, installation['directory'])
+        db_check_data, db_check_error = Call.wpcli(
+            self.app,
+            ['db', 'check'],
+            install_path=installation['directory'])
+        self.add_progress(progress_increments)
+        if db_check_data:
+            data = db_check_data.splitlines()
+            for line in data:
+                if '_options' in line and 'OK' in line:
+                    # L.debug('Line: %s', line)
+                    installation['valid_wp_options'] = True
+                    homedata, _ = Call.wpcli(
+                        self.app,
+                        [
+                            'option',
+                            'get',
+                            'home'],
+                        install_path=installation['directory'])
+                    if homedata:
+                        installation['home_url'] = homedata.rstrip()
+                if 'Success: Database checked' in line:
+                    installation['wp_db_check_success'] = True
+        if db_check_error:
+            installation['wp_db_error'] = db_check_error
+        self.add_progress(progress_increments)
+        self.notify('update_installation', installation)
+
+    def add_progress(self, increment):
+        """Adds increment to the shared progress total and reports
+        it through app.action_pipe"""
+        with self.progress_lock:
+            if self.progress_closed:
+                return
+            self.progress = self.progress + increment
             # L.debug('Progress: %s', self.progress)
-            os.write(self.app.action_pipe, str.encode(str(self.progress)))
-            db_check_data, db_check_error = Call.wpcli(
-                self.app,
-                ['db', 'check'],
-                install_path=installation['directory'])
-            if db_check_data:
-                data = db_check_data.splitlines()
-                for line in data:
-                    if '_options' in line and 'OK' in line:
-                        # L.debug('Line: %s', line)
-                        installation['valid_wp_options'] = True
-                        self.progress = self.progress + progress_increments
-                        # L.debug('Progress: %s', self.progress)
-                        progress = str(self.progress)
-                        os.write(
-                            self.app.action_pipe,
-                            progress.encode(encoding='UTF-8'))
-                        homedata, _ = Call.wpcli(
-                            self.app,
-                            [
-                                'option',
-                                'get',
-                                'home'],
-                            install_path=installation['directory'])
-                        if homedata:
-                            installation['home_url'] = homedata.rstrip()
-                    if 'Success: Database checked' in line:
-                        installation['wp_db_check_success'] = True
-            if db_check_error:
-                installation['wp_db_error'] = db_check_error
-        os.close(self.app.action_pipe)
+            progress = str(self.progress) + '\n'
+            try:
+                os.write(
+                    self.app.action_pipe,
+                    progress.encode(encoding='UTF-8'))
+            except OSError:
+                L.debug('self.app.action_pipe already closed')
+
+
+class InstallationIndex(object):
+    """On-disk index of discovered installations and their probe results.
+
+    Entries are keyed by installation directory, and are considered stale
+    when wp-config.php's mtime or inode, or the mtime of the installation
+    directory or its parent, no longer match, or when they were probed
+    more than ttl seconds ago"""
+    PROBE_FIELDS = ['home_url', 'valid_wp_options', 'wp_db_check_success',
+                    'wp_db_error', 'db_name']
+
+    def __init__(self, ttl, path):
+        self.ttl = ttl
+        self.path = path
+        self.data = {'discovered': 0, 'installations': {}}
+
+    def load(self):
+        """Reads the index. Returns the list of installation dicts in
+        discovery order, or None if there is no usable index"""
+        try:
+            with open(self.path, 'r') as index_file:
+                self.data = json.load(index_file)
+            entries = self.data['installations']
+            order = self.data['order']
+        except (IOError, OSError, ValueError, KeyError) as error:
+            L.debug('Installation index not loaded: %s', error)
+            return None
+        installations = []
+        for directory in order:
+            installation = {'directory': directory}
+            for field in self.PROBE_FIELDS:
+                installation[field] = entries[directory]['probe'].get(
+                    field, '')
+            installations.append(installation)
+        return installations
+
+    def save(self, installations, discovered=False):
+        """Writes the index, fingerprinting each installation as it is
+        on disk now"""
+        entries = {}
+        old_entries = self.data.get('installations', {})
+        for installation in installations:
+            directory = installation['directory']
+            fingerprint = self.fingerprint(directory)
+            if not fingerprint:
+                continue
+            old_entry = old_entries.get(directory, {})
+            probe = dict(
+                (field, installation.get(field, ''))
+                for field in self.PROBE_FIELDS)
+            if old_entry.get('probe') == probe and \
+                    old_entry.get('fingerprint') == fingerprint:
+                probed = old_entry.get('probed', time.time())
+            else:
+                probed = time.time()
+            entries[directory] = {
+                'fingerprint': fingerprint,
+                'probe': probe,
+                'probed': probed
+            }
+        self.data = {
+            'discovered': time.time() if discovered else self.data.get(
+                'discovered', 0),
+            'order': [
+                installation['directory'] for installation in installations
+                if installation['directory'] in entries],
+            'installations': entries
+        }
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as index_file:
+                json.dump(self.data, index_file)
+            os.replace(temp_path, self.path)
+        except (IOError, OSError) as error:
+            L.warning('Unable to write installation index: %s', error)
+
+    @staticmethod
+    def fingerprint(directory):
+        """Returns the stat data an entry is validated against, or None
+        if wp-config.php is gone"""
+        try:
+            config_stat = os.stat(os.path.join(directory, 'wp-config.php'))
+            return {
+                'config_mtime': config_stat.st_mtime,
+                'config_inode': config_stat.st_ino,
+                'dir_mtime': os.stat(directory).st_mtime,
+                'parent_mtime': os.stat(os.path.dirname(directory)).st_mtime
+            }
+        except OSError:
+            return None
+
+    def stale(self, installations):
+        """Returns the installations whose index entry is out of date"""
+        stale = []
+        entries = self.data.get('installations', {})
+        for installation in installations:
+            entry = entries.get(installation['directory'])
+            if not entry or \
+                    time.time() - entry['probed'] > self.ttl or \
+                    entry['fingerprint'] != self.fingerprint(
+                        installation['directory']):
+                stale.append(installation)
+        return stale
+
+    def discovery_expired(self):
+        """True if the homedir was last scanned more than ttl seconds ago"""
+        return time.time() - self.data.get('discovered', 0) > self.ttl
+
+
+class ListingCache(object):
+    """In memory cache of `wp plugin list` and `wp theme list` results,
+    per installation.
+
+    An entry is used while its fingerprint still matches: the mtimes of
+    the plugin or theme root, of everything in it and of the files at the
+    top of each plugin or theme directory, along with the option values
+    that decide which are active. Actions that change plugins or themes
+    also invalidate the entry themselves"""
+    entries = {}
+    lock = Lock()
+    OPTIONS = {
+        'plugin': ['active_plugins'],
+        'theme': ['template', 'stylesheet']
+    }
+
+    @classmethod
+    def get(cls, app, kind):
+        """Returns the cached listing of kind, 'plugin' or 'theme', for
+        the active installation, or None if there is none or it is
+        stale"""
+        if not cls.enabled(app):
+            return None
+        key = (kind, app.state.active_installation['directory'])
+        with cls.lock:
+            entry = cls.entries.get(key)
+        if not entry:
+            return None
+        if cls.fingerprint(app, kind, entry['roots']) != \
+                entry['fingerprint']:
+            L.debug('%s list cache is stale', kind)
+            cls.invalidate(app, kind)
+            return None
+        return entry['listing']
+
+    @classmethod
+    def put(cls, app, kind, roots, fingerprint, listing):
+        """Caches listing, taken after fingerprint was read from roots"""
+        if not cls.enabled(app) or not roots or fingerprint is None:
+            return
+        key = (kind, app.state.active_installation['directory'])
+        with cls.lock:
+            cls.entries[key] = {
+                'roots': roots,
+                'fingerprint': fingerprint,
+                'listing': listing
+            }
+
+    @classmethod
+    def invalidate(cls, app, kind):
+        """Drops the active installation's listing of kind"""
+        key = (kind, app.state.active_installation['directory'])
+        with cls.lock:
+            cls.entries.pop(key, None)
+
+    @classmethod
+    def forget(cls, install_path):
+        """Drops every listing of install_path, for changes made to an
+        installation other than the active one"""
+        with cls.lock:
+            for kind in cls.OPTIONS:
+                cls.entries.pop((kind, install_path), None)
+
+    @staticmethod
+    def enabled(app):
+        """True unless the cache is turned off in settings.json"""
+        return getattr(app.settings, 'wpcli', {}).get('list_cache', True)
+
+    @classmethod
+    def fingerprint(cls, app, kind, roots):
+        """Returns the fingerprint of roots and kind's options, or None
+        if it can not be read"""
+        state = []
+        try:
+            for root in roots:
+                if not os.path.isdir(root):
+                    state.append([root, None])
+                    continue
+                state.append([root, os.stat(root).st_mtime_ns])
+                for entry in sorted(os.scandir(root),
+                                    key=lambda entry: entry.name):
+                    state.append([entry.name,
+                                  entry.stat(follow_symlinks=False)
+                                  .st_mtime_ns])
+                    if entry.is_dir():
+                        state.append(sorted(
+                            [child.name, child.stat().st_mtime_ns]
+                            for child in os.scandir(entry.path)
+                            if child.is_file()))
+        except OSError as error:
+            L.debug('No %s list fingerprint: %s', kind, error)
+            return None
+        options = cls.option_values(app, cls.OPTIONS[kind])
+        if options is None:
+            return None
+        return json.dumps([state, options])
+
+    @staticmethod
+    def option_values(app, names):
+        """Returns the raw values of the options in names, read directly
+        from the database when possible. None if they can not be read"""
+        client = DbConnections.get(app)
+        if client:
+            try:
+                rows = client.query(
+                    'SELECT option_name, option_value FROM %s '
+                    'WHERE option_name IN (%s)' % (
+                        quote_name(client.credentials.table_prefix +
+                                   'options'),
+                        ', '.join(['%s'] * len(names))),
+                    names)
+                values = dict((row['option_name'], row['option_value'])
+                              for row in rows)
+                return [values.get(name) for name in names]
+            except DbError as error:
+                L.warning('Options not read directly: %s', error)
+        values = []
+        for name in names:
+            result, error = Call.wpcli(app, ['option', 'get', name])
+            if error and not result:
+                L.debug('Option %s not read: %s', name, error)
+                return None
+            values.append(result)
+        return values
 
 
 class DatabaseInformation(object):
@@ -112,6 +558,8 @@ class DatabaseInformation(object):
             'check_tables': None,
             'check_error': None
         }
+        # (install path, plan) of the last native search-replace dry run
+        self.sr_plan = None
 
     def get_db_size(self):
         """Get database size and name list"""
@@ -132,11 +580,16 @@ class DatabaseInformation(object):
             os.write(self.app.action_pipe, str.encode(str(progress)))
         except OSError as error:
             L.warning('self.app.action_pipe Not Open Yet: %s', error)
-        dbsize_result, dbsize_error = Call.wpcli(
-            self.app, [
-                'db', 'size',
-                '--human-readable',
-                '--format=json', '--no-color'])
+        direct_info = self.get_db_info_direct()
+        if direct_info:
+            db_info.update(direct_info)
+            dbsize_result, dbsize_error = None, None
+        else:
+            dbsize_result, dbsize_error = Call.wpcli(
+                self.app, [
+                    'db', 'size',
+                    '--human-readable',
+                    '--format=json', '--no-color'])
         if dbsize_result:
             result_json = json.loads(dbsize_result)
             L.debug(
@@ -185,12 +638,43 @@ class DatabaseInformation(object):
         self.db_info = db_info
         return db_info
 
+    def get_db_info_direct(self):
+        """Reads database name, size and table status from
+        information_schema over a direct connection, in place of
+        `wp db size` and `wp db check`.
+        Returns None when no direct connection can be made"""
+        client = DbConnections.get(self.app)
+        if not client:
+            return None
+        try:
+            tables = get_table_status(client)
+        except DbError as error:
+            L.warning('Direct table status failed: %s', error)
+            return None
+        name = client.credentials.name
+        check_tables = []
+        for table in tables:
+            if table['ENGINE']:
+                status = 'OK'
+            else:
+                status = table['TABLE_COMMENT'] or 'Error'
+            check_tables.append({
+                'table_name': name + '.' + table['TABLE_NAME'],
+                'check_status': status})
+        return {
+            'name': name,
+            'size': human_size(sum(
+                int(table['TABLE_SIZE'] or 0) for table in tables)),
+            'check_tables': check_tables
+        }
+
     def export(self, file_path=None):
-        """installs theme from wordpress.org repo"""
+        """Exports the database in a background thread, streaming
+        progress to the Database view"""
 
-        self.app.wpcli_pipe = self.app.loop.watch_pipe(
-            self.app.views.Database.body.update_view)
-        L.debug("self.app.wpcli_pipe: %s", self.app.wpcli_pipe)
+        progress_pipe = self.app.loop.watch_pipe(
+            self.app.views.Database.body.update_export_progress)
+        L.debug("export progress_pipe: %s", progress_pipe)
         if not file_path:
             export_path = self.app.state.homedir
             n_length = 6
@@ -210,48 +694,107 @@ class DatabaseInformation(object):
         else:
             file_path = file_path
 
-        wpcli_thread = Thread(
-            target=Call.wpcli_live_response,
-            name='wpcli_thread',
-            args=[
-                self.app,
-                self.app.views.Database.body.after_response,
-                [
-                    'db',
-                    'export',
-                    file_path
-                ]
-            ])
-        wpcli_thread.start()
+        export_thread = Thread(
+            target=self.run_export,
+            name='export_thread',
+            args=[file_path, progress_pipe])
+        export_thread.start()
+
+    def run_export(self, file_path, progress_pipe):
+        """Runs a DbDump reporting to progress_pipe, then closes it and
+        returns to the Database view"""
+        settings = getattr(self.app.settings, 'database', {})
+        tables = self.get_tables(self.app)
+        try:
+            if settings.get('parallel_export', False) and tables:
+                ParallelDump(
+                    self.installation['directory'],
+                    file_path,
+                    settings,
+                    tables,
+                    progress_fd=progress_pipe).run()
+            else:
+                DbDump(
+                    self.installation['directory'],
+                    file_path,
+                    settings,
+                    progress_fd=progress_pipe,
+                    total_tables=len(tables) if tables else None).run()
+        finally:
+            try:
+                os.close(progress_pipe)
+            except OSError:
+                L.warning('export progress_pipe Not Open')
+            self.app.views.Database.body.after_response()
 
     @staticmethod
-    def export_db(app, file_path=None):
-        """Exports Database"""
+    def get_tables(app, install_path=None):
+        """Returns the tables `wp db export` will dump, largest first
+        when they can be read directly, or None if they can not be
+        listed. install_path defaults to the active installation"""
+        client = DbConnections.get(app, install_path)
+        if client:
+            try:
+                tables = get_table_status(client)
+            except DbError as error:
+                L.warning('Direct table list failed: %s', error)
+            else:
+                tables.sort(
+                    key=lambda table: int(table['TABLE_SIZE'] or 0),
+                    reverse=True)
+                return [table['TABLE_NAME'] for table in tables]
+        tables, _error = Call.wpcli(
+            app, ['db', 'tables', '--all-tables'], install_path=install_path)
+        if tables:
+            return tables.split()
+        return None
 
-        file_path = file_path
-        export = Call.wpcli(
-            app,
-            [
-                'db',
-                'export',
-                file_path
-            ])
-        if export[0]:
-            return True
+    @staticmethod
+    def export_db(app, file_path=None, parallel=None, install_path=None):
+        """Exports Database to file_path, compressed as set in
+        settings.database. When parallel, or settings.database
+        parallel_export if it is None, tables are dumped concurrently
+        into a directory. install_path defaults to the active
+        installation. Returns the path written, or False"""
+
+        settings = getattr(app.settings, 'database', {})
+        if parallel is None:
+            parallel = settings.get('parallel_export', False)
+        if not install_path:
+            install_path = app.state.active_installation['directory']
+        tables = DatabaseInformation.get_tables(
+            app, install_path) if parallel else None
+        if tables:
+            export = ParallelDump(
+                install_path, file_path, settings, tables).run()
+        else:
+            export = DbDump(install_path, file_path, settings).run()
+        if export:
+            return export
         else:
             return False
 
     @staticmethod
     def import_db(app, path):
-        """Exports wp database"""
+        """Imports a database dump. Compressed dumps are streamed
+        into `wp db import -`"""
         file_path = path
-        import_result = Call.wpcli(
-            app,
-            [
-                'db',
-                'import',
-                file_path
-            ])
+        if os.path.isdir(file_path):
+            import_result = import_dump_dir(
+                app.state.active_installation['directory'], file_path,
+                getattr(app.settings, 'database', {}).get(
+                    'import_workers', 4))
+        elif is_compressed(file_path):
+            import_result = import_dump(
+                app.state.active_installation['directory'], file_path)
+        else:
+            import_result = Call.wpcli(
+                app,
+                [
+                    'db',
+                    'import',
+                    file_path
+                ])
         L.debug('Import_results: %s', import_result)
         if import_result[0]:
             L.debug('Import Result:  %s', import_result[0])
@@ -268,11 +811,18 @@ class DatabaseInformation(object):
         L.debug('db_name: %s', db_name)
         for root, _, files in os.walk(homedir, topdown=True):
             for file_name in files:
-                if db_name in file_name and 'sql' in file_name:
+                if db_name in file_name and \
+                        file_name.endswith(DUMP_EXTENSIONS):
                     L.debug('Import Found: %s', file_name)
                     if '/.' not in root:
                         _x = os.path.join(root, file_name)
                         imports.append(_x)
+                elif file_name == MANIFEST and \
+                        root.endswith(DUMP_DIR_EXTENSION) and \
+                        db_name in os.path.basename(root):
+                    L.debug('Parallel Import Found: %s', root)
+                    if '/.' not in root:
+                        imports.append(root)
         return imports
 
     def optimize_db(self):
@@ -321,6 +871,18 @@ class DatabaseInformation(object):
             ])
         wpcli_thread.start()
 
+    def db_search_engine(self, query):
+        """Returns a DbSearchEngine for query, or None if the database
+        can not be searched directly"""
+        settings = getattr(self.app.settings, 'database', {})
+        if not settings.get('native_search', False) or \
+                not DbConnections.get(self.app):
+            return None
+        install_path = self.app.state.active_installation['directory']
+        return DbSearchEngine(
+            lambda: DbConnections.connect(self.app, install_path, settings),
+            query, settings)
+
     def db_search(self, query):
         """Searches database"""
         L.debug("Begin DB Search WP Cli")
@@ -361,7 +923,37 @@ class DatabaseInformation(object):
             return "Database Search Error"
 
     def search_replace(self, sr_search_term, sr_replace_term, dry_run=True):
-        """Search and replace database"""
+        """Search and replace database. Uses SearchReplaceEngine over
+        direct DB connections when possible, otherwise wp search-replace
+        """
+        settings = getattr(self.app.settings, 'database', {})
+        if settings.get('native_search_replace', False) and \
+                DbConnections.get(self.app):
+            install_path = self.app.state.active_installation['directory']
+            # the real run only revisits the rows the dry run matched
+            plan = None
+            if self.sr_plan and self.sr_plan[0] == install_path:
+                plan = self.sr_plan[1]
+            self.sr_plan = None
+            engine = SearchReplaceEngine(
+                lambda: DbConnections.connect(
+                    self.app, install_path, settings),
+                sr_search_term, sr_replace_term, settings, dry_run=dry_run,
+                plan=plan)
+            try:
+                results = engine.run()
+            except (DbError, WpConfigParseError, OSError) as error:
+                L.warning('Native search-replace failed: %s', error)
+                if not dry_run:
+                    # tables already done would be replaced twice
+                    return str(error)
+            else:
+                if dry_run:
+                    self.sr_plan = (install_path, engine.plan)
+                else:
+                    # rows were changed behind the object cache's back
+                    Call.wpcli(self.app, ['cache', 'flush'])
+                return results
         L.debug("Begin wp search-replace")
         call_args = [
             'search-replace',
@@ -423,6 +1015,21 @@ class WpConfig(object):
         L.debug('Progress: %s', self.progress)
         L.debug('self.app.action_pipe: %s', self.app.action_pipe)
         os.write(self.app.action_pipe, str.encode(str(self.progress)))
+        config_path = os.path.join(
+            self.app.state.active_installation['directory'],
+            'wp-config.php')
+        try:
+            self.wp_config_directive_list = WpConfigParser.parse_file(
+                config_path)
+        except (WpConfigParseError, OSError) as error:
+            L.debug('wp-config.php not parsed, using wp-cli: %s', error)
+        else:
+            self.wp_config_error = None
+            try:
+                os.close(self.app.action_pipe)
+            except OSError:
+                L.warning('self.app.action_pipe already closed')
+            return
         wp_config_result, wp_config_error = Call.wpcli(
             self.app, [
                 'config', 'list',
@@ -439,6 +1046,60 @@ class WpConfig(object):
         except OSError:
             L.warning('self.app.action_pipe already closed')
 
+    @staticmethod
+    def get_db_name(app, install_path):
+        """Returns DB_NAME for the installation at install_path, read
+        from wp-config.php directly when possible"""
+        try:
+            db_name = WpConfigParser.get_constant(
+                os.path.join(install_path, 'wp-config.php'), 'DB_NAME')
+        except (WpConfigParseError, OSError) as error:
+            L.debug('DB_NAME not parsed, using wp-cli: %s', error)
+        else:
+            if db_name is not None:
+                return str(db_name)
+        db_name, _ = Call.wpcli(
+            app,
+            ['config', 'get', 'DB_NAME'],
+            install_path=install_path)
+        return db_name.rstrip()
+
+    def apply_wp_config(self, changes):
+        """Applies a batch of wp_config changes in a single rewrite of
+        wp-config.php. changes is a list of (directive_name, value)
+        tuples, where a value of None removes the directive.
+        Returns a dict of directive_name: True / False.
+        Falls back to one wp-cli call per directive if the file can not
+        be edited statically"""
+        path = self.app.state.active_installation['directory']
+        editor = WpConfigEditor(os.path.join(path, 'wp-config.php'))
+        for directive_name, directive_value in changes:
+            if directive_value is None:
+                editor.delete(directive_name)
+            else:
+                editor.set(directive_name, directive_value)
+        try:
+            results = editor.apply()
+        except (WpConfigParseError, OSError) as error:
+            L.warning('wp-config.php batch edit failed, using wp-cli: %s',
+                      error)
+            results = {}
+            for directive_name, directive_value in changes:
+                if directive_value is None:
+                    results[directive_name] = self.del_wp_config(
+                        directive_name)
+                else:
+                    results[directive_name] = self.set_wp_config(
+                        directive_name, directive_value)
+        else:
+            workers = Call.get_workers(self.app)
+            if workers:
+                workers.recycle(path)
+        if any(name.startswith('DB_') for name, _value in changes):
+            DbConnections.close(path)
+        L.debug('apply_wp_config results: %s', results)
+        return results
+
     def set_wp_config(self, directive_name, directive_value):
         """Sets a single wp_config directive.
         This is used by the wp_config display screen edit widgets"""
@@ -516,8 +1177,55 @@ class Themes(object):
             os.write(self.app.action_pipe, str.encode(str(progress)))
         except OSError:
             L.warning('Action Pipe not opened')
-        fields = ['name', 'status', 'update', 'version',
-                  'update_version', 'update_package', 'title', 'description']
+        result_json = self.get_listing()
+        try:
+            os.close(self.app.action_pipe)
+        except OSError:
+            L.warning('Action Pipe already closed')
+        if result_json:
+            return result_json
+
+    def get_listing(self):
+        """Returns the theme list, from ListingCache when it is current,
+        with update fields from the shared UpdateCache"""
+
+        updates = UpdateCache.for_app(self.app)
+        result_json = ListingCache.get(self.app, 'theme')
+        if result_json is None:
+            result_json = self.list_themes(updates)
+        if result_json and updates:
+            result_json = updates.add_updates('theme', result_json)
+        return result_json
+
+    def list_themes(self, updates=None):
+        """Lists themes, and caches the result in ListingCache. With an
+        UpdateCache, themes are read from their style.css where possible,
+        and otherwise listed by wp-cli without its update check"""
+
+        root = None
+        if updates and getattr(self.app.settings, 'wpcli', {}).get(
+                'native_headers', True):
+            root = content_roots(
+                self.app.state.active_installation['directory'])[1]
+            if root and not os.path.isdir(root):
+                root = None
+        native = bool(root)
+        if not native:
+            root = (self.get_theme_root() or '').rstrip()
+        roots = [root] if root else []
+        fingerprint = ListingCache.fingerprint(self.app, 'theme', roots)
+        if native:
+            result_json = self.scan_list(root)
+            if result_json is not None:
+                ListingCache.put(
+                    self.app, 'theme', roots, fingerprint, result_json)
+                return result_json
+        if updates:
+            fields = ['name', 'status', 'version', 'title', 'description']
+        else:
+            fields = ['name', 'status', 'update', 'version',
+                      'update_version', 'update_package', 'title',
+                      'description']
         args = '--fields=' + ','.join(fields)
         results, error = Call.wpcli(
             self.app,
@@ -526,20 +1234,59 @@ class Themes(object):
                 'list',
                 args,
                 '--format=json'
-            ])
-        result_json = json.loads(results)
+            ] + (['--skip-update-check'] if updates else []))
+        try:
+            result_json = json.loads(results)
+        except ValueError:
+            result_json = None
         L.debug('get_list results: %s', result_json)
         L.debug('get_list errors: %s', error)
-        try:
-            os.close(self.app.action_pipe)
-        except OSError:
-            L.warning('Action Pipe already closed')
         if result_json:
-            return result_json
+            ListingCache.put(
+                self.app, 'theme', roots, fingerprint, result_json)
+        return result_json
+
+    def scan_list(self, root):
+        """Returns the theme list read from the style.css files under
+        root, or None if the active theme can't be read"""
+
+        options = ListingCache.option_values(
+            self.app, ['template', 'stylesheet'])
+        if not options:
+            return None
+        template, stylesheet = [(value or '').strip() for value in options]
+        themes = scan_themes(root, getattr(self.app.settings, 'wpcli', {})
+                             .get('header_scan_workers', 8))
+        listing = []
+        for name, theme in sorted(themes.items()):
+            if name == stylesheet:
+                status = 'active'
+            elif name == template:
+                status = 'parent'
+            else:
+                status = 'inactive'
+            listing.append({
+                'name': name,
+                'status': status,
+                'version': theme['Version'],
+                'title': theme['Name'],
+                'description': theme['Description'],
+                'headers': theme
+            })
+        return listing
+
+    def invalidate_list(self):
+        """Drops the cached theme list, ahead of a change to themes"""
+
+        ListingCache.invalidate(self.app, 'theme')
 
     def get_details(self, theme_name):
-        """Gets theme details"""
+        """Gets theme details, from the theme's style.css when it can be
+        found, otherwise from `wp theme get`"""
 
+        theme_details = self.read_details(theme_name)
+        if theme_details:
+            return theme_details
         result, error = Call.wpcli(
             self.app,
             [
@@ -557,6 +1304,48 @@ class Themes(object):
         else:
             return False
 
+    def read_details(self, theme_name):
+        """Returns the details `wp theme get` gives, read from style.css
+        and the template and stylesheet options, or None if the theme
+        can't be read directly"""
+
+        if not getattr(self.app.settings, 'wpcli', {}).get(
+                'native_headers', True):
+            return None
+        root = content_roots(
+            self.app.state.active_installation['directory'])[1]
+        theme = read_theme(root, theme_name) if root else None
+        options = ListingCache.option_values(
+            self.app, ['template', 'stylesheet']) if theme else None
+        if not options:
+            return None
+        template, stylesheet = [(value or '').strip() for value in options]
+        parent = read_theme(root, theme['Template']) \
+            if theme['Template'] else None
+        if theme_name == stylesheet:
+            status = 'active'
+        elif theme_name == template:
+            status = 'parent'
+        else:
+            status = 'inactive'
+        return {
+            'name': theme_name,
+            'title': theme['Name'],
+            'version': theme['Version'],
+            'status': status,
+            'parent_theme': parent['Name'] if parent else '',
+            'template_dir': os.path.join(
+                root, theme['Template'] or theme_name),
+            'stylesheet_dir': os.path.join(root, theme_name),
+            'template': theme['Template'] or theme_name,
+            'stylesheet': theme_name,
+            'description': theme['Description'],
+            'author': theme['Author'],
+            'tags': [tag.strip() for tag in theme['Tags'].split(',')
+                     if tag.strip()],
+            'theme_root': root
+        }
+
     def activate(self, theme_name):
         """Activates theme"""
 
@@ -577,8 +1366,9 @@ class Themes(object):
             ])
         wpcli_thread.start()
 
-    def update(self, theme_name):
-        """Updates theme"""
+    def update(self, theme_name, before=None):
+        """Updates theme. before, if given, runs in the wp-cli thread
+        ahead of the update"""
 
         self.app.wpcli_pipe = self.app.loop.watch_pipe(
             self.app.views.Themes.body.update_view)
@@ -594,11 +1384,41 @@ class Themes(object):
                     'update',
                     theme_name
                 ]
-            ])
+            ],
+            kwargs={'before': before})
         wpcli_thread.start()
 
-    def uninstall(self, theme_name):
-        """uninstalls theme"""
+    def get_update_names(self):
+        """Returns the names of the themes with an update available"""
+
+        if UpdateCache.for_app(self.app):
+            return [theme['name'] for theme in self.get_listing() or []
+                    if theme['update'] == 'available']
+        result, error = Call.wpcli(
+            self.app,
+            [
+                'theme',
+                'list',
+                '--update=available',
+                '--field=name'
+            ])
+        if error:
+            L.warning('Error obtaining theme updates: %s', error)
+        return result.split() if result else []
+
+    def update_job(self, theme_name, install_path, package=None):
+        """Updates a theme as a step of a JobQueue, from the package file
+        if one was downloaded. Returns (stdout, stderr, status)"""
+
+        if package:
+            arguments = ['theme', 'install', package, '--force']
+        else:
+            arguments = ['theme', 'update', theme_name]
+        return Call.run_job(self.app, arguments, install_path)
+
+    def uninstall(self, theme_name, before=None):
+        """uninstalls theme. before, if given, runs in the wp-cli thread
+        ahead of the uninstall"""
 
         self.app.wpcli_pipe = self.app.loop.watch_pipe(
             self.app.views.Themes.body.update_view)
@@ -614,7 +1434,8 @@ class Themes(object):
                     'uninstall',
                     theme_name
                 ]
-            ])
+            ],
+            kwargs={'before': before})
         wpcli_thread.start()
 
     def install(self, theme_name):
@@ -647,14 +1468,64 @@ class Plugins(object):
     def get_plugin_list(self):
         """Obtain list of plugins"""
 
-        fields = ['name', 'status', 'update', 'version',
-                  'update_version']
-        args = '--fields=' + ','.join(fields)
         progress = 0
         try:
             os.write(self.app.action_pipe, str.encode(str(progress)))
         except OSError:
             L.warning('Action Pipe not opened')
+        result_json = self.get_listing()
+        try:
+            os.close(self.app.action_pipe)
+        except OSError:
+            L.warning('Action Pipe already closed')
+        if result_json:
+            L.debug('Result_json: %s', result_json)
+            return result_json
+        return False
+
+    def get_listing(self):
+        """Returns the plugin list, from ListingCache when it is current,
+        with update fields from the shared UpdateCache"""
+
+        updates = UpdateCache.for_app(self.app)
+        result_json = ListingCache.get(self.app, 'plugin')
+        if result_json is None:
+            result_json = self.list_plugins(updates)
+        if result_json and updates:
+            result_json = updates.add_updates('plugin', result_json)
+        return result_json
+
+    def list_plugins(self, updates=None):
+        """Lists plugins, and caches the result in ListingCache. With an
+        UpdateCache, plugins are read from their headers where possible,
+        and otherwise listed by wp-cli without its update check.
+        Must-use plugins, also listed, live next to the plugin root"""
+
+        install_path = self.app.state.active_installation['directory']
+        root = None
+        if updates and getattr(self.app.settings, 'wpcli', {}).get(
+                'native_headers', True) and not is_multisite(install_path):
+            root = content_roots(install_path)[0]
+            if root and not os.path.isdir(root):
+                root = None
+        native = bool(root)
+        if not native:
+            root = self.get_plugin_path()
+        roots = [root, os.path.join(os.path.dirname(root), 'mu-plugins')] \
+            if root else []
+        fingerprint = ListingCache.fingerprint(self.app, 'plugin', roots)
+        if native:
+            result_json = self.scan_list(*roots)
+            if result_json is not None:
+                ListingCache.put(
+                    self.app, 'plugin', roots, fingerprint, result_json)
+                return result_json
+        if updates:
+            fields = ['name', 'status', 'version', 'file', 'title']
+        else:
+            fields = ['name', 'status', 'update', 'version',
+                      'update_version']
+        args = '--fields=' + ','.join(fields)
         result, error = Call.wpcli(
             self.app,
             [
@@ -662,26 +1533,71 @@ class Plugins(object):
                 'list',
                 args,
                 '--format=json'
-            ]
+            ] + (['--skip-update-check'] if updates else [])
         )
+        if not result:
+            L.warning('Error: %s', error)
+            return None
         try:
-            os.close(self.app.action_pipe)
-        except OSError:
-            L.warning('Action Pipe already closed')
-        if result:
             result_json = json.loads(result)
-            if result_json:
-                L.debug('Result_json: %s', result_json)
-                return result_json
-            else:
-                return False
-        else:
-            L.warning('Error: %s', error)
-            return False
+        except ValueError:
+            L.warning('Unreadable plugin list: %s', result)
+            return None
+        if result_json:
+            ListingCache.put(
+                self.app, 'plugin', roots, fingerprint, result_json)
+        return result_json
+
+    def scan_list(self, root, mu_root):
+        """Returns the plugin list read from the plugin headers under
+        root and the must-use plugins in mu_root, or None if the active
+        plugins can't be read. Drop-ins are not listed"""
+
+        active = self.get_active_files()
+        if active is None:
+            return None
+        plugins = scan_plugins(root, getattr(self.app.settings, 'wpcli', {})
+                               .get('header_scan_workers', 8))
+        listing = [{
+            'name': name,
+            'status': 'active' if plugin['File'] in active else 'inactive',
+            'version': plugin['Version'],
+            'file': plugin['File'],
+            'title': plugin['Name'],
+            'headers': plugin
+        } for name, plugin in sorted(plugins.items())]
+        try:
+            mu_files = sorted(entry for entry in os.listdir(mu_root)
+                              if entry.endswith('.php'))
+        except OSError:
+            mu_files = []
+        for mu_file in mu_files:
+            try:
+                plugin = get_file_data(
+                    os.path.join(mu_root, mu_file), PLUGIN_HEADERS)
+            except (OSError, IOError):
+                continue
+            listing.append({
+                'name': mu_file[:-4],
+                'status': 'must-use',
+                'version': plugin['Version'],
+                'file': mu_file,
+                'title': plugin['Name'] or mu_file
+            })
+        return listing
+
+    def invalidate_list(self):
+        """Drops the cached plugin list, ahead of a change to plugins"""
+
+        ListingCache.invalidate(self.app, 'plugin')
 
     def get_details(self, plugin_name):
-        """Get plugin details"""
+        """Get plugin details, from the plugin's header when it can be
+        found, otherwise from `wp plugin get`"""
 
+        plugin_details = self.read_details(plugin_name)
+        if plugin_details:
+            return plugin_details
         result, error = Call.wpcli(
             self.app,
             [
@@ -699,6 +1615,44 @@ class Plugins(object):
         else:
             return False
 
+    def read_details(self, plugin_name):
+        """Returns the details `wp plugin get` gives, read from the
+        plugin's header and the active_plugins option, or None if the
+        plugin can't be read directly. Multisite installations, where
+        plugins can also be network activated, always use wp-cli"""
+
+        install_path = self.app.state.active_installation['directory']
+        if not getattr(self.app.settings, 'wpcli', {}).get(
+                'native_headers', True) or is_multisite(install_path):
+            return None
+        root = content_roots(install_path)[0]
+        plugin = read_plugin(root, plugin_name) if root else None
+        active = self.get_active_files() if plugin else None
+        if active is None:
+            return None
+        return {
+            'name': plugin_name,
+            'title': plugin['Name'],
+            'author': plugin['Author'],
+            'version': plugin['Version'],
+            'description': plugin['Description'],
+            'status': 'active' if plugin['File'] in active else 'inactive'
+        }
+
+    def get_active_files(self):
+        """Returns the main files of the active plugins, relative to the
+        plugin root, or None if they can't be read. The option is either
+        serialized, read from the database, or var_export'ed by
+        `wp option get`"""
+
+        value = (ListingCache.option_values(
+            self.app, ['active_plugins']) or [None])[0]
+        if value is None:
+            return None
+        if value.startswith('a:'):
+            return re.findall(r's:\d+:"(.*?)";', value)
+        return re.findall(r"=> '((?:[^'\\]|\\.)*)'", value)
+
     def get_plugin_path(self, plugin_name=None):
         """Get path to plugin dir, or path to plugin_root """
 
@@ -744,8 +1698,9 @@ class Plugins(object):
             ])
         wpcli_thread.start()
 
-    def update(self, plugin_name,):
-        """Updates a plugin """
+    def update(self, plugin_name, before=None):
+        """Updates a plugin. before, if given, runs in the wp-cli thread
+        ahead of the update"""
 
         L.debug('plugin_name: %s', plugin_name)
         self.app.wpcli_pipe = self.app.loop.watch_pipe(
@@ -762,9 +1717,38 @@ class Plugins(object):
                     'update',
                     plugin_name
                 ]
-            ])
+            ],
+            kwargs={'before': before})
         wpcli_thread.start()
 
+    def get_update_names(self):
+        """Returns the names of the plugins with an update available"""
+
+        if UpdateCache.for_app(self.app):
+            return [plugin['name'] for plugin in self.get_listing() or []
+                    if plugin['update'] == 'available']
+        result, error = Call.wpcli(
+            self.app,
+            [
+                'plugin',
+                'list',
+                '--update=available',
+                '--field=name'
+            ])
+        if error:
+            L.warning('Error obtaining plugin updates: %s', error)
+        return result.split() if result else []
+
+    def update_job(self, plugin_name, install_path, package=None):
+        """Updates a plugin as a step of a JobQueue, from the package file
+        if one was downloaded. Returns (stdout, stderr, status)"""
+
+        if package:
+            arguments = ['plugin', 'install', package, '--force']
+        else:
+            arguments = ['plugin', 'update', plugin_name]
+        return Call.run_job(self.app, arguments, install_path)
+
     def activate(self, plugin_name):
         """Activates a plugin"""
 
@@ -805,8 +1789,9 @@ class Plugins(object):
             ])
         wpcli_thread.start()
 
-    def uninstall(self, plugin_name):
-        """Uninstalls a plugin"""
+    def uninstall(self, plugin_name, before=None):
+        """Uninstalls a plugin. before, if given, runs in the wp-cli
+        thread ahead of the uninstall"""
 
         self.app.wpcli_pipe = self.app.loop.watch_pipe(
             self.app.views.Plugins.body.update_view)
@@ -822,7 +1807,8 @@ class Plugins(object):
                     'uninstall',
                     plugin_name
                 ]
-            ])
+            ],
+            kwargs={'before': before})
         wpcli_thread.start()
 
     def get_active_plugins(self):
@@ -862,15 +1848,27 @@ class Plugins(object):
 
 class Call(object):
     """opens a subprocess to run wp-cli command"""
+    workers = None
+
     @staticmethod
     def wpcli(app, arguments, skip_themes=True, skip_plugins=True,
               install_path=None):
-        """runs_wp-cli command"""
+        """runs_wp-cli command
+
+        The command is dispatched to the installation's resident
+        WpCliWorker when one is available, otherwise a new wp-cli
+        process is forked for this call only"""
         if install_path:
             path = install_path
         else:
             path = app.state.active_installation['directory']
         L.debug('Begin wp-cli command: %s', arguments)
+        workers = Call.get_workers(app)
+        if workers:
+            result = workers.run(
+                path, arguments, skip_themes, skip_plugins)
+            if result is not None:
+                return result
         popen_args = ['wp']
         for argument in arguments:
             popen_args.append(argument)
@@ -879,18 +1877,34 @@ class Call(object):
             popen_args.append('--skip-themes')
         if skip_plugins:
             popen_args.append('--skip-plugins')
-        data, error = subprocess.Popen(
-            popen_args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        ).communicate()
-        return data.decode('UTF-8'), error.decode('UTF-8')
+        return Job(popen_args).communicate()
 
     @staticmethod
-    def wpcli_live_response(app, callback,
-                            arguments, skip_themes=True, skip_plugins=True):
-        # L.debug('pipe: %s, path: %s, arguments: %s', pipe, path, arguments)
-        """runs_wp-cli command"""
+    def get_workers(app):
+        """Returns the shared WpCliWorkers pool, or None when
+        worker mode is disabled in settings.json"""
+        settings = getattr(app.settings, 'wpcli', {})
+        if not settings.get('worker_enabled', False):
+            return None
+        if Call.workers is None:
+            Call.workers = WpCliWorkers(
+                max_commands=settings.get('worker_max_commands', 50),
+                retry_delay=settings.get('worker_retry_delay', 60),
+                max_workers=settings.get('worker_max_workers', 8),
+                idle_timeout=settings.get('worker_idle_timeout', 300))
+        return Call.workers
+
+    @staticmethod
+    def close_workers():
+        """Stops all resident wp-cli workers"""
+        if Call.workers:
+            Call.workers.close_all()
+
+    @staticmethod
+    def wpcli_to_pipe(app, arguments, skip_themes=True, skip_plugins=True):
+        """Runs a wp-cli command as an interactive Job, writing its
+        output to app.wpcli_pipe as it is produced, followed by the
+        reason if it did not finish. Returns the job's status"""
         L.debug('Begin wp-cli command: %s', arguments)
         path = app.state.active_installation['directory']
         popen_args = ['wp']
@@ -901,15 +1915,291 @@ class Call(object):
             popen_args.append('--skip-themes')
         if skip_plugins:
             popen_args.append('--skip-plugins')
-        proc = subprocess.Popen(
+        job = Job(popen_args, interactive=True)
+        for line in job.lines():
+            L.debug('proc line: %s', line)
+            os.write(app.wpcli_pipe, line)
+        if job.reason:
+            os.write(app.wpcli_pipe, str.encode(job.message() + '\n'))
+        return job.status
+
+    @staticmethod
+    def wpcli_live_response(app, callback,
+                            arguments, skip_themes=True, skip_plugins=True,
+                            before=None):
+        """runs_wp-cli command. before, if given, is run first in the
+        same thread, and may write progress to app.wpcli_pipe. The
+        command is skipped if the cancel key is pressed meanwhile"""
+        cancellations = Job.cancellations
+        try:
+            if before:
+                before()
+            if Job.cancellations != cancellations:
+                os.write(app.wpcli_pipe, b'Error: cancelled\n')
+            else:
+                Call.wpcli_to_pipe(app, arguments, skip_themes, skip_plugins)
+        finally:
+            os.close(app.wpcli_pipe)
+            callback()
+
+    @staticmethod
+    def run_job(app, arguments, install_path, skip_themes=True,
+                skip_plugins=True):
+        """Runs a wp-cli command for install_path as an interactive Job,
+        so the cancel key stops it. Returns (stdout, stderr, status)"""
+        L.debug('Begin wp-cli job: %s', arguments)
+        popen_args = ['wp'] + list(arguments) + ['--path=' + install_path]
+        if skip_themes:
+            popen_args.append('--skip-themes')
+        if skip_plugins:
+            popen_args.append('--skip-plugins')
+        job = Job(popen_args, interactive=True)
+        result, error = job.communicate()
+        return result, error, job.status
+
+
+class WpCliWorker(object):
+    """A single resident wp-cli process for one installation.
+
+    wpcli_worker.php is started through `wp eval-file`, so PHP and
+    WordPress are bootstrapped once. Commands are written to its stdin as
+    JSON argument lists, and each one is answered by a single JSON line
+    on stdout prefixed with MARKER."""
+    MARKER = b'\x1eWPUI '
+    SCRIPT = os.path.join(os.path.dirname(__file__), 'wpcli_worker.php')
+
+    def __init__(self, path, skip_themes=True, skip_plugins=True):
+        self.path = path
+        self.commands = 0
+        self.expired = False
+        self.last_used = time.time()
+        self.lock = Lock()
+        popen_args = ['wp', 'eval-file', self.SCRIPT, '--path=' + path]
+        if skip_themes:
+            popen_args.append('--skip-themes')
+        if skip_plugins:
+            popen_args.append('--skip-plugins')
+        L.debug('Starting wp-cli worker: %s', popen_args)
+        self.proc = subprocess.Popen(
             popen_args,
-            stdout=subprocess.PIPE)
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        self.ready = bool(self.read_response())
+        if not self.ready:
+            L.warning('wp-cli worker failed to start for %s', path)
+            self.close()
+
+    def read_response(self):
+        """Reads stdout until a MARKER line is found.
+        Returns the decoded dict, or None if the worker has exited"""
         while True:
-            line = proc.stdout.readline()
-            if proc.poll() or line == b'':
-                os.close(app.wpcli_pipe)
-                break
-            else:
-                L.debug('proc line: %s', line)
-                os.write(app.wpcli_pipe, line)
-        callback()
+            line = self.proc.stdout.readline()
+            if not line:
+                return None
+            if line.startswith(self.MARKER):
+                try:
+                    return json.loads(
+                        line[len(self.MARKER):].decode('UTF-8'))
+                except ValueError as error:
+                    L.warning('Unreadable worker response: %s', error)
+                    return None
+            L.debug('Worker stray output: %s', line)
+
+    def run(self, arguments):
+        """Runs a wp-cli command inside the worker.
+        Returns (stdout, stderr), or None if the command could not be
+        sent, so the caller can fork it instead. A command the worker
+        died running is not run again, as it may have changed the
+        installation partway. A command that runs past its Job timeout
+        kills the worker"""
+        with self.lock:
+            self.last_used = time.time()
+            if not self.alive():
+                return None
+            request = json.dumps(list(arguments)) + '\n'
+            try:
+                self.proc.stdin.write(request.encode('UTF-8'))
+                self.proc.stdin.flush()
+            except (OSError, ValueError) as error:
+                # the worker reads whole lines, so it never saw it
+                L.warning('wp-cli worker pipe error: %s', error)
+                return None
+            timeout = Job.get_timeout(['wp'] + list(arguments))
+            timer = None
+            self.expired = False
+            if timeout:
+                timer = Timer(timeout, self.timed_out)
+                timer.daemon = True
+                timer.start()
+            response = self.read_response()
+            if timer:
+                timer.cancel()
+            self.last_used = time.time()
+            if response is None and self.expired:
+                # running it again by forking would hang too
+                return '', 'Error: timed out after %ss' % timeout
+            if response is None:
+                L.warning('wp-cli worker for %s died running %s',
+                          self.path, arguments)
+                return '', 'Error: wp-cli worker exited while running ' \
+                    'the command'
+            self.commands += 1
+            stderr = response['stderr']
+            return_code = response.get('return_code')
+            if return_code:
+                L.debug('Worker command %s exit status %s',
+                        arguments, return_code)
+                if not stderr.strip():
+                    stderr = 'Error: exit status %s' % return_code
+            return response['stdout'], stderr
+
+    def timed_out(self):
+        """Kills the worker when a command runs past its timeout"""
+        self.expired = True
+        self.proc.kill()
+
+    def alive(self):
+        """True while the worker process is running"""
+        return self.proc.poll() is None
+
+    def busy(self):
+        """True while a command is running in the worker"""
+        if self.lock.acquire(blocking=False):
+            self.lock.release()
+            return False
+        return True
+
+    def close(self):
+        """Ends the worker by closing its stdin"""
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+class WpCliWorkers(object):
+    """Keeps one WpCliWorker per installation / skip flags combination.
+    Workers are recycled after max_commands commands, after commands that
+    change wp-config.php or replace the database, and when they crash.
+    Installations whose worker can not start are retried after
+    retry_delay seconds, and use fork-per-call until then. At most
+    max_workers are kept, the least recently used making way for new
+    ones, and workers idle for idle_timeout seconds are stopped."""
+    RECYCLE_COMMANDS = [
+        ['config', 'set'],
+        ['config', 'delete'],
+        ['config', 'create'],
+        ['config', 'shuffle-salts'],
+        ['db', 'import'],
+        ['db', 'reset'],
+        ['core', 'update'],
+    ]
+
+    def __init__(self, max_commands=50, retry_delay=60, max_workers=8,
+                 idle_timeout=300):
+        self.max_commands = max_commands
+        self.retry_delay = retry_delay
+        self.max_workers = max(1, int(max_workers))
+        self.idle_timeout = idle_timeout
+        # least recently used first
+        self.workers = OrderedDict()
+        self.failed = {}
+        self.starting = set()
+        self.lock = Lock()
+        self.closed = Event()
+        if idle_timeout:
+            Thread(target=self.reap, name='wpcli_worker_reaper',
+                   daemon=True).start()
+
+    def reap(self):
+        """Stops idle workers every so often, until close_all"""
+        while not self.closed.wait(max(1, self.idle_timeout / 2)):
+            self.evict(time.time() - self.idle_timeout)
+
+    def evict(self, idle_since=None, room=0):
+        """Stops the workers not used since idle_since, and then the
+        least recently used idle ones until room more can start"""
+        with self.lock:
+            stopping = []
+            for key, worker in list(self.workers.items()):
+                if worker.busy():
+                    continue
+                if (idle_since and worker.last_used < idle_since) or \
+                        len(self.workers) + len(self.starting) + room > \
+                        self.max_workers:
+                    stopping.append(self.workers.pop(key))
+        for worker in stopping:
+            L.debug('Stopping wp-cli worker for %s', worker.path)
+            worker.close()
+
+    def get_worker(self, key):
+        """Returns a running worker for key, starting one if needed.
+        Workers are started outside of the pool lock, so installations
+        can bootstrap concurrently. Callers for a key whose worker is
+        still starting get None and fork instead"""
+        with self.lock:
+            worker = self.workers.get(key)
+            if worker and worker.alive() and \
+                    worker.commands < self.max_commands:
+                self.workers.move_to_end(key)
+                return worker
+            if worker:
+                del self.workers[key]
+            start = key not in self.starting and \
+                time.time() - self.failed.get(key, 0) >= self.retry_delay
+            if start:
+                self.starting.add(key)
+        if worker:
+            worker.close()
+        if not start:
+            return None
+        # starting counts this worker already
+        self.evict()
+        try:
+            worker = WpCliWorker(*key)
+        except OSError as error:
+            L.warning('Unable to start wp-cli worker: %s', error)
+            worker = None
+        with self.lock:
+            self.starting.discard(key)
+            if not worker or not worker.ready:
+                self.failed[key] = time.time()
+                return None
+            self.failed.pop(key, None)
+            self.workers[key] = worker
+            return worker
+
+    def run(self, path, arguments, skip_themes=True, skip_plugins=True):
+        """Runs arguments in the worker for path.
+        Returns None when the caller should fall back to fork-per-call"""
+        key = (path, skip_themes, skip_plugins)
+        worker = self.get_worker(key)
+        if not worker:
+            return None
+        result = worker.run(arguments)
+        if result is None or not worker.alive():
+            L.warning('wp-cli worker for %s crashed, recycling', path)
+            self.recycle(path)
+        elif arguments[:2] in self.RECYCLE_COMMANDS:
+            self.recycle(path)
+        return result
+
+    def recycle(self, path):
+        """Stops every worker belonging to path. A new one is started on
+        the next command"""
+        with self.lock:
+            for key in [key for key in self.workers if key[0] == path]:
+                self.workers.pop(key).close()
+
+    def close_all(self):
+        """Stops all workers"""
+        self.closed.set()
+        with self.lock:
+            for worker in self.workers.values():
+                worker.close()
+            self.workers = OrderedDict()
@@ -0,0 +1,83 @@
+<?php
+/**
+ * Long lived wp-cli worker used by wpcli.WpCliWorker
+ *
+ * Started once per installation through `wp eval-file`, so WordPress is
+ * bootstrapped a single time. Each line read from STDIN is a JSON encoded
+ * list of wp-cli arguments. The command is run in-process and a single
+ * JSON encoded result line, prefixed with the record separator marker, is
+ * written to STDOUT.
+ */
+
+$wpui_marker = "\x1eWPUI ";
+
+function wpui_respond( $marker, $data ) {
+	fwrite( STDOUT, $marker . json_encode( $data ) . "\n" );
+	fflush( STDOUT );
+}
+
+// A command that calls exit() ends the worker; answer it with the
+// output it made, so it is not taken for a crash and run again
+$wpui_running = false;
+register_shutdown_function(
+	function () use ( $wpui_marker, &$wpui_running ) {
+		if ( ! $wpui_running ) {
+			return;
+		}
+		$stray = '';
+		while ( ob_get_level() > 0 ) {
+			$stray = ob_get_clean() . $stray;
+		}
+		wpui_respond(
+			$wpui_marker,
+			array(
+				'stdout'      => $stray,
+				'stderr'      => '',
+				'return_code' => 0,
+				'exited'      => true,
+			)
+		);
+	}
+);
+
+wpui_respond( $wpui_marker, array( 'ready' => true ) );
+
+while ( false !== ( $line = fgets( STDIN ) ) ) {
+	$args = json_decode( $line, true );
+	if ( ! is_array( $args ) ) {
+		continue;
+	}
+	// Other processes may have changed the database since the last command
+	wp_cache_flush();
+	$command = implode( ' ', array_map( 'escapeshellarg', $args ) );
+	ob_start();
+	$wpui_running = true;
+	try {
+		$result = WP_CLI::runcommand(
+			$command,
+			array(
+				'return'     => 'all',
+				'launch'     => false,
+				'exit_error' => false,
+				'parse'      => false,
+			)
+		);
+		$response = array(
+			'stdout'      => (string) $result->stdout,
+			'stderr'      => (string) $result->stderr,
+			'return_code' => (int) $result->return_code,
+		);
+	} catch ( Throwable $error ) {
+		$response = array(
+			'stdout'      => '',
+			'stderr'      => $error->getMessage(),
+			'return_code' => 1,
+		);
+	}
+	$wpui_running = false;
+	$stray = ob_get_clean();
+	if ( $stray ) {
+		$response['stdout'] = $stray . $response['stdout'];
+	}
+	wpui_respond( $wpui_marker, $response );
+}
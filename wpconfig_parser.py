@@ -0,0 +1,687 @@
+# -*- coding: utf-8 -*-
+"""Reads and edits wp-config.php without running PHP.
+
+wp-config.php is tokenized, and define() calls and simple top level
+variable assignments whose values are static (literals, arrays of literals,
+concatenation, __DIR__, __FILE__, dirname() and previously defined
+constants) are extracted. Anything that would need PHP to evaluate raises
+WpConfigParseError, so callers can fall back to wp-cli.
+
+WpConfigEditor uses the parsed statement offsets to apply a batch of
+set / delete operations in a single atomic rewrite of the file."""
+import os
+import re
+import copy
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+from logmod import Log
+
+L = Log()
+
+# Defined by WordPress / wp-cli before wp-config.php is loaded, and so not
+# reported by `wp config list` when wp-config.php defines them behind an
+# `if ( ! defined( ... ) )` guard
+PREDEFINED_CONSTANTS = ['ABSPATH']
+
+OPERATORS = [
+    '===', '!==', '<=>', '**=', '...', '<<=', '>>=', '??=',
+    '==', '!=', '<>', '<=', '>=', '&&', '||', '++', '--', '+=', '-=', '*=',
+    '/=', '.=', '%=', '&=', '|=', '^=', '->', '=>', '::', '<<', '>>', '??',
+    '**']
+
+IDENT_RE = re.compile(r'[A-Za-z_\x80-\uffff][A-Za-z0-9_\x80-\uffff]*')
+NUMBER_RE = re.compile(
+    r'0[xX][0-9a-fA-F_]+|0[bB][01_]+|'
+    r'(?:[0-9][0-9_]*)?\.[0-9][0-9_]*(?:[eE][+-]?[0-9]+)?|'
+    r'[0-9][0-9_]*(?:\.(?![.])[0-9_]*)?(?:[eE][+-]?[0-9]+)?')
+DOUBLE_ESCAPES = {
+    'n': '\n', 't': '\t', 'r': '\r', 'v': '\v', 'e': '\x1b', 'f': '\f',
+    '\\': '\\', '$': '$', '"': '"'}
+
+
+class WpConfigParseError(ValueError):
+    """Raised when wp-config.php can not be read statically"""
+
+
+class Token(object):
+    """A single PHP token. kind is one of
+    'ident', 'variable', 'string', 'number', 'op', 'inline_html' """
+
+    def __init__(self, kind, value, start, end, static=True):
+        self.kind = kind
+        self.value = value
+        self.start = start
+        self.end = end
+        self.static = static
+
+    def is_op(self, *values):
+        """True if the token is one of the given operators"""
+        return self.kind == 'op' and self.value in values
+
+    def is_ident(self, name):
+        """Case insensitive identifier comparison, as PHP uses for
+        function names and keywords"""
+        return self.kind == 'ident' and self.value.lower() == name
+
+    def __repr__(self):
+        return 'Token(%s, %r)' % (self.kind, self.value)
+
+
+def tokenize(source):
+    """Splits PHP source into Tokens, leaving out whitespace and comments"""
+    tokens = []
+    pos = 0
+    length = len(source)
+    in_php = False
+    while pos < length:
+        if not in_php:
+            open_tag = source.find('<?', pos)
+            if open_tag < 0:
+                if source[pos:].strip():
+                    tokens.append(
+                        Token('inline_html', source[pos:], pos, length))
+                break
+            if source[pos:open_tag].strip():
+                tokens.append(Token(
+                    'inline_html', source[pos:open_tag], pos, open_tag))
+            pos = open_tag + 2
+            if source[pos:pos + 3].lower() == 'php':
+                pos += 3
+            elif source[pos:pos + 1] == '=':
+                raise WpConfigParseError('Short echo tag')
+            in_php = True
+            continue
+        char = source[pos]
+        if char.isspace():
+            pos += 1
+        elif source.startswith('?>', pos):
+            # a closing tag also ends the statement
+            tokens.append(Token('op', ';', pos, pos + 2))
+            pos += 2
+            if source.startswith('\n', pos):
+                pos += 1
+            in_php = False
+        elif char == '#' or source.startswith('//', pos):
+            line_end = source.find('\n', pos)
+            close_tag = source.find('?>', pos)
+            if line_end < 0:
+                line_end = length
+            if 0 <= close_tag < line_end:
+                line_end = close_tag
+            pos = line_end
+        elif source.startswith('/*', pos):
+            comment_end = source.find('*/', pos + 2)
+            if comment_end < 0:
+                raise WpConfigParseError('Unterminated comment')
+            pos = comment_end + 2
+        elif source.startswith('<<<', pos):
+            raise WpConfigParseError('Heredoc strings are not supported')
+        elif char == "'":
+            pos = read_single_quoted(source, pos, tokens)
+        elif char == '"':
+            pos = read_double_quoted(source, pos, tokens)
+        elif char == '$' and IDENT_RE.match(source, pos + 1):
+            match = IDENT_RE.match(source, pos + 1)
+            tokens.append(
+                Token('variable', match.group(0), pos, match.end()))
+            pos = match.end()
+        elif char.isdigit() or (
+                char == '.' and source[pos + 1:pos + 2].isdigit()):
+            match = NUMBER_RE.match(source, pos)
+            tokens.append(Token(
+                'number', parse_number(match.group(0)), pos, match.end()))
+            pos = match.end()
+        elif IDENT_RE.match(source, pos):
+            match = IDENT_RE.match(source, pos)
+            tokens.append(Token('ident', match.group(0), pos, match.end()))
+            pos = match.end()
+        else:
+            for operator in OPERATORS:
+                if source.startswith(operator, pos):
+                    break
+            else:
+                operator = char
+            tokens.append(Token('op', operator, pos, pos + len(operator)))
+            pos += len(operator)
+    return tokens
+
+
+def read_single_quoted(source, pos, tokens):
+    """Reads a single quoted string starting at pos.
+    Returns the position after the closing quote"""
+    value = []
+    index = pos + 1
+    while index < len(source):
+        char = source[index]
+        if char == '\\' and source[index + 1:index + 2] in ("'", '\\'):
+            value.append(source[index + 1])
+            index += 2
+        elif char == "'":
+            tokens.append(Token('string', ''.join(value), pos, index + 1))
+            return index + 1
+        else:
+            value.append(char)
+            index += 1
+    raise WpConfigParseError('Unterminated string')
+
+
+def read_double_quoted(source, pos, tokens):
+    """Reads a double quoted string starting at pos. Strings that
+    interpolate variables are marked as not static.
+    Returns the position after the closing quote"""
+    value = []
+    static = True
+    index = pos + 1
+    while index < len(source):
+        char = source[index]
+        if char == '\\':
+            escape = source[index + 1:index + 2]
+            if escape in DOUBLE_ESCAPES:
+                value.append(DOUBLE_ESCAPES[escape])
+                index += 2
+            elif escape == 'x' and re.match(
+                    r'[0-9a-fA-F]', source[index + 2:index + 3]):
+                match = re.match(r'[0-9a-fA-F]{1,2}', source[index + 2:])
+                value.append(chr(int(match.group(0), 16)))
+                index += 2 + len(match.group(0))
+            elif re.match(r'[0-7]', escape):
+                match = re.match(r'[0-7]{1,3}', source[index + 1:])
+                value.append(chr(int(match.group(0), 8) & 0xff))
+                index += 1 + len(match.group(0))
+            elif escape == 'u' and source[index + 2:index + 3] == '{':
+                brace_end = source.find('}', index)
+                value.append(chr(int(source[index + 3:brace_end], 16)))
+                index = brace_end + 1
+            else:
+                value.append(char)
+                index += 1
+        elif char == '$' and (
+                IDENT_RE.match(source, index + 1) or
+                source[index + 1:index + 2] == '{'):
+            static = False
+            value.append(char)
+            index += 1
+        elif char == '{' and source[index + 1:index + 2] == '$':
+            static = False
+            value.append(char)
+            index += 1
+        elif char == '"':
+            tokens.append(Token(
+                'string', ''.join(value), pos, index + 1, static=static))
+            return index + 1
+        else:
+            value.append(char)
+            index += 1
+    raise WpConfigParseError('Unterminated string')
+
+
+def parse_number(text):
+    """Converts a PHP numeric literal to int or float"""
+    text = text.replace('_', '')
+    lowered = text.lower()
+    if lowered.startswith('0x'):
+        return int(text[2:], 16)
+    if lowered.startswith('0b'):
+        return int(text[2:], 2)
+    if '.' in text or 'e' in lowered:
+        return float(text)
+    if len(text) > 1 and text.startswith('0'):
+        return int(text, 8)
+    return int(text)
+
+
+class Directive(object):
+    """A define() call or variable assignment found in wp-config.php.
+    The offsets locate the whole statement, and the value expression,
+    in the file's source, for editing in place"""
+
+    def __init__(self, name, value, directive_type, start, end,
+                 value_start, value_end):
+        self.name = name
+        self.value = value
+        self.type = directive_type
+        self.start = start
+        self.end = end
+        self.value_start = value_start
+        self.value_end = value_end
+
+    def as_dict(self):
+        """Returns the directive as `wp config list --format=json`
+        reports it"""
+        return {'name': self.name, 'value': self.value, 'type': self.type}
+
+
+class WpConfigParser(object):
+    """Static parser for a single wp-config.php file"""
+    cache = {}
+    cache_lock = Lock()
+
+    def __init__(self, path, source=None):
+        self.path = path
+        if source is None:
+            with open(path, 'r', encoding='UTF-8', errors='surrogateescape') \
+                    as config_file:
+                source = config_file.read()
+        self.source = source
+        self.tokens = tokenize(source)
+        self.constants = {
+            '__DIR__': os.path.dirname(path),
+            '__FILE__': path,
+            'PHP_EOL': '\n',
+            'DIRECTORY_SEPARATOR': '/'}
+        self.directives = []
+        self.parse()
+
+    @classmethod
+    def parse_file(cls, path):
+        """Returns the directives of path as `wp config list` would,
+        as a list of {'name', 'value', 'type'} dicts. Results are cached
+        until the file's mtime, size or inode change.
+
+        Raises WpConfigParseError if the file can not be read statically,
+        and OSError if it can not be read at all"""
+        file_stat = os.stat(path)
+        key = (file_stat.st_mtime, file_stat.st_size, file_stat.st_ino)
+        with cls.cache_lock:
+            cached = cls.cache.get(path)
+        if cached and cached[0] == key:
+            return copy.deepcopy(cached[1])
+        parser = cls(path)
+        result = [directive.as_dict() for directive in parser.directives]
+        with cls.cache_lock:
+            cls.cache[path] = (key, result)
+        return copy.deepcopy(result)
+
+    @classmethod
+    def get_constant(cls, path, name, default=None):
+        """Returns the value of a single constant defined in path, or
+        default if it is not defined.
+        Raises the same errors as parse_file"""
+        for directive in cls.parse_file(path):
+            if directive['type'] == 'constant' and directive['name'] == name:
+                return directive['value']
+        return default
+
+    def parse(self):
+        """Finds every define() call, and every top level variable
+        assignment, and evaluates their values"""
+        tokens = self.tokens
+        seen = set()
+        depth = 0
+        index = 0
+        while index < len(tokens):
+            token = tokens[index]
+            previous = tokens[index - 1] if index else None
+            if token.is_ident('define') and \
+                    index + 1 < len(tokens) and \
+                    tokens[index + 1].is_op('(') and \
+                    not (previous and (
+                        previous.is_op('->', '::') or
+                        previous.is_ident('function'))):
+                start = token.start
+                if index > 0 and tokens[index - 1].is_op('\\'):
+                    start = tokens[index - 1].start
+                directive, index = self.parse_define(index, start)
+                if directive:
+                    if directive.name in seen:
+                        raise WpConfigParseError(
+                            'Constant %s is defined more than once' %
+                            directive.name)
+                    seen.add(directive.name)
+                    self.directives.append(directive)
+                continue
+            if token.kind == 'variable' and \
+                    index + 1 < len(tokens) and \
+                    tokens[index + 1].is_op('=') and \
+                    depth == 0 and \
+                    (not previous or previous.is_op(';', '{', '}')):
+                directive, index = self.parse_assignment(index)
+                if directive.name in seen:
+                    raise WpConfigParseError(
+                        'Variable %s is assigned more than once' %
+                        directive.name)
+                seen.add(directive.name)
+                self.directives.append(directive)
+                continue
+            if token.is_op('(', '['):
+                depth += 1
+            elif token.is_op(')', ']'):
+                depth -= 1
+            index += 1
+
+    def parse_define(self, index, start):
+        """Parses define( name, value [, case_insensitive] ).
+        Returns (Directive or None, index after the call)"""
+        tokens = self.tokens
+        args, index = self.split_arguments(index + 1)
+        if len(args) < 2 or len(args) > 3:
+            raise WpConfigParseError('Unexpected define() arguments')
+        name = self.evaluate(args[0])
+        if not isinstance(name, str):
+            raise WpConfigParseError('Constant name is not a string')
+        end = tokens[index - 1].end
+        if index < len(tokens) and tokens[index].is_op(';'):
+            end = tokens[index].end
+            index += 1
+        if name in PREDEFINED_CONSTANTS and self.is_guarded(start, name):
+            return None, index
+        value = self.evaluate(args[1])
+        self.constants[name] = value
+        return Directive(
+            name, value, 'constant', start, end,
+            args[1][0].start, args[1][-1].end), index
+
+    def parse_assignment(self, index):
+        """Parses $name = value;
+        Returns (Directive, index after the statement)"""
+        tokens = self.tokens
+        name = tokens[index].value
+        start = tokens[index].start
+        expression = []
+        position = index + 2
+        depth = 0
+        while position < len(tokens):
+            token = tokens[position]
+            if depth == 0 and token.is_op(';'):
+                break
+            if token.is_op('(', '['):
+                depth += 1
+            elif token.is_op(')', ']'):
+                depth -= 1
+            expression.append(token)
+            position += 1
+        else:
+            raise WpConfigParseError('Unterminated assignment')
+        if not expression:
+            raise WpConfigParseError('Empty assignment')
+        value = self.evaluate(expression)
+        return Directive(
+            name, value, 'variable', start, tokens[position].end,
+            expression[0].start, expression[-1].end), position + 1
+
+    def is_guarded(self, start, name):
+        """True if the define() at start sits behind
+        `if ( ! defined( 'name' ) )` """
+        preceding = self.source[max(0, start - 200):start]
+        return bool(re.search(
+            r'if\s*\(\s*!\s*defined\s*\(\s*[\'"]' + re.escape(name) +
+            r'[\'"]\s*\)\s*\)\s*[{:]?\s*$', preceding))
+
+    def split_arguments(self, index):
+        """Splits the argument list of the call whose '(' is at index.
+        Returns (list of token lists, index after the closing ')')"""
+        tokens = self.tokens
+        args = [[]]
+        depth = 0
+        index += 1
+        while index < len(tokens):
+            token = tokens[index]
+            if token.is_op('(', '['):
+                depth += 1
+            elif token.is_op(')', ']'):
+                if depth == 0:
+                    if not args[-1]:
+                        args.pop()
+                    return args, index + 1
+                depth -= 1
+            if depth == 0 and token.is_op(','):
+                args.append([])
+            else:
+                args[-1].append(token)
+            index += 1
+        raise WpConfigParseError('Unterminated argument list')
+
+    def evaluate(self, expression):
+        """Evaluates a static expression.
+        Raises WpConfigParseError for anything else"""
+        value, position = self.evaluate_concat(expression, 0)
+        if position != len(expression):
+            raise WpConfigParseError(
+                'Unsupported expression near %r' % expression[position])
+        return value
+
+    def evaluate_concat(self, expression, position):
+        """expression := operand ( '.' operand )*"""
+        value, position = self.evaluate_operand(expression, position)
+        while position < len(expression) and expression[position].is_op('.'):
+            right, position = self.evaluate_operand(expression, position + 1)
+            value = php_string(value) + php_string(right)
+        return value, position
+
+    def evaluate_operand(self, expression, position):
+        """Evaluates a single literal, array, constant, or supported
+        function call"""
+        if position >= len(expression):
+            raise WpConfigParseError('Incomplete expression')
+        token = expression[position]
+        if token.kind == 'string':
+            if not token.static:
+                raise WpConfigParseError('Interpolated string')
+            return token.value, position + 1
+        if token.kind == 'number':
+            return token.value, position + 1
+        if token.is_op('-', '+'):
+            value, position = self.evaluate_operand(expression, position + 1)
+            if not isinstance(value, (int, float)) or \
+                    isinstance(value, bool):
+                raise WpConfigParseError('Unary operator on a non number')
+            return (-value if token.value == '-' else value), position
+        if token.is_op('('):
+            inner, position = self.evaluate_concat(expression, position + 1)
+            if position >= len(expression) or \
+                    not expression[position].is_op(')'):
+                raise WpConfigParseError('Unbalanced parentheses')
+            return inner, position + 1
+        if token.is_op('['):
+            return self.evaluate_array(expression, position + 1, ']')
+        if token.kind == 'ident':
+            lowered = token.value.lower()
+            following = expression[position + 1] \
+                if position + 1 < len(expression) else None
+            if lowered == 'array' and following and following.is_op('('):
+                return self.evaluate_array(expression, position + 2, ')')
+            if lowered == 'dirname' and following and following.is_op('('):
+                inner, position = self.evaluate_concat(
+                    expression, position + 2)
+                if position >= len(expression) or \
+                        not expression[position].is_op(')'):
+                    raise WpConfigParseError('Unsupported dirname() call')
+                return os.path.dirname(php_string(inner)), position + 1
+            if following and following.is_op('(', '::'):
+                raise WpConfigParseError(
+                    'Function call %s() needs PHP' % token.value)
+            if lowered == 'true':
+                return True, position + 1
+            if lowered == 'false':
+                return False, position + 1
+            if lowered == 'null':
+                return None, position + 1
+            if token.value in self.constants:
+                return self.constants[token.value], position + 1
+            raise WpConfigParseError('Unknown constant %s' % token.value)
+        raise WpConfigParseError('Unsupported token %r' % token)
+
+    def evaluate_array(self, expression, position, closing):
+        """Evaluates the elements of an array literal up to closing.
+        Lists are returned for sequential keys, dicts otherwise"""
+        items = []
+        while True:
+            if position >= len(expression):
+                raise WpConfigParseError('Unterminated array')
+            if expression[position].is_op(closing):
+                break
+            value, position = self.evaluate_concat(expression, position)
+            key = None
+            if position < len(expression) and \
+                    expression[position].is_op('=>'):
+                key = value
+                value, position = self.evaluate_concat(
+                    expression, position + 1)
+            items.append((key, value))
+            if position < len(expression) and \
+                    expression[position].is_op(','):
+                position += 1
+        if all(key is None for key, _ in items):
+            return [value for _, value in items], position + 1
+        result = {}
+        next_key = 0
+        for key, value in items:
+            if key is None:
+                key = next_key
+            if isinstance(key, int):
+                next_key = max(next_key, key + 1)
+            result[str(key)] = value
+        return result, position + 1
+
+
+def php_string(value):
+    """Converts a static value to a string the way PHP's '.' does"""
+    if value is True:
+        return '1'
+    if value is False or value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, (list, dict)):
+        raise WpConfigParseError('Array to string conversion')
+    return str(value)
+
+
+def php_literal(value):
+    """Returns PHP source for a python value"""
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if value is None:
+        return 'null'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+class WpConfigEditor(object):
+    """Collects set / delete operations for one wp-config.php, and
+    applies them all in one pass. The new file is written to a temp file
+    in the same directory, fsync'd, and renamed over the original"""
+    # wp-cli's default anchor for new directives
+    ANCHORS = ["/* That's all, stop editing!", "require_once ABSPATH"]
+
+    def __init__(self, path):
+        self.path = path
+        self.operations = OrderedDict()
+
+    def set(self, name, value):
+        """Queues setting constant (or variable) name to value"""
+        self.operations[name] = ('set', value)
+
+    def delete(self, name):
+        """Queues removing the define() of name"""
+        self.operations[name] = ('delete', None)
+
+    @staticmethod
+    def coerce(old_value, text):
+        """Edits arrive as text. Like `wp config set` they are written as
+        strings, unless the directive currently holds a boolean or number
+        and the text reads as the same type"""
+        if not isinstance(text, str):
+            return text
+        if isinstance(old_value, bool):
+            if text.lower() in ('true', 'false'):
+                return text.lower() == 'true'
+        elif isinstance(old_value, (int, float)):
+            try:
+                return int(text)
+            except ValueError:
+                try:
+                    return float(text)
+                except ValueError:
+                    pass
+        return text
+
+    def apply(self):
+        """Applies all queued operations. Returns a dict of
+        directive name: True / False. Raises WpConfigParseError if the file
+        can not be edited statically, and OSError if it can not be
+        written"""
+        parser = WpConfigParser(self.path)
+        source = parser.source
+        directives = dict(
+            (directive.name, directive) for directive in parser.directives)
+        results = {}
+        edits = []
+        new_lines = []
+        for name, (operation, value) in self.operations.items():
+            directive = directives.get(name)
+            if operation == 'delete':
+                if not directive or directive.type != 'constant':
+                    results[name] = False
+                    continue
+                start, end = directive.start, directive.end
+                line_start = source.rfind('\n', 0, start) + 1
+                line_end = source.find('\n', end)
+                if line_end < 0:
+                    line_end = len(source)
+                if not source[line_start:start].strip() and \
+                        not source[end:line_end].strip():
+                    start, end = line_start, min(line_end + 1, len(source))
+                edits.append((start, end, ''))
+            elif directive:
+                edits.append((
+                    directive.value_start, directive.value_end,
+                    php_literal(self.coerce(directive.value, value))))
+            else:
+                new_lines.append(
+                    "define( '%s', %s );\n" % (name, php_literal(value)))
+            results[name] = True
+        if new_lines:
+            edits.append((self.insert_position(source), None,
+                          ''.join(new_lines)))
+        for start, end, text in sorted(
+                edits, key=lambda edit: edit[0], reverse=True):
+            if end is None:
+                end = start
+            source = source[:start] + text + source[end:]
+        self.write(source)
+        self.operations = OrderedDict()
+        return results
+
+    def insert_position(self, source):
+        """Returns the offset new define() lines are inserted at"""
+        for anchor in self.ANCHORS:
+            position = source.find(anchor)
+            if position >= 0:
+                return source.rfind('\n', 0, position) + 1
+        close_tag = source.rfind('?>')
+        if close_tag >= 0:
+            return close_tag
+        return len(source)
+
+    def write(self, source):
+        """Atomically replaces the file with source"""
+        directory = os.path.dirname(self.path)
+        file_stat = os.stat(self.path)
+        temp_fd, temp_path = tempfile.mkstemp(
+            prefix='.wp-config.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(temp_fd, 'w', encoding='UTF-8',
+                           errors='surrogateescape') as temp_file:
+                temp_file.write(source)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.chmod(temp_path, file_stat.st_mode & 0o7777)
+            try:
+                os.chown(temp_path, file_stat.st_uid, file_stat.st_gid)
+            except OSError:
+                pass
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)